@@ -29,8 +29,15 @@ over ethernet. The arduino has:
  Parameters - Motor name
  Reply - Integer of encoder count
  
+ D - Turn both motors at once
+ Parameters - Body direction, Body turns, comma, Mirror direction, Mirror turns
+ Reply - Body encoder count, comma, Mirror encoder count
+ 
  R - Reset encoder counts to 0
  Reply - None
+
+ V - Protocol version
+ Reply - Integer version, 2
  
  Motor names:
  B - Main body motor
@@ -66,6 +73,43 @@ over ethernet. The arduino has:
  in: '200\n'
  out: 'TBA300\n'
  in:  '-85\n'
+ out: 'DC800,A400\n'
+ in:  '-75,195\n'
+
+ A turn for an unknown motor or direction is answered with '!' and the same
+ error code a version 2 '!' frame would carry (2 bad motor, 4 bad direction):
+
+ out: 'TBX300\n'
+ in:  '!4\n'
+
+ Protocol version 2:
+
+ The same commands can be sent as binary frames, told apart from text by the
+ top bit of the first byte, see solar/protocol.py:
+
+ <0x80 | length><request id><command><payload>
+
+ length counts the bytes after the first. Payloads are big-endian, steps are
+ signed 16 bit with negative turning anticlockwise:
+
+ T - Motor name, steps            Reply - Encoder count (32 bit)
+ E - Motor name                   Reply - Encoder count (32 bit)
+ D - Body steps, mirror steps     Reply - Body, mirror encoder counts (32 bit)
+ Q - Query both encoders          Reply - Body, mirror encoder counts (32 bit),
+                                          home inputs (bit 0 body, bit 1 mirror)
+ R - Reset encoder counts to 0    Reply - None
+
+ Replies are frames carrying the request id and command of the request.
+ A frame that can't be carried out is answered with a '!' frame holding an
+ error code.
+
+ i.e. To turn the body 1000 steps anticlockwise as request 7, send the bytes:
+
+ 0x85 0x07 'T' 'B' 0xFC 0x18
+
+ and recieve the encoder count back as:
+
+ 0x86 0x07 'T' 0xFF 0xFF 0xFF 0xB0
  */
 
 #include "Encoder.h"
@@ -76,6 +120,14 @@ over ethernet. The arduino has:
 #define ENCODER_PAUSE_mS 100
 #define SYNC_PAUSE_mS 100
 
+#define PROTOCOL_VERSION 2
+#define FRAME_FLAG 0x80
+#define FRAME_MAX 16
+#define ERROR_UNKNOWN_COMMAND 1
+#define ERROR_BAD_MOTOR 2
+#define ERROR_BAD_LENGTH 3
+#define ERROR_BAD_DIRECTION 4
+
 unsigned char mac[] = { 
     0xDE, 0xAD, 0xBE, 0xEF, 0xFE, 0xED };
 //the IP address for the shield:
@@ -100,6 +152,9 @@ Motor m2 = {
 Encoder e1(20, 21);
 Encoder e2(18, 19);
 
+Motor *motors[2] = {&m1, &m2};
+Encoder *encoders[2] = {&e1, &e2};
+
 Server server(8010);
 
 char blocking_read(Client &client) {
@@ -111,18 +166,56 @@ char blocking_read(Client &client) {
     return input;
 }
 
-unsigned int parse_int(Client &client) {
+unsigned char read_byte(Client &client) {
+    int input;
+    do {
+        input = client.read();
+    }
+    while(input == -1);
+    return (unsigned char) input;
+}
+
+unsigned int parse_int_until(Client &client, char end) {
     char data[10];
     char c;
     int pos = 0;
     do {
         c = blocking_read(client);
-        data[pos++] = c; 
-    } while (c != '\n');
+        // Digits past the end of the buffer are dropped rather than overrun it
+        if(pos < sizeof(data) - 1)
+            data[pos++] = c;
+    } while (c != end);
     data[pos] = (char) NULL;
     return atoi(data);    
 }
 
+unsigned int parse_int(Client &client) {
+    return parse_int_until(client, '\n');
+}
+
+/*
+ Answer a text command that can't be carried out with '!' and an error code,
+ the legacy counterpart of send_error
+ */
+void send_text_error(Client &client, unsigned char code) {
+    client.print('!');
+    client.println(code);
+}
+
+bool set_direction(Motor *m, char dir) {
+    switch(dir) {
+    case 'A':
+        digitalWrite(m->dir, LOW);
+        return true;
+    case 'C':
+        digitalWrite(m->dir, HIGH);
+        return true;
+    default:
+        Serial.println("Unknown Direction");
+        return false;
+    }
+}
+
 void encoder_count(Client &client) {
     Encoder *e;
     char mtr = blocking_read(client);
@@ -161,27 +254,22 @@ void perform_turn(Client &client) {
     default:
         Serial.print("Unknown Motor: ");
         Serial.println(mtr);
+        // Drop the rest of the command so it isn't read as new commands
+        parse_int(client);
+        send_text_error(client, ERROR_BAD_MOTOR);
         return;
     }
 
-    digitalWrite(m->sync, LOW);
-    delay(SYNC_PAUSE_mS);
-
     char dir = blocking_read(client);
+    int steps = parse_int(client);
 
-    switch(dir) {
-    case 'A':
-        digitalWrite(m->dir, LOW);
-        break;
-    case 'C':
-        digitalWrite(m->dir, HIGH);
-        break;
-    default:
-        Serial.println("Unknown Direction");
+    if(!set_direction(m, dir)) {
+        send_text_error(client, ERROR_BAD_DIRECTION);
         return;
     }
 
-    int steps = parse_int(client);
+    digitalWrite(m->sync, LOW);
+    delay(SYNC_PAUSE_mS);
     int step_delay = STEP_DELAY_uS_TRACK;
     
     if(steps > 100)
@@ -203,6 +291,236 @@ void perform_turn(Client &client) {
     digitalWrite(m->sync, HIGH);
 }
 
+/*
+ Step both motors in the same loop, so the body and mirror slew together
+ and a move takes as long as the longer of the two rather than their sum
+ */
+void perform_dual_turn(Client &client) {
+    Motor *m[2] = {&m1, &m2};
+    char dir[2];
+    int steps[2];
+
+    dir[0] = blocking_read(client);
+    steps[0] = parse_int_until(client, ',');
+    dir[1] = blocking_read(client);
+    steps[1] = parse_int_until(client, '\n');
+
+    for(int j=0; j < 2; j++) {
+        if(!set_direction(m[j], dir[j])) {
+            send_text_error(client, ERROR_BAD_DIRECTION);
+            return;
+        }
+    }
+
+    int most = max(steps[0], steps[1]);
+    int step_delay = STEP_DELAY_uS_TRACK;
+
+    if(most > 100)
+        step_delay = STEP_DELAY_uS_FAST;
+
+    for(int j=0; j < 2; j++) {
+        if(steps[j] > 0)
+            digitalWrite(m[j]->sync, LOW);
+    }
+    delay(SYNC_PAUSE_mS);
+
+    for(int i=0; i < most; i++) {
+        for(int j=0; j < 2; j++) {
+            if(i < steps[j])
+                digitalWrite(m[j]->clock, HIGH);
+        }
+        delayMicroseconds(step_delay);
+        for(int j=0; j < 2; j++)
+            digitalWrite(m[j]->clock, LOW);
+        delayMicroseconds(step_delay);
+    }
+
+    delay(ENCODER_PAUSE_mS);
+
+    client.print(e1.read());
+    client.print(',');
+    client.println(e2.read());
+
+    delay(SYNC_PAUSE_mS);
+
+    digitalWrite(m1.sync, HIGH);
+    digitalWrite(m2.sync, HIGH);
+}
+
+/*
+ Returns the index of a motor in motors and encoders, or -1
+ */
+int motor_index(char mtr) {
+    switch(mtr) {
+    case 'B':
+        return 0;
+    case 'M':
+        return 1;
+    default:
+        Serial.print("Unknown Motor: ");
+        Serial.println(mtr);
+        return -1;
+    }
+}
+
+int get_int16(unsigned char *data) {
+    return (int) (((unsigned int) data[0] << 8) | data[1]);
+}
+
+void put_int32(unsigned char *data, long value) {
+    for(int i=0; i < 4; i++)
+        data[i] = (value >> (24 - 8 * i)) & 0xFF;
+}
+
+/*
+ Step both motors in the same loop, negative steps turning anticlockwise.
+ The sync lines are left low for end_turn once the reply is sent
+ */
+void turn_motors(int steps[2]) {
+    int count[2];
+
+    for(int j=0; j < 2; j++) {
+        set_direction(motors[j], steps[j] < 0 ? 'A' : 'C');
+        count[j] = abs(steps[j]);
+        if(count[j] > 0)
+            digitalWrite(motors[j]->sync, LOW);
+    }
+
+    int most = max(count[0], count[1]);
+    int step_delay = STEP_DELAY_uS_TRACK;
+
+    if(most > 100)
+        step_delay = STEP_DELAY_uS_FAST;
+
+    delay(SYNC_PAUSE_mS);
+
+    for(int i=0; i < most; i++) {
+        for(int j=0; j < 2; j++) {
+            if(i < count[j])
+                digitalWrite(motors[j]->clock, HIGH);
+        }
+        delayMicroseconds(step_delay);
+        for(int j=0; j < 2; j++)
+            digitalWrite(motors[j]->clock, LOW);
+        delayMicroseconds(step_delay);
+    }
+
+    delay(ENCODER_PAUSE_mS);
+}
+
+void end_turn() {
+    delay(SYNC_PAUSE_mS);
+
+    digitalWrite(m1.sync, HIGH);
+    digitalWrite(m2.sync, HIGH);
+}
+
+/*
+ Send a reply frame in a single write, so it goes out in one packet
+ */
+void send_reply(Client &client, unsigned char id, char op, unsigned char *payload, int size) {
+    unsigned char frame[FRAME_MAX];
+
+    frame[0] = FRAME_FLAG | (size + 2);
+    frame[1] = id;
+    frame[2] = op;
+    for(int i=0; i < size; i++)
+        frame[3 + i] = payload[i];
+
+    client.write(frame, size + 3);
+}
+
+void send_error(Client &client, unsigned char id, unsigned char code) {
+    send_reply(client, id, '!', &code, 1);
+}
+
+/*
+ Carry out a protocol version 2 frame, the header byte already read
+ */
+void perform_frame(Client &client, unsigned char header) {
+    unsigned char frame[FRAME_MAX];
+    unsigned char reply[9];
+    int steps[2] = {0, 0};
+    int length = header & ~FRAME_FLAG;
+    int j;
+
+    // Read the whole frame even if it is too long, to stay in step
+    for(int i=0; i < length; i++) {
+        unsigned char c = read_byte(client);
+        if(i < FRAME_MAX)
+            frame[i] = c;
+    }
+
+    if(length < 2 || length > FRAME_MAX) {
+        send_error(client, length > 0 ? frame[0] : 0, ERROR_BAD_LENGTH);
+        return;
+    }
+
+    unsigned char id = frame[0];
+    char op = frame[1];
+    unsigned char *payload = frame + 2;
+    int size = length - 2;
+
+    switch(op) {
+    case 'R':
+        e1.write(0);
+        e2.write(0);
+        break;
+    case 'E':
+        if(size != 1) {
+            send_error(client, id, ERROR_BAD_LENGTH);
+            break;
+        }
+        j = motor_index(payload[0]);
+        if(j < 0) {
+            send_error(client, id, ERROR_BAD_MOTOR);
+            break;
+        }
+        put_int32(reply, encoders[j]->read());
+        send_reply(client, id, op, reply, 4);
+        break;
+    case 'Q':
+        put_int32(reply, e1.read());
+        put_int32(reply + 4, e2.read());
+        reply[8] = digitalRead(m1.home) | (digitalRead(m2.home) << 1);
+        send_reply(client, id, op, reply, 9);
+        break;
+    case 'T':
+        if(size != 3) {
+            send_error(client, id, ERROR_BAD_LENGTH);
+            break;
+        }
+        j = motor_index(payload[0]);
+        if(j < 0) {
+            send_error(client, id, ERROR_BAD_MOTOR);
+            break;
+        }
+        steps[j] = get_int16(payload + 1);
+        turn_motors(steps);
+        put_int32(reply, encoders[j]->read());
+        send_reply(client, id, op, reply, 4);
+        end_turn();
+        break;
+    case 'D':
+        if(size != 4) {
+            send_error(client, id, ERROR_BAD_LENGTH);
+            break;
+        }
+        steps[0] = get_int16(payload);
+        steps[1] = get_int16(payload + 2);
+        turn_motors(steps);
+        put_int32(reply, e1.read());
+        put_int32(reply + 4, e2.read());
+        send_reply(client, id, op, reply, 8);
+        end_turn();
+        break;
+    default:
+        Serial.print("Unknown Frame Command: ");
+        Serial.println(op);
+        send_error(client, id, ERROR_UNKNOWN_COMMAND);
+    }
+}
+
 void setup() {
     Ethernet.begin(mac, ip, subnet);
     server.begin();
@@ -231,7 +549,12 @@ void loop() {
 
     if (client) {
         while (client.available() > 0) {
-            char command = blocking_read(client);
+            unsigned char command = read_byte(client);
+
+            if(command & FRAME_FLAG) {
+                perform_frame(client, command);
+                continue;
+            }
 
             switch(command) {
             case '\n': // Catch any extra newlines
@@ -246,6 +569,12 @@ void loop() {
             case 'E':
                 encoder_count(client);
                 break;
+            case 'D':
+                perform_dual_turn(client);
+                break;
+            case 'V':
+                client.println(PROTOCOL_VERSION);
+                break;
             default:
                 Serial.print("Unknown Command: ");
                 Serial.println(command);
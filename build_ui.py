@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Compile the Qt Designer .ui files to Python modules, so the GUIs don't parse
+XML every time they start
+
+    python build_ui.py
+
+writes ui/solar_drive_ui.py and raw_test/solar_drive_ui.py next to their .ui
+files. Run it again after editing a .ui file, until then load_ui falls back
+to parsing the .ui file whenever its module is missing or older than it.
+"""
+import imp
+import logging
+import os
+import sys
+from xml.etree import ElementTree
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+UI_FILES = [
+    os.path.join(ROOT, 'ui', 'solar_drive.ui'),
+    os.path.join(ROOT, 'raw_test', 'solar_drive.ui'),
+]
+
+
+def module_path(ui_file):
+    """
+    Returns where the compiled module for a .ui file goes
+    """
+    return os.path.splitext(ui_file)[0] + '_ui.py'
+
+
+def compile_ui(ui_file):
+    """
+    Compile a .ui file to a module defining its Ui_ class, and WIDGET_CLASS,
+    the Qt class of the top level widget
+    Returns the module's path
+    """
+    from PyQt4 import uic
+    widget_class = ElementTree.parse(ui_file).getroot().find('widget').get('class')
+    path = module_path(ui_file)
+    with open(path, 'w') as f:
+        uic.compileUi(ui_file, f)
+        f.write('\nWIDGET_CLASS = {!r}\n'.format(widget_class))
+    return path
+
+
+def _compiled(ui_file):
+    """
+    Returns the class of the top level widget built from the compiled
+    module, or None if there isn't an up to date one
+    """
+    path = module_path(ui_file)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(ui_file):
+        return None
+    try:
+        name = '_ui_{}'.format(abs(hash(path)))
+        module = imp.load_source(name, path)
+        from PyQt4 import QtGui
+        base = getattr(QtGui, module.WIDGET_CLASS)
+        ui_class = [value for key, value in vars(module).items() if key.startswith('Ui_')][0]
+    except (ImportError, SyntaxError, AttributeError, IndexError) as e:
+        logging.warning('Unable to use {}: {}'.format(path, e))
+        return None
+    return type(ui_class.__name__[3:], (base, ui_class), {})
+
+
+def load_ui(ui_file):
+    """
+    Build the interface described by a .ui file, from its compiled module
+    when that is up to date, otherwise by parsing the .ui file
+    Returns the top level widget, with the named widgets as attributes, as
+    uic.loadUi does
+    """
+    widget_class = _compiled(ui_file)
+    if widget_class is None:
+        from PyQt4 import uic
+        return uic.loadUi(ui_file)
+    widget = widget_class()
+    widget.setupUi(widget)
+    return widget
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    for ui_file in sys.argv[1:] or UI_FILES:
+        logging.info('Compiled {} to {}'.format(ui_file, compile_ui(ui_file)))
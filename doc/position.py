@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
+import os
+import sys
 from pylab import *
-import Pysolar as pysol
-from datetime import datetime, timedelta
+from datetime import datetime
+
+# Run as python doc/position.py, which puts doc/ rather than the repository on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from solar.ephemeris import sun_position
 
 start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
 lat = 51.4841
 lng = -3.1701
 x = linspace(8 * 3600, 8 * 3600 + 12 * 60 * 60, num=200)
-alt = array([pysol.GetAltitude(lat, lng, start + timedelta(seconds=s)) for s in x])
-az = array([pysol.GetAzimuth(lat, lng, start + timedelta(seconds=s)) for s in x])
-az = (az - 180) % -360 + 360
+az, alt = sun_position(lng, lat, datetime64(start) + (x * 1e6).astype('timedelta64[us]'))
+az, alt = az / 3600, alt / 3600
 m, b = polyfit(x, az, 1)
 az_fit = m * x + b
 
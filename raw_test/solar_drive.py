@@ -1,9 +1,13 @@
 import socket
 import time
 import sys
+import os
 import logging
 
-from PyQt4 import QtGui, QtCore, uic
+from PyQt4 import QtGui, QtCore
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from build_ui import load_ui
 
 arduino = {
     'ip' : '192.168.2.2',
@@ -13,7 +17,7 @@ arduino = {
 class SerialApp(QtGui.QApplication):
     def __init__(self):
         super(SerialApp, self).__init__([])
-        self.ui = uic.loadUi('solar_drive.ui')
+        self.ui = load_ui(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'solar_drive.ui'))
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.connect((arduino['ip'], arduino['port']))
         self.client_socket.setblocking(0)
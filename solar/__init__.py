@@ -1,3 +1,11 @@
 from solar import *
 from common import *
-from solar_async import TelescopeManager
+
+
+def TelescopeManager(*args, **kwargs):
+    """
+    Make a solar_async.TelescopeManager. solar_async brings in multiprocessing
+    and NumPy, so it is only imported when the first one is made
+    """
+    from solar_async import TelescopeManager
+    return TelescopeManager(*args, **kwargs)
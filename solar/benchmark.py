@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the telescope library, run against the simulated controller
+
+    python solar/benchmark.py --output results.json --baseline baseline.json
+
+Measures:
+    latency -- round trip time of current_position and _raw_turn over a real
+               local socket, with the firmware delays switched off
+    slew -- simulated time and round trips taken by adjust_polar/adjust_dec,
+            and by adjust_both moving the two axes together, for a range of
+            targets, on a virtual clock with the firmware delays
+    stop -- longest and mean simulated time between the moves of a long
+            slew, which bounds how long a slew takes to stop
+    protocol -- bytes and round trips for a tracking move and a query of both
+                encoders, in the legacy text protocol and version 2
+    tracking -- pointing error over a simulated hour of tracking
+    startup -- time a fresh interpreter takes to import solar, to make a
+               TelescopeManager, and to build the GUI from ui/solar_drive.ui
+               compiled by build_ui.py and parsed at runtime, if PyQt4 is installed
+
+Every figure is lower-is-better. When a baseline file exists the results are
+compared against it, and any figure that got worse by more than the tolerance
+is reported as a regression, giving a non-zero exit status.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import clock
+import protocol
+import simulator
+import solar
+import tracking_sim
+
+SLEW_TARGETS = (10, 100, 1000, 10000, 100000)  # Arcseconds
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _summarise(seconds):
+    return {
+        'mean_ms': sum(seconds) / len(seconds) * 1000,
+        'median_ms': _percentile(seconds, 0.5) * 1000,
+        'p95_ms': _percentile(seconds, 0.95) * 1000,
+    }
+
+
+def bench_latency(samples=500):
+    """
+    Returns latency statistics for each command, in milliseconds
+    """
+    sim = simulator.Simulator(time_scale=0)
+    sim.start()
+    try:
+        solar.connect(*sim.address)
+        results = {}
+        for name, command in (('current_position', lambda: solar.current_position(solar.Devices.body)),
+                              ('_raw_turn', lambda: solar._raw_turn(solar.Devices.body,
+                                                                    solar.Directions.clockwise, 10))):
+            times = []
+            for i in range(samples):
+                start = time.time()
+                command()
+                times.append(time.time() - start)
+            results[name] = _summarise(times)
+        solar.get_telescope().disconnect()
+        return results
+    finally:
+        sim.stop()
+
+
+def bench_slew(slip=0.02, targets=SLEW_TARGETS):
+    """
+    Returns the simulated time and round trips for each axis and target
+    """
+    previous = clock.set_clock(clock.VirtualClock())
+    try:
+        controller = simulator.Controller(slip=slip, seed=0)
+        solar.connect(transport=simulator.FakeTransport(controller))
+        telescope = solar.get_telescope()
+        results = {}
+        for name, adjust in (('polar', solar.adjust_polar), ('dec', solar.adjust_dec),
+                             ('both', lambda arcsec: solar.adjust_both(arcsec, -arcsec))):
+            for arcsec in targets:
+                start, round_trips = clock.monotonic(), telescope.round_trips
+                adjust(arcsec)
+                results['{}_{}'.format(name, arcsec)] = {
+                    'time_s': clock.monotonic() - start,
+                    'round_trips': telescope.round_trips - round_trips,
+                }
+        return results
+    finally:
+        clock.set_clock(previous)
+
+
+def bench_stop(slip=0.02, arcsec=100000):
+    """
+    Returns the time between the moves of a long slew, when it can be stopped
+    """
+    previous = clock.set_clock(clock.VirtualClock())
+    try:
+        solar.connect(transport=simulator.FakeTransport(simulator.Controller(slip=slip, seed=0)))
+        gaps = []
+        last = clock.monotonic()
+        for _ in solar.slew_moves(arcsec, arcsec):
+            gaps.append(clock.monotonic() - last)
+            last = clock.monotonic()
+        return {'max_s': max(gaps), 'mean_s': sum(gaps) / len(gaps)}
+    finally:
+        clock.set_clock(previous)
+
+
+def bench_protocol(moves=100):
+    """
+    Returns the bytes and round trips per tracking move and per query of both
+    encoders, for each protocol version
+    """
+    results = {}
+    for version in (1, protocol.VERSION):
+        solar.connect(transport=simulator.FakeTransport(simulator.Controller(time_scale=0, version=version)),
+                      version=version)
+        telescope = solar.get_telescope()
+        for name, command in (('move', lambda: solar.step_both(solar.Directions.clockwise, solar.STEPS_PER_ENC,
+                                                               solar.Directions.anti_clockwise, 10)),
+                              ('query', telescope.sync)):
+            sent, received, round_trips = telescope.bytes_sent, telescope.bytes_received, telescope.round_trips
+            for i in range(moves):
+                command()
+            results['v{}_{}'.format(version, name)] = {
+                'bytes': float(telescope.bytes_sent + telescope.bytes_received - sent - received) / moves,
+                'round_trips': float(telescope.round_trips - round_trips) / moves,
+            }
+    return results
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SOLAR = os.path.join(ROOT, 'solar')
+
+# Each is run in a fresh interpreter from the repository root with solar/ first
+# on the path, as this runner has it, the figure is the time taken by the
+# statements after the setup, as the GUI starts
+STARTUP = {
+    'import_solar': ('', 'import solar'),
+    'telescope_manager': ('import solar_async', 'solar_async.TelescopeManager()'),
+    'ui_compiled': ('from PyQt4 import QtGui; import build_ui; app = QtGui.QApplication([])',
+                    'build_ui.load_ui(build_ui.UI_FILES[0])'),
+    'ui_runtime': ('from PyQt4 import QtGui, uic; import build_ui; app = QtGui.QApplication([])',
+                   'uic.loadUi(build_ui.UI_FILES[0])'),
+}
+
+
+def _startup_time(setup, statements):
+    code = ('import sys, time; sys.path.insert(0, {!r}); {}\n'
+            't = time.time(); {}; print(time.time() - t)').format(SOLAR, setup or 'pass', statements)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, stderr=subprocess.STDOUT)
+    return float(output.decode('ascii').split()[-1])
+
+
+def bench_startup(samples=5):
+    """
+    Returns the cold start time of each step in STARTUP, in milliseconds.
+    A step that fails, such as one needing PyQt4 when it isn't installed, is
+    recorded as None and skipped
+    """
+    results = {}
+    for name, (setup, statements) in sorted(STARTUP.items()):
+        try:
+            times = [_startup_time(setup, statements) for i in range(samples)]
+        except subprocess.CalledProcessError as e:
+            error = e.output.decode('ascii', 'replace').strip().split('\n')[-1]
+            print('Skipped startup step {}: {}'.format(name, error))
+            results[name] = None
+            continue
+        results[name] = _summarise(times)
+    return results
+
+
+def bench_tracking(slip=0.02, hours=1.):
+    """
+    Returns the pointing error and command rate over a simulated tracking session
+    """
+    report = tracking_sim.simulate_tracking(duration=hours * 3600, slip=slip, slip_jitter=slip / 2)
+    return dict((key, report[key]) for key in ('rms_error', 'peak_error', 'commands_per_minute'))
+
+
+def flatten(results, prefix=''):
+    """
+    Turn nested results into {'a.b.c': value}
+    """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Print each figure against the baseline
+    Returns the names of figures that are more than tolerance worse
+    """
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for name in sorted(current):
+        if current[name] is None:
+            print('{:45s} {:>12s}'.format(name, 'skipped'))
+            continue
+        if previous.get(name) is None:
+            print('{:45s} {:12.3f}'.format(name, current[name]))
+            continue
+        old, new = previous[name], current[name]
+        change = float(new - old) / abs(old) if old else 0.
+        flag = ''
+        if change > tolerance:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print('{:45s} {:12.3f} {:12.3f} {:+7.1%}{}'.format(name, new, old, change, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the telescope library')
+    parser.add_argument('--output', default='benchmark.json', help='file to write results to')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the results to the baseline file as well')
+    parser.add_argument('--slip', type=float, default=0.02)
+    parser.add_argument('--samples', type=int, default=500, help='commands per latency measurement')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fractional change counted as a regression')
+    args = parser.parse_args()
+
+    results = {
+        'latency': bench_latency(args.samples),
+        'slew': bench_slew(args.slip),
+        'stop': bench_stop(args.slip),
+        'protocol': bench_protocol(),
+        'tracking': bench_tracking(args.slip),
+        'startup': bench_startup(),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    regressions = []
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    else:
+        compare(results, {})
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Clocks for the telescope code to tell the time and sleep with
+
+Everything that needs the time goes through the module level functions
+here, which ask the active clock. Swapping in a VirtualClock or an
+AcceleratedClock with set_clock lets a day of tracking be simulated in
+seconds.
+"""
+from datetime import datetime, timedelta
+import errno
+import select
+import time
+
+EPOCH = datetime(1970, 1, 1)
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    # Python 2, read CLOCK_MONOTONIC directly where it's available
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+                                     use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        _monotonic = time.time
+    else:
+        _CLOCK_MONOTONIC = 1
+
+        def _monotonic():
+            """
+            Seconds on a clock that never jumps, with an arbitrary zero
+            """
+            ts = _timespec()
+            if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+class RealClock(object):
+    """
+    The system clocks
+    """
+    def time(self):
+        """
+        POSIX seconds
+        """
+        return time.time()
+
+    def monotonic(self):
+        return _monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, conn, timeout):
+        """
+        Wait for a message on a connection
+        conn -- multiprocessing Connection, or anything with fileno()
+        timeout -- Seconds to wait at most
+        Returns True if there is something to read
+        """
+        deadline = _monotonic() + timeout
+        while True:
+            try:
+                readable, _, _ = select.select([conn], [], [], max(timeout, 0))
+            except (select.error, OSError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                timeout = deadline - _monotonic()
+                continue
+            return bool(readable)
+
+
+class VirtualClock(object):
+    """
+    A clock that only moves when something sleeps on it, so waiting is free
+
+    start -- Initial UTC datetime or POSIX seconds, defaults to now
+    """
+    def __init__(self, start=None):
+        if start is None:
+            start = time.time()
+        elif isinstance(start, datetime):
+            start = (start - EPOCH).total_seconds()
+        self._start = start
+        self._elapsed = 0.
+
+    def time(self):
+        return self._start + self._elapsed
+
+    def monotonic(self):
+        return self._elapsed
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self._elapsed += seconds
+
+    def wait(self, conn, timeout):
+        if conn.poll():
+            return True
+        self.sleep(timeout)
+        return False
+
+
+class AcceleratedClock(RealClock):
+    """
+    Real time sped up by a constant factor
+
+    factor -- How many simulated seconds pass each real second
+    start -- Initial UTC datetime or POSIX seconds, defaults to now
+    """
+    def __init__(self, factor, start=None):
+        self.factor = float(factor)
+        if start is None:
+            start = time.time()
+        elif isinstance(start, datetime):
+            start = (start - EPOCH).total_seconds()
+        self._start = start
+        self._real_start = _monotonic()
+
+    def monotonic(self):
+        return (_monotonic() - self._real_start) * self.factor
+
+    def time(self):
+        return self._start + self.monotonic()
+
+    def sleep(self, seconds):
+        RealClock.sleep(self, seconds / self.factor)
+
+    def wait(self, conn, timeout):
+        return RealClock.wait(self, conn, timeout / self.factor)
+
+
+_active = RealClock()
+
+
+def set_clock(clock):
+    """
+    Make clock the one used everywhere
+    Returns the previous clock
+    """
+    global _active
+    previous, _active = _active, clock
+    return previous
+
+
+def get_clock():
+    return _active
+
+
+def time_now():
+    """
+    POSIX seconds from the active clock
+    """
+    return _active.time()
+
+
+def utcnow():
+    """
+    Current UTC time from the active clock as a naive datetime, like datetime.utcnow
+    """
+    return EPOCH + timedelta(seconds=_active.time())
+
+
+def monotonic():
+    return _active.monotonic()
+
+
+def sleep(seconds):
+    _active.sleep(seconds)
+
+
+def wait(conn, timeout):
+    """
+    Wait up to timeout seconds for a message on conn
+    Returns True if there is something to read
+    """
+    return _active.wait(conn, timeout)
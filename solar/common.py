@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
-from datetime import datetime, timedelta
-import Pysolar as pysol
+from datetime import timedelta
+import clock
 
 
 def az_to_str(arcsec):
@@ -33,7 +33,7 @@ def mean_solar_time(longitude):
     longitude -- Current longitude
     Returns mean solar time as a python Datetime object
     """
-    lt = datetime.utcnow()
+    lt = clock.utcnow()
     dt = timedelta(seconds=longitude / 15 * 3600)
     mst = lt + dt
     return mst
@@ -46,7 +46,9 @@ def sun_az(longitude, latitude):
     latitude -- Current latitude
     Returns the Sun's azimuth in arcseconds
     """
-    return pysol.GetAzimuth(latitude, longitude, datetime.utcnow()) * 3600
+    # Imported here so importing solar doesn't bring in NumPy
+    from ephemeris import sun_position
+    return float(sun_position(longitude, latitude, clock.time_now())[0])
 
 
 def sun_alt(longitude, latitude):
@@ -56,4 +58,5 @@ def sun_alt(longitude, latitude):
     latitude -- Current latitude
     Returns the Sun's altitude in arcseconds
     """
-    return pysol.GetAltitude(latitude, longitude, datetime.utcnow()) * 3600
+    from ephemeris import sun_position
+    return float(sun_position(longitude, latitude, clock.time_now())[1])
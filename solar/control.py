@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Controllers deciding how far to move an axis on each step of a tracking loop
+
+A tracking loop gives its controller the pointing error and the feedforward
+move the target's own motion calls for, and gets back the move to make,
+all in arcseconds. Gains are kept per axis in a JSON file:
+
+    {"body": {"kp": 1.0, "ki": 0.02, "deadband": 0.5},
+     "mirror": {"kp": 1.0, "deadband": 2.0}}
+
+Any gain left out takes the PIDController default. tune_gains.py picks
+gains by replaying recorded sessions.
+"""
+import json
+import logging
+import os
+import solar
+
+CONFIG_PATH = os.path.join(os.path.expanduser('~'), '.config', 'solar_drive', 'gains.json')
+
+
+class TrackController(object):
+    """
+    Interface for tracking controllers, one per axis
+    """
+    def reset(self):
+        """
+        Forget any history, called when tracking starts
+        """
+        pass
+
+    def update(self, error, feedforward, dt):
+        """
+        error -- Target minus measured position, arcsec
+        feedforward -- Move the target's motion alone calls for, arcsec
+        dt -- Seconds since the last update
+        Returns the move to make, arcsec
+        """
+        raise NotImplementedError
+
+
+class ThresholdController(TrackController):
+    """
+    The original tracking correction: feedforward only, plus a catch-up of
+    all but one encoder tick when more than a tick behind, a nudge of
+    SLIP_FACTOR steps when less than a tick behind, and no move at all when
+    ahead. A catch-up is limited to what one command can turn, the rest is
+    left for the next update
+
+    mount -- solar.Mount of the axis, defaults to solar's constants
+    """
+    def __init__(self, mount=None):
+        self.mount = mount or solar.Mount()
+        self.output_limit = solar.MAX_STEPS_PER_COMMAND * self.mount.arcsec_per_step
+
+    def update(self, error, feedforward, dt):
+        ticks = error // self.mount.arcsec_per_enc
+        if ticks > 1:
+            move = feedforward + (ticks - 1) * self.mount.arcsec_per_enc
+        elif ticks > 0:
+            move = feedforward + self.mount.slip_factor * self.mount.arcsec_per_step
+        elif ticks < 0:
+            return 0.
+        else:
+            move = feedforward
+        return min(max(move, -self.output_limit), self.output_limit)
+
+
+class PIDController(TrackController):
+    """
+    Feedforward plus PID on the encoder measured error
+
+    The integral is clamped to integral_limit, and stops growing while the
+    output is saturated at output_limit, so a long stall doesn't wind it up
+    into an overshoot. Moves smaller than the deadband aren't made, saving a
+    command at the cost of some error.
+
+    kp, ki, kd -- Proportional, integral (per second) and derivative
+                  (seconds) gains
+    kff -- Gain on the feedforward move
+    integral_limit -- Largest the integral term may contribute, arcsec,
+                      defaults to 4 encoder ticks
+    output_limit -- Largest move made at once, arcsec, defaults to the most
+                    steps one command can turn
+    deadband -- Smallest move made, arcsec
+    mount -- solar.Mount the defaults are worked out for, defaults to solar's constants
+    """
+    def __init__(self, kp=1., ki=0., kd=0., kff=1., integral_limit=None, output_limit=None, deadband=0.,
+                 mount=None):
+        mount = mount or solar.Mount()
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.kff = kff
+        self.integral_limit = 4 * mount.arcsec_per_enc if integral_limit is None else integral_limit
+        self.output_limit = solar.MAX_STEPS_PER_COMMAND * mount.arcsec_per_step if output_limit is None \
+            else output_limit
+        self.deadband = deadband
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.
+        self.last_error = None
+
+    def update(self, error, feedforward, dt):
+        derivative = 0.
+        if self.last_error is not None and dt > 0:
+            derivative = (error - self.last_error) / dt
+        self.last_error = error
+
+        integral = self.integral + self.ki * error * dt
+        integral = min(max(integral, -self.integral_limit), self.integral_limit)
+        output = self.kff * feedforward + self.kp * error + integral + self.kd * derivative
+        limited = min(max(output, -self.output_limit), self.output_limit)
+        # Anti-windup, only integrate while the output isn't pinned at its limit
+        if limited == output or (output > 0) != (error > 0):
+            self.integral = integral
+
+        if abs(limited) < self.deadband:
+            return 0.
+        return limited
+
+    def gains(self):
+        return {
+            'kp': self.kp, 'ki': self.ki, 'kd': self.kd, 'kff': self.kff,
+            'integral_limit': self.integral_limit, 'output_limit': self.output_limit,
+            'deadband': self.deadband,
+        }
+
+
+def make_controllers(gains=None, mount=None):
+    """
+    Build a PIDController for each axis
+    gains -- {'body': {...}, 'mirror': {...}} of PIDController arguments
+    mount -- solar.Mount of the telescope, defaults to solar's constants
+    Returns {motor: controller}
+    """
+    gains = gains or {}
+    return {
+        solar.Devices.body: PIDController(mount=mount, **gains.get('body', {})),
+        solar.Devices.mirror: PIDController(mount=mount, **gains.get('mirror', {})),
+    }
+
+
+def load_controllers(path=None, mount=None):
+    """
+    Build controllers from a gains file, see the module docstring
+    path -- JSON file, defaults to CONFIG_PATH. Defaults are used if it doesn't exist
+    mount -- solar.Mount of the telescope, defaults to solar's constants
+    Returns {motor: controller}
+    """
+    path = path or CONFIG_PATH
+    if not os.path.exists(path):
+        return make_controllers(mount=mount)
+    with open(path) as f:
+        gains = json.load(f)
+    logging.info('Tracking gains from {}: {}'.format(path, gains))
+    return make_controllers(gains, mount)
+
+
+def save_gains(controllers, path=None):
+    """
+    Write the gains of PIDControllers to a file load_controllers can read
+    """
+    path = path or CONFIG_PATH
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump({'body': controllers[solar.Devices.body].gains(),
+                   'mirror': controllers[solar.Devices.mirror].gains()}, f, indent=2, sort_keys=True)
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+Headless daemon owning the connection to the arduino, needing Python 3.6 or later
+
+The firmware accepts one TCP connection, so only one program can drive the
+mount at a time. The daemon holds that connection with a
+solar_aio.AsyncTelescope and serves any number of clients, the GUI, scripts
+and loggers, over a Unix domain socket:
+
+    python solar/daemon.py --socket /tmp/solar_drive.sock --longitude -3.18 --latitude 51.48
+
+Each line on the socket is a JSON-RPC 2.0 message. Requests are
+
+    {"jsonrpc": "2.0", "id": 1, "method": "slew", "params": {"polar": 3600, "dec": 0}}
+
+and get a result or error back with the same id once done, so a slew is
+answered when the mount stops. Requests from one client are carried out
+concurrently, and only one slew or track runs at once, see Daemon.METHODS.
+A client that calls subscribe is sent a telemetry notification, a request
+with no id, every time the state changes:
+
+    {"jsonrpc": "2.0", "method": "telemetry", "params": {"az": ..., "enc_body": ...}}
+
+Telemetry is encoded once for all subscribers. A subscriber that isn't
+reading misses updates until it catches up, rather than holding up the rest.
+
+daemon_client.DaemonClient is a blocking client that runs on Python 2 as well.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import math
+import os
+import solar
+import simulator
+import transform
+from ephemeris import EphemerisCache
+from solar_aio import AsyncTelescope
+from solar_async import SLEW_TOLERANCE_TICKS, MAX_SLEW_MOVES
+
+DEFAULT_SOCKET = '/tmp/solar_drive.sock'
+# Bytes waiting to go to a subscriber before it misses telemetry
+TELEMETRY_BACKLOG = 64 * 1024
+
+
+class Errors:
+    """
+    JSON-RPC error codes
+    """
+    PARSE_ERROR = -32700
+    INVALID_REQUEST = -32600
+    METHOD_NOT_FOUND = -32601
+    INVALID_PARAMS = -32602
+    INTERNAL_ERROR = -32603
+    # Codes for the mount
+    BUSY = 1
+    CANCELLED = 2
+    LINK_DOWN = 3
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super(RPCError, self).__init__(message)
+        self.code = code
+
+
+def _number(name, value):
+    """
+    Check a parameter is a finite number
+    Returns it as a float
+    Raises RPCError INVALID_PARAMS if it isn't
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        value = None
+    if value is None or not math.isfinite(value):
+        raise RPCError(Errors.INVALID_PARAMS, '{} must be a number'.format(name))
+    return value
+
+
+def motion(f):
+    """
+    Decorator for methods that move the mount. Only one runs at a time, and
+    stop cancels it. A client going away doesn't
+    """
+    @functools.wraps(f)
+    async def _motion(self, *args, **kwargs):
+        motion = self.start_motion(f, *args, **kwargs)
+        try:
+            return await asyncio.shield(motion)
+        except asyncio.CancelledError:
+            if not motion.cancelled():
+                raise
+            raise RPCError(Errors.CANCELLED, '{} stopped'.format(f.__name__))
+    return _motion
+
+
+class Daemon(object):
+    """
+    Serve the telescope to clients on a Unix domain socket
+
+    address -- (ip, port) of the arduino
+    longitude, latitude -- Site, in degrees
+    version -- Protocol version to speak, None to ask the firmware
+    """
+    METHODS = ('status', 'subscribe', 'unsubscribe', 'set_position', 'set_site', 'tune',
+               'slew', 'slew_altaz', 'slew_to_sun', 'track', 'stop', 'reset_zero')
+
+    def __init__(self, address, longitude=0., latitude=0., version=None):
+        self.address = address
+        self.version = version
+        self.telescope = AsyncTelescope()
+        self.ephemeris = EphemerisCache()
+        self.longitude = longitude
+        self.latitude = latitude
+        self.az = 0.
+        self.alt = 0.
+        self.motion = None
+        self.motion_name = None
+        self.subscribers = set()
+        self.clients = 0
+        self._telemetry = None
+        self._keepalive = None
+        self._server = None
+
+    async def start(self, path=DEFAULT_SOCKET):
+        """
+        Connect to the arduino and listen for clients on path
+        """
+        await self.telescope.connect(*self.address, version=self.version)
+        await self.telescope.positions()
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = await asyncio.start_unix_server(self._serve, path)
+        self._telemetry = asyncio.ensure_future(self._fan_out())
+        self._keepalive = asyncio.ensure_future(self._keep_alive())
+        logging.info('Serving the telescope at {}'.format(path))
+
+    async def close(self):
+        for task in (self.motion, self._telemetry, self._keepalive):
+            if task is not None:
+                task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.telescope.close()
+
+    def status(self):
+        """
+        Returns where the mount points, what it's doing, and the state of the link
+        """
+        state = dict(self.telescope.state)
+        state.update(az=self.az, alt=self.alt, longitude=self.longitude, latitude=self.latitude,
+                     tune=list(self.telescope.tune), motion=self.motion_name,
+                     link_up=int(self.telescope.connected),
+                     clients=self.clients, subscribers=len(self.subscribers))
+        return state
+
+    def publish(self):
+        self.telescope.publish()
+
+    def start_motion(self, f, *args, **kwargs):
+        """
+        Claim the mount for the undecorated motion method f, before anything
+        else gets a chance to, and start it running
+        Raises RPCError BUSY if another motion is running
+        Returns its task
+        """
+        if self.motion is not None:
+            raise RPCError(Errors.BUSY, 'Already {}'.format(self.motion_name))
+        self.motion = asyncio.ensure_future(f(self, *args, **kwargs))
+        self.motion_name = f.__name__
+        self.motion.add_done_callback(self._motion_done)
+        self.publish()
+        return self.motion
+
+    def _motion_done(self, future):
+        self.motion = self.motion_name = None
+        if not future.cancelled():
+            # Nobody may be left waiting to hear why it failed
+            future.exception()
+        self.publish()
+
+    async def _fan_out(self):
+        """
+        Send each state change to every subscriber, encoded once
+        """
+        async for _ in self.telescope.updates():
+            if 'az' in self.telescope.state and self.motion_name == 'track':
+                self.az, self.alt = self.telescope.state['az'], self.telescope.state['alt']
+            line = _encode({'jsonrpc': '2.0', 'method': 'telemetry', 'params': self.status()})
+            for writer in list(self.subscribers):
+                if writer.transport.get_write_buffer_size() < TELEMETRY_BACKLOG:
+                    writer.write(line)
+
+    async def _keep_alive(self):
+        """
+        Ask for the encoders while nothing else is sent, to notice the link
+        dropping, and reconnect when it has
+        """
+        delay = solar.RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(solar.HEARTBEAT_INTERVAL if delay == solar.RECONNECT_DELAY else delay)
+            try:
+                if not self.telescope.connected:
+                    logging.info('Reconnecting to motors')
+                    # The firmware speaks the version it did before it dropped
+                    await self.telescope.connect(*self.address, version=self.telescope.version)
+                if self.motion is None:
+                    for axis in self.telescope.axes.values():
+                        axis.invalidate()
+                    await self.telescope.positions()
+                delay = solar.RECONNECT_DELAY
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.warning('Motors unreachable: {}'.format(e))
+                delay = min(delay * 2, solar.MAX_RECONNECT_DELAY)
+
+    async def _serve(self, reader, writer):
+        self.clients += 1
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(self._answer(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            self.clients -= 1
+            self.subscribers.discard(writer)
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _answer(self, line, writer):
+        request_id = None
+        try:
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError:
+                raise RPCError(Errors.PARSE_ERROR, 'Not JSON')
+            if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+                raise RPCError(Errors.INVALID_REQUEST, 'Not a JSON-RPC request')
+            request_id = request.get('id')
+            method = request['method']
+            if method not in self.METHODS:
+                raise RPCError(Errors.METHOD_NOT_FOUND, 'No method {}'.format(method))
+            params = request.get('params', {})
+            if not isinstance(params, (list, dict)):
+                raise RPCError(Errors.INVALID_PARAMS, 'params must be a list or an object')
+            args, kwargs = (params, {}) if isinstance(params, list) else ([], params)
+            try:
+                result = getattr(self, 'rpc_' + method)(writer, *args, **kwargs)
+            except TypeError as e:
+                raise RPCError(Errors.INVALID_PARAMS, str(e))
+            if asyncio.iscoroutine(result):
+                result = await result
+            reply = {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+        except RPCError as e:
+            reply = {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': e.code, 'message': str(e)}}
+        except solar.ConnectionLost as e:
+            reply = {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': Errors.LINK_DOWN, 'message': str(e)}}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Whatever went wrong, the client still gets an answer
+            logging.exception('Error answering {!r}'.format(line))
+            reply = {'jsonrpc': '2.0', 'id': request_id,
+                     'error': {'code': Errors.INTERNAL_ERROR, 'message': '{}: {}'.format(type(e).__name__, e)}}
+        if request_id is not None:
+            writer.write(_encode(reply))
+
+    def rpc_status(self, writer):
+        return self.status()
+
+    def rpc_subscribe(self, writer):
+        self.subscribers.add(writer)
+        return self.status()
+
+    def rpc_unsubscribe(self, writer):
+        self.subscribers.discard(writer)
+
+    def rpc_set_position(self, writer, az, alt):
+        """
+        Tell the daemon where the mount points, in arcsec
+        """
+        if self.motion is not None:
+            raise RPCError(Errors.BUSY, 'Already {}'.format(self.motion_name))
+        self.az, self.alt = _number('az', az), _number('alt', alt)
+        self.publish()
+
+    def rpc_set_site(self, writer, longitude, latitude):
+        self.longitude, self.latitude = _number('longitude', longitude), _number('latitude', latitude)
+        self.publish()
+
+    def rpc_tune(self, writer, azimuth, altitude):
+        """
+        Offset tracking from the Sun, in arcsec
+        """
+        self.telescope.tune = (_number('azimuth', azimuth), _number('altitude', altitude))
+        self.publish()
+
+    def rpc_stop(self, writer):
+        """
+        Stop the slew or track running, if any
+        """
+        if self.motion is None:
+            return False
+        self.motion.cancel()
+        return True
+
+    async def rpc_reset_zero(self, writer):
+        if self.motion is not None:
+            raise RPCError(Errors.BUSY, 'Already {}'.format(self.motion_name))
+        self.telescope.submit('R')
+        for axis in self.telescope.axes.values():
+            axis.invalidate()
+        await self.telescope.positions()
+
+    def rpc_slew(self, writer, polar, dec):
+        return self.slew(_number('polar', polar), _number('dec', dec))
+
+    def rpc_slew_altaz(self, writer, az, alt):
+        return self.slew_altaz(_number('az', az), _number('alt', alt))
+
+    def rpc_slew_to_sun(self, writer):
+        return self.slew_to_sun()
+
+    def rpc_track(self, writer):
+        """
+        Start following the Sun, answered straight away. stop ends it
+        """
+        # Claimed here rather than when the task first runs, so a second
+        # track sent straight after is refused
+        self.start_motion(Daemon.track.__wrapped__)
+        return True
+
+    async def _turn(self, polar, dec):
+        """
+        Turn the polar and declination axes, keeping az and alt up to date
+        from the encoders even if stopped part way
+        """
+        start = await self.telescope.positions()
+        start_ha, start_dec = transform.altaz_to_hadec(self.az, self.alt, self.latitude)
+        try:
+            await self.telescope.slew(polar, dec)
+        finally:
+            done = [(axis.encoder - count) * self.telescope.mount.arcsec_per_enc for axis, count in
+                    zip((self.telescope.axes[solar.Devices.body], self.telescope.axes[solar.Devices.mirror]), start)]
+            az, alt = transform.hadec_to_altaz(start_ha + done[0], start_dec + done[1], self.latitude)
+            self.az, self.alt = float(az), float(alt)
+        return done
+
+    @motion
+    async def slew(self, polar, dec):
+        """
+        Turn the polar and declination axes, in arcsec
+        Returns the arcsec each turned
+        """
+        return await self._turn(polar, dec)
+
+    async def _slew_altaz(self, az, alt):
+        polar, dec = transform.axis_offsets(az, alt, self.az, self.alt, self.latitude)
+        await self._turn(float(polar), float(dec))
+        self.az, self.alt = az, alt
+
+    @motion
+    async def slew_altaz(self, az, alt):
+        """
+        Point the mount at az and alt, in arcsec
+        """
+        await self._slew_altaz(az, alt)
+
+    @motion
+    async def slew_to_sun(self):
+        """
+        Point the mount at the Sun, correcting for it moving during the slew
+        Returns the moves taken
+        """
+        moves = 0
+        s_az, s_alt = self.ephemeris.position(self.longitude, self.latitude)
+        tolerance = SLEW_TOLERANCE_TICKS * self.telescope.mount.arcsec_per_enc
+        while max(abs(s_az - self.az), abs(s_alt - self.alt)) > tolerance and moves < MAX_SLEW_MOVES:
+            await self._slew_altaz(float(s_az), float(s_alt))
+            moves += 1
+            s_az, s_alt = self.ephemeris.position(self.longitude, self.latitude)
+        return moves
+
+    @motion
+    async def track(self):
+        await self.telescope.track(self.longitude, self.latitude, self.az, self.alt)
+
+
+def _encode(message):
+    return (json.dumps(message) + '\n').encode('utf-8')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the telescope to local clients')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Unix socket to listen on')
+    parser.add_argument('--ip', default=solar.arduino['ip'])
+    parser.add_argument('--port', type=int, default=solar.arduino['port'])
+    parser.add_argument('--protocol', type=int, help='protocol version, asked of the firmware by default')
+    parser.add_argument('--longitude', type=float, default=0.)
+    parser.add_argument('--latitude', type=float, default=0.)
+    parser.add_argument('--simulate', action='store_true', help='drive a simulator instead of the arduino')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    address = (args.ip, args.port)
+    sim = None
+    if args.simulate:
+        sim = simulator.Simulator()
+        sim.start()
+        address = sim.address
+
+    loop = asyncio.get_event_loop()
+    daemon = Daemon(address, args.longitude, args.latitude, args.protocol)
+    loop.run_until_complete(daemon.start(args.socket))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(daemon.close())
+        if sim is not None:
+            sim.stop()
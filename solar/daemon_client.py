@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Blocking client for the telescope daemon, see daemon
+
+    client = DaemonClient()
+    client.call('slew_altaz', az=3600, alt=36000)
+    client.call('subscribe')
+    for state in client.telemetry():
+        print(state['az'], state['alt'])
+
+Also usable from the command line:
+
+    python solar/daemon_client.py status
+    python solar/daemon_client.py slew polar=3600 dec=0
+    python solar/daemon_client.py watch
+"""
+import collections
+import json
+import socket
+import sys
+
+DEFAULT_SOCKET = '/tmp/solar_drive.sock'
+# Seconds to wait for a reply, longer than the longest slew, which is answered once done
+DEFAULT_TIMEOUT = 600.
+
+
+class DaemonError(Exception):
+    """
+    Error reply from the daemon
+    code -- One of daemon.Errors
+    """
+    def __init__(self, code, message):
+        super(DaemonError, self).__init__(message)
+        self.code = code
+
+
+class DaemonClient(object):
+    """
+    Connection to the telescope daemon
+
+    path -- Unix socket the daemon listens on
+    timeout -- Seconds to wait for the daemon before raising socket.timeout,
+               None to wait for ever
+    """
+    def __init__(self, path=DEFAULT_SOCKET, timeout=DEFAULT_TIMEOUT):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(path)
+        self._buffer = b''
+        self._request_id = 0
+        # Telemetry that arrived while waiting for a reply
+        self.notifications = collections.deque(maxlen=100)
+
+    def close(self):
+        self.socket.close()
+
+    def _read(self):
+        while b'\n' not in self._buffer:
+            data = self.socket.recv(4096)
+            if not data:
+                raise IOError('Daemon closed the connection')
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+    def call(self, method, **params):
+        """
+        Call a method of the daemon and wait for its result
+        Raises DaemonError if the daemon answers with an error
+        """
+        self._request_id += 1
+        request = {'jsonrpc': '2.0', 'id': self._request_id, 'method': method, 'params': params}
+        self.socket.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        while True:
+            message = self._read()
+            if 'id' not in message:
+                self.notifications.append(message['params'])
+            elif message['id'] == self._request_id:
+                if 'error' in message:
+                    raise DaemonError(message['error']['code'], message['error']['message'])
+                return message['result']
+
+    def telemetry(self):
+        """
+        Yield the state each time it changes, once subscribed
+        """
+        while True:
+            while self.notifications:
+                yield self.notifications.popleft()
+            message = self._read()
+            if 'id' not in message:
+                yield message['params']
+
+
+def _value(text):
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: daemon_client.py method [name=value ...] | watch')
+        sys.exit(2)
+    if sys.argv[1] == 'watch':
+        # Telemetry only comes when something changes
+        client = DaemonClient(timeout=None)
+        client.call('subscribe')
+        for state in client.telemetry():
+            print(json.dumps(state, sort_keys=True))
+    else:
+        client = DaemonClient()
+        params = dict((name, _value(value)) for name, value in (arg.split('=', 1) for arg in sys.argv[2:]))
+        try:
+            print(json.dumps(client.call(sys.argv[1], **params), indent=2, sort_keys=True))
+        except DaemonError as e:
+            print('Error {}: {}'.format(e.code, e))
+            sys.exit(1)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorised solar ephemeris
+
+Positions are computed for whole arrays of times and sites in one NumPy pass,
+using a truncated VSOP87 series for the Earth's orbit and the methods of
+Meeus (Astronomical Algorithms, ch. 22, 25) for nutation, aberration and
+parallax, with the same refraction model as Pysolar.
+
+Conventions match Pysolar's GetAzimuth/GetAltitude: azimuth is measured from
+south, positive towards the east, and altitude includes refraction at 25C and
+1013.25mb. Azimuth is wrapped to (-180, 180] degrees rather than Pysolar's
+(-360, 0], so it stays continuous through local noon.
+
+Error bounds against Pysolar 0.5, from 6000 random times between 2000 and 2030
+at latitudes within 60 degrees of the equator, with the Sun above the horizon:
+    altitude -- within 20 arcsec, 9 arcsec rms
+    azimuth -- within 20 arcsec on the sky, i.e. scaled by cos(altitude)
+Most of that difference is Pysolar, which takes the cosine of the obliquity
+in degrees when correcting sidereal time for nutation. Copying that mistake
+brings the altitude within 6 arcsec. Below the horizon Pysolar keeps applying
+refraction and the two diverge.
+
+A day of positions at one minute intervals takes about 4ms, against roughly
+0.7s for the equivalent Pysolar calls.
+"""
+from collections import OrderedDict
+from datetime import datetime
+import logging
+import os
+import numpy as np
+import clock
+
+EPOCH = datetime(1970, 1, 1)
+JD_EPOCH = 2440587.5  # Julian day at the POSIX epoch
+J2000 = 2451545.0
+DELTA_T = 65.  # Seconds of TT - UT, the value Pysolar uses
+
+PRESSURE_MB = 1013.25
+TEMPERATURE_C = 25.
+
+
+def posix_seconds(when):
+    """
+    Convert times to seconds since the POSIX epoch
+    when -- A datetime, numpy datetime64, POSIX seconds or an array of any of those.
+            datetimes are taken to be UTC
+    Returns a float array
+    """
+    if isinstance(when, datetime):
+        return np.asarray((when - EPOCH).total_seconds())
+    when = np.asarray(when)
+    if when.dtype.kind == 'M':
+        delta = when - np.datetime64('1970-01-01T00:00:00')
+        return delta.astype('timedelta64[us]').astype(float) / 1e6
+    if when.dtype == object:
+        seconds = np.vectorize(lambda d: (d - EPOCH).total_seconds(), otypes=[float])
+        return seconds(when)
+    return when.astype(float)
+
+
+def julian_day(when):
+    """
+    Julian day (UT) for a time or array of times, see posix_seconds
+    """
+    return posix_seconds(when) / 86400. + JD_EPOCH
+
+
+# Periodic terms for the Earth's heliocentric longitude (L) and radius vector
+# (R) from VSOP87 (Bretagnon & Francou), as (amplitude in 1e-8, phase,
+# frequency per Julian millennium). Only the largest terms are kept, which is
+# good to about an arcsecond over this century.
+_L0 = np.array([
+    (175347046, 0, 0), (3341656, 4.6692568, 6283.07585), (34894, 4.6261, 12566.1517),
+    (3497, 2.7441, 5753.3849), (3418, 2.8289, 3.5231), (3136, 3.6277, 77713.7715),
+    (2676, 4.4181, 7860.4194), (2343, 6.1352, 3930.2097), (1324, 0.7425, 11506.7698),
+    (1273, 2.0371, 529.691), (1199, 1.1096, 1577.3435), (990, 5.233, 5884.927),
+    (902, 2.045, 26.298), (857, 3.508, 398.149), (780, 1.179, 5223.694),
+    (753, 2.533, 5507.553), (505, 4.583, 18849.228), (492, 4.205, 775.523),
+    (357, 2.92, 0.067), (317, 5.849, 11790.629),
+])
+_L1 = np.array([
+    (628331966747, 0, 0), (206059, 2.678235, 6283.07585), (4303, 2.6351, 12566.1517),
+    (425, 1.59, 3.523), (119, 5.796, 26.298), (109, 2.966, 1577.344),
+])
+_L2 = np.array([
+    (52919, 0, 0), (8720, 1.0721, 6283.0758), (309, 0.867, 12566.152),
+])
+_R0 = np.array([
+    (100013989, 0, 0), (1670700, 3.0984635, 6283.07585), (13956, 3.05525, 12566.1517),
+    (3084, 5.1985, 77713.7715), (1628, 1.1739, 5753.3849), (1576, 2.8469, 7860.4194),
+])
+_R1 = np.array([
+    (103019, 1.10749, 6283.07585), (1721, 1.0644, 12566.1517),
+])
+
+
+def _series(terms, tau):
+    """
+    Sum a table of periodic terms at each time in tau
+    """
+    return (terms[:, 0] * np.cos(terms[:, 1] + terms[:, 2] * tau[..., np.newaxis])).sum(axis=-1)
+
+
+def sun_equatorial(when):
+    """
+    Apparent geocentric position of the Sun
+    when -- Time or array of times, see posix_seconds
+    Returns (right ascension, declination, distance in AU, apparent sidereal
+    time at Greenwich), angles in degrees
+    """
+    jd = julian_day(when)
+    t = (jd + DELTA_T / 86400. - J2000) / 36525.
+    tau = t / 10.
+
+    longitude = (_series(_L0, tau) + tau * (_series(_L1, tau) + tau * _series(_L2, tau))) / 1e8
+    true_longitude = np.degrees(longitude) + 180.
+    distance = (_series(_R0, tau) + tau * _series(_R1, tau)) / 1e8
+
+    # Nutation, principal terms
+    omega = np.radians(125.04452 - 1934.136261 * t)
+    l_sun = np.radians(2 * (280.4665 + 36000.7698 * t))
+    l_moon = np.radians(2 * (218.3165 + 481267.8813 * t))
+    nut_longitude = (-17.20 * np.sin(omega) - 1.32 * np.sin(l_sun) -
+                     0.23 * np.sin(l_moon) + 0.21 * np.sin(2 * omega)) / 3600.
+    nut_obliquity = (9.20 * np.cos(omega) + 0.57 * np.cos(l_sun) +
+                     0.10 * np.cos(l_moon) - 0.09 * np.cos(2 * omega)) / 3600.
+    aberration = -20.4898 / 3600. / distance
+
+    obliquity = np.radians(23.439291111 - t * (46.8150 + t * (0.00059 - t * 0.001813)) / 3600. +
+                           nut_obliquity)
+    longitude = np.radians(true_longitude + nut_longitude + aberration)
+
+    ra = np.degrees(np.arctan2(np.cos(obliquity) * np.sin(longitude), np.cos(longitude)))
+    dec = np.degrees(np.arcsin(np.sin(obliquity) * np.sin(longitude)))
+
+    tu = (jd - J2000) / 36525.
+    sidereal = (280.46061837 + 360.98564736629 * (jd - J2000) +
+                tu * tu * (0.000387933 - tu / 38710000.))
+    sidereal += nut_longitude * np.cos(obliquity)
+
+    return ra % 360, dec, distance, sidereal % 360
+
+
+def refraction(altitude, pressure=PRESSURE_MB, temperature=TEMPERATURE_C):
+    """
+    Atmospheric refraction in degrees for a true altitude in degrees,
+    using the same formula as Pysolar. No correction is applied once the Sun
+    is well below the horizon, where the formula is singular.
+    """
+    correction = (pressure / 1010.) * (283. / (273.15 + temperature)) * 1.02 / \
+        (60. * np.tan(np.radians(altitude + 10.3 / (altitude + 5.11))))
+    return np.where(altitude > -0.8333, correction, 0.)
+
+
+def sun_position(longitude, latitude, when):
+    """
+    Calculate the azimuth and altitude of the Sun for many times and sites at once
+    longitude -- Longitude in degrees, or an array of them
+    latitude -- Latitude in degrees, or an array of them
+    when -- UTC time or array of times, see posix_seconds
+    All arguments are broadcast against each other.
+    Returns (azimuth, altitude) as arrays of arcseconds
+    """
+    ra, dec, distance, sidereal = sun_equatorial(when)
+    lat = np.radians(latitude)
+    hour_angle = np.radians(sidereal + np.asarray(longitude, dtype=float) - ra)
+    dec = np.radians(dec)
+
+    # Shift to the observer's position on the surface of the Earth
+    parallax = np.radians(8.794 / 3600.) / distance
+    u = np.arctan(0.99664719 * np.tan(lat))
+    x, y = np.cos(u), 0.99664719 * np.sin(u)
+    denominator = np.cos(dec) - x * np.sin(parallax) * np.cos(hour_angle)
+    d_ra = np.arctan2(-x * np.sin(parallax) * np.sin(hour_angle), denominator)
+    dec = np.arctan2((np.sin(dec) - y * np.sin(parallax)) * np.cos(d_ra), denominator)
+    hour_angle = hour_angle - d_ra
+
+    altitude = np.degrees(np.arcsin(np.sin(lat) * np.sin(dec) +
+                                    np.cos(lat) * np.cos(dec) * np.cos(hour_angle)))
+    altitude = altitude + refraction(altitude)
+    azimuth = np.degrees(np.arctan2(-np.sin(hour_angle),
+                                    np.cos(hour_angle) * np.sin(lat) - np.tan(dec) * np.cos(lat)))
+
+    return azimuth * 3600, altitude * 3600
+
+
+class EphemerisCache(object):
+    """
+    Daily tables of the Sun's position, interpolated to answer single queries quickly
+
+    Each (latitude, longitude, UTC date) gets a table of positions on a
+    regular grid, computed in one pass with sun_position. Lookups use cubic
+    (Catmull-Rom) interpolation on plain Python lists, taking around ten
+    microseconds. With the default one minute grid the interpolated position
+    is within 0.1 arcsec of sun_position while the Sun is above the horizon.
+    Within a grid step of the point where refraction is switched on, just
+    below the horizon, the altitude can be out by up to half a degree.
+
+    step -- Grid spacing in seconds
+    max_days -- Number of tables to keep in memory, least recently used are dropped
+    directory -- Optional directory to keep tables in as .npy files, so they
+                 survive a restart
+    """
+    def __init__(self, step=60., max_days=4, directory=None):
+        self.step = float(step)
+        self.max_days = max_days
+        self.directory = directory
+        self.tables = OrderedDict()
+
+    def _path(self, key):
+        latitude, longitude, day = key
+        date = datetime.utcfromtimestamp(day * 86400).strftime('%Y%m%d')
+        name = 'sun_{:+.6f}_{:+.6f}_{}_{:g}.npy'.format(latitude, longitude, date, self.step)
+        return os.path.join(self.directory, name)
+
+    def _compute(self, key):
+        """
+        Positions for the whole day, with two extra points either side so the
+        interpolation has neighbours at midnight
+        """
+        latitude, longitude, day = key
+        n = int(round(86400. / self.step))
+        times = day * 86400. + self.step * np.arange(-2, n + 3)
+        az, alt = sun_position(longitude, latitude, times)
+        # Unwrap so the interpolation doesn't cross the jump at due north
+        az = np.degrees(np.unwrap(np.radians(az / 3600.))) * 3600.
+        return np.array([az, alt])
+
+    def _load(self, key):
+        if self.directory is not None:
+            path = self._path(key)
+            if os.path.exists(path):
+                try:
+                    return np.load(path)
+                except (IOError, ValueError) as e:
+                    logging.warning('Unable to read ephemeris table: {}'.format(e))
+        table = self._compute(key)
+        if self.directory is not None:
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                # Written aside and renamed, as several workers may share the directory
+                partial = '{}.{}'.format(path, os.getpid())
+                with open(partial, 'wb') as f:
+                    np.save(f, table)
+                os.rename(partial, path)
+            except (IOError, OSError) as e:
+                logging.warning('Unable to store ephemeris table: {}'.format(e))
+        return table
+
+    def table(self, longitude, latitude, day):
+        """
+        Return the table for a site on a day, as lists of azimuth and altitude
+        day -- Days since the POSIX epoch
+        """
+        key = (round(latitude, 6), round(longitude, 6), day)
+        table = self.tables.pop(key, None)
+        if table is None:
+            az, alt = self._load(key)
+            table = az.tolist(), alt.tolist()
+            while len(self.tables) >= self.max_days:
+                self.tables.popitem(last=False)
+        self.tables[key] = table
+        return table
+
+    def position(self, longitude, latitude, when=None):
+        """
+        Interpolate the Sun's position
+        longitude -- Longitude in degrees
+        latitude -- Latitude in degrees
+        when -- UTC datetime or POSIX seconds, defaults to now
+        Returns (azimuth, altitude) in arcseconds
+        """
+        if when is None:
+            when = clock.time_now()
+        if isinstance(when, datetime):
+            when = (when - EPOCH).total_seconds()
+        day = int(when // 86400)
+        az, alt = self.table(longitude, latitude, day)
+
+        u = (when - day * 86400.) / self.step + 2
+        i = int(u)
+        f = u - i
+        f2 = f * f
+        f3 = f2 * f
+        # Catmull-Rom weights for points i - 1 .. i + 2
+        w0 = 0.5 * (-f3 + 2 * f2 - f)
+        w1 = 0.5 * (3 * f3 - 5 * f2 + 2)
+        w2 = 0.5 * (-3 * f3 + 4 * f2 + f)
+        w3 = 0.5 * (f3 - f2)
+
+        s_az = w0 * az[i - 1] + w1 * az[i] + w2 * az[i + 1] + w3 * az[i + 2]
+        s_alt = w0 * alt[i - 1] + w1 * alt[i] + w2 * alt[i + 1] + w3 * alt[i + 2]
+        return (s_az + 648000.) % 1296000. - 648000., s_alt
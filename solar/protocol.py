@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Binary framing of the arduino protocol, version 2
+
+The legacy protocol, version 1, sends each command and gets each reply as a
+line of text, see solar_drive.pde. Version 2 sends the same commands in
+length prefixed frames carrying a request ID, so every reply can be checked
+against the command it answers, and adds Q, a query of both encoders and the
+home switches answered in one reply.
+
+Every frame, in both directions, is
+
+    <0x80 | length> <request id> <command> <payload>
+
+where length counts the bytes after the first, and the command is the same
+letter as in the text protocol. The top bit of the first byte tells the
+firmware a frame from a text command. Payloads are big-endian:
+
+    T  motor (B/M), steps (int16)       -> encoder (int32)
+    E  motor                            -> encoder (int32)
+    D  body steps, mirror steps (int16) -> body, mirror encoders (int32)
+    Q                                   -> body, mirror encoders (int32), status
+    R                                   -> no reply
+
+Steps are signed, negative turning anticlockwise. The status byte holds the
+body's home switch input in bit 0 and the mirror's in bit 1. A
+command the firmware can't carry out is answered with a ! frame holding one
+of Errors.
+
+The client asks which version the firmware speaks with the text command V.
+Version 2 firmware answers with the line "2", legacy firmware doesn't answer.
+
+solar.Telescope and the simulator both work in the text commands and
+replies, turning them into frames with the functions here.
+"""
+import struct
+
+VERSION = 2
+FRAME_FLAG = 0x80
+MAX_LENGTH = 0x7f
+
+version_query = 'V'
+query = 'Q'
+error = '!'
+
+
+class Errors:
+    """
+    Codes in the payload of a ! reply, or after the ! of a legacy error line
+    """
+    UNKNOWN_COMMAND, BAD_MOTOR, BAD_LENGTH, BAD_DIRECTION = range(1, 5)
+
+
+REQUEST_FORMATS = {
+    'T': '>ch',
+    'E': '>c',
+    'D': '>hh',
+    'Q': '>',
+    'R': '>',
+}
+
+REPLY_FORMATS = {
+    'T': '>i',
+    'E': '>i',
+    'D': '>ii',
+    'Q': '>iiB',
+    '!': '>B',
+}
+
+
+def _signed(direction, steps):
+    steps = min(int(steps), 32767)
+    return -steps if direction == 'A' else steps
+
+
+def _frame(request_id, op, fmt, *values):
+    body = bytearray([request_id & 0xff]) + op.encode('ascii') + bytearray(struct.pack(fmt, *values))
+    if len(body) > MAX_LENGTH:
+        raise ValueError('Frame too long: {} bytes'.format(len(body)))
+    return bytearray([FRAME_FLAG | len(body)]) + body
+
+
+def frame_length(data):
+    """
+    data -- Bytes received so far, starting at the start of a frame
+    Returns the length of the whole frame, or None if data doesn't start
+    with a frame header
+    """
+    if not data or not data[0] & FRAME_FLAG:
+        return None
+    return 1 + (data[0] & MAX_LENGTH)
+
+
+def split_frame(data):
+    """
+    Take the first complete frame off the front of data
+    data -- bytearray received so far
+    Returns (frame, rest), frame being None if it isn't all there yet
+    """
+    length = frame_length(data)
+    if length is None:
+        raise ValueError('Not a frame: {!r}'.format(bytes(data[:8])))
+    if len(data) < length:
+        return None, data
+    return data[:length], data[length:]
+
+
+def encode_request(request_id, cmd):
+    """
+    Frame a text command
+    request_id -- Number to tag the command with, only the low byte is sent
+    cmd -- Command as sent in the text protocol, e.g. 'TBC800' or 'DC80,A12'
+    Returns a bytearray
+    """
+    op, args = cmd[0], cmd[1:]
+    if op == 'T':
+        return _frame(request_id, op, REQUEST_FORMATS[op], args[0].encode('ascii'), _signed(args[1], args[2:]))
+    elif op == 'E':
+        return _frame(request_id, op, REQUEST_FORMATS[op], args[0].encode('ascii'))
+    elif op == 'D':
+        body, mirror = args.split(',')
+        return _frame(request_id, op, REQUEST_FORMATS[op],
+                      _signed(body[0], body[1:]), _signed(mirror[0], mirror[1:]))
+    elif op in REQUEST_FORMATS:
+        return _frame(request_id, op, REQUEST_FORMATS[op])
+    raise ValueError('No version 2 frame for {}'.format(cmd))
+
+
+def decode_request(frame):
+    """
+    Unpack a request frame, the opposite of encode_request
+    Returns (request id, text command), the command being None if it isn't understood
+    """
+    if len(frame) < 3:
+        return frame[1] if len(frame) > 1 else 0, None
+    request_id, op = frame[1], chr(frame[2])
+    payload = bytes(frame[3:])
+    fmt = REQUEST_FORMATS.get(op)
+    if fmt is None or struct.calcsize(fmt) != len(payload):
+        return request_id, None
+    values = struct.unpack(fmt, payload)
+    if op == 'T':
+        motor, steps = values
+        return request_id, 'T{}{}{}'.format(motor.decode('latin-1'), 'A' if steps < 0 else 'C', abs(steps))
+    elif op == 'E':
+        return request_id, 'E' + values[0].decode('latin-1')
+    elif op == 'D':
+        return request_id, 'D' + ','.join('{}{}'.format('A' if steps < 0 else 'C', abs(steps))
+                                          for steps in values)
+    return request_id, op
+
+
+def encode_reply(request_id, op, reply):
+    """
+    Frame a text reply
+    op -- Command being answered, or error
+    reply -- Reply as it would be in the text protocol, comma separated
+             integers, e.g. '-75,195'
+    Returns a bytearray
+    """
+    return _frame(request_id, op, REPLY_FORMATS[op], *[int(value) for value in reply.split(',')])
+
+
+def decode_reply(frame):
+    """
+    Unpack a reply frame, the opposite of encode_reply
+    Returns (request id, command, text reply)
+    Raises ValueError if the frame isn't a reply
+    """
+    if len(frame) < 3:
+        raise ValueError('Reply frame too short: {!r}'.format(bytes(frame)))
+    request_id, op = frame[1], chr(frame[2])
+    fmt = REPLY_FORMATS.get(op)
+    if fmt is None or struct.calcsize(fmt) != len(frame) - 3:
+        raise ValueError('Not a reply frame: {!r}'.format(bytes(frame)))
+    values = struct.unpack(fmt, bytes(frame[3:]))
+    return request_id, op, ','.join(str(value) for value in values)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Binary recorder for telescope sessions
+
+Every turn command, encoder reply and tracking error is appended as a fixed
+size record to a memory-mapped .npy file. Each session gets its own
+directory of files, which load straight back as NumPy structured arrays:
+
+    records = recorder.load_session('sessions/20140601T101500')
+    turns = records[records['kind'] == recorder.Kinds.TURN]
+
+NumPy is only imported once a session is recorded or loaded, as every
+turn goes through the module and most of the time nothing is recorded.
+"""
+import glob
+import logging
+import os
+import clock
+
+# Fields of each record, see record_dtype
+RECORD_FIELDS = [
+    ('monotonic', 'f8'),  # Seconds on the monotonic clock
+    ('utc', 'f8'),  # POSIX seconds
+    ('kind', 'u1'),  # See Kinds
+    ('motor', 'S1'),
+    ('direction', 'S1'),
+    ('steps', 'i4'),  # Motor steps commanded
+    ('encoder', 'i4'),  # Encoder count reported
+    ('error', 'f4'),  # Encoder ticks still to go
+]
+
+DEFAULT_CAPACITY = 1 << 20  # Records per file, about 30MB
+
+
+class Kinds:
+    """
+    What a record describes. Zero marks unused space at the end of a file
+    """
+    TURN, ENCODER, ERROR = range(1, 4)
+
+
+def record_dtype():
+    """
+    Returns the NumPy dtype of a record
+    """
+    import numpy as np
+    return np.dtype(RECORD_FIELDS)
+
+
+class NullRecorder(object):
+    """
+    Recorder used when no session is running, throws records away
+    """
+    def record(self, kind, motor='', direction='', steps=0, encoder=0, error=0.):
+        pass
+
+    def close(self):
+        pass
+
+
+class Recorder(object):
+    """
+    Appends records to memory-mapped files in a session directory, starting a
+    new file each time one fills up
+
+    directory -- Directory the session directory is created in
+    capacity -- Number of records in each file
+    """
+    def __init__(self, directory, capacity=DEFAULT_CAPACITY):
+        name = clock.utcnow().strftime('%Y%m%dT%H%M%S')
+        self.path = os.path.join(directory, name)
+        n = 0
+        while os.path.exists(self.path):
+            n += 1
+            self.path = os.path.join(directory, '{}-{}'.format(name, n))
+        os.makedirs(self.path)
+        self.capacity = capacity
+        self.part = 0
+        self.count = 0
+        self.records = None
+        self._open()
+
+    def _open(self):
+        import numpy as np
+        filename = os.path.join(self.path, 'part-{:04d}.npy'.format(self.part))
+        self.records = np.lib.format.open_memmap(filename, mode='w+', dtype=record_dtype(),
+                                                 shape=(self.capacity,))
+        self.count = 0
+
+    def record(self, kind, motor='', direction='', steps=0, encoder=0, error=0.):
+        """
+        Append a record, see RECORD_FIELDS
+        """
+        if self.count == self.capacity:
+            self.records.flush()
+            self.part += 1
+            self._open()
+        self.records[self.count] = (clock.monotonic(), clock.time_now(), kind, motor, direction,
+                                    steps, encoder, error)
+        self.count += 1
+
+    def close(self):
+        if self.records is not None:
+            self.records.flush()
+            self.records = None
+
+
+def load_session(path):
+    """
+    Read a session back
+    path -- Session directory
+    Returns the records as a structured array, memory-mapped if the session
+    fits in one file
+    """
+    import numpy as np
+    parts = []
+    for filename in sorted(glob.glob(os.path.join(path, 'part-*.npy'))):
+        records = np.load(filename, mmap_mode='r')
+        used = np.flatnonzero(records['kind'])
+        parts.append(records[:used[-1] + 1 if len(used) else 0])
+    if len(parts) == 1:
+        return parts[0]
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=record_dtype())
+
+
+active = NullRecorder()
+
+
+def start_session(directory, capacity=DEFAULT_CAPACITY):
+    """
+    Close any running session and start recording a new one
+    Returns the new Recorder
+    """
+    global active
+    active.close()
+    active = Recorder(directory, capacity)
+    logging.info('Recording session to {}'.format(active.path))
+    return active
+
+
+def stop_session():
+    global active
+    active.close()
+    active = NullRecorder()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Sleep until deadlines on a monotonic clock, waking early for pipe messages
+"""
+import logging
+import clock
+
+
+class DeadlineScheduler(object):
+    """
+    Waits for deadlines given on the monotonic clock, see clock.monotonic
+
+    While waiting the connection is watched, so a message from
+    the other end wakes the caller straight away. How late each deadline
+    wakeup was is recorded, to keep an eye on timing jitter.
+
+    conn -- Optional multiprocessing Connection to watch
+    """
+    def __init__(self, conn=None):
+        self.conn = conn
+        self.wakeups = 0
+        self.late_total = 0.
+        self.late_max = 0.
+
+    def wait_until(self, deadline):
+        """
+        Sleep until the deadline passes or a message arrives
+        deadline -- Time on the monotonic clock
+        Returns True if woken by a message, False once the deadline has passed
+
+        A message already waiting is returned for even when the deadline has
+        passed, so a caller that keeps falling behind can still be stopped.
+        """
+        while True:
+            timeout = deadline - clock.monotonic()
+            if timeout <= 0:
+                if self.conn is not None and clock.wait(self.conn, 0):
+                    return True
+                break
+            if self.conn is None:
+                clock.sleep(timeout)
+            elif clock.wait(self.conn, timeout):
+                return True
+
+        late = clock.monotonic() - deadline
+        self.wakeups += 1
+        self.late_total += late
+        self.late_max = max(self.late_max, late)
+        return False
+
+    @property
+    def late_mean(self):
+        if self.wakeups == 0:
+            return 0.
+        return self.late_total / self.wakeups
+
+    def log_stats(self):
+        logging.info('Scheduler wakeups: {} mean late: {:.2f}ms max late: {:.2f}ms'.format(
+            self.wakeups, self.late_mean * 1000, self.late_max * 1000))
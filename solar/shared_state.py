@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Latest telescope position shared between the TelescopeManager and its worker
+process through shared memory, instead of a stream of pipe messages
+"""
+from multiprocessing.sharedctypes import RawArray, RawValue
+import errno
+import fcntl
+import os
+import clock
+
+
+class SharedState(object):
+    """
+    A block of doubles in shared memory guarded by a sequence lock
+
+    The worker is the only writer. It bumps the sequence number to odd before
+    changing any field and back to even afterwards, so a reader that sees the
+    same even number before and after copying the block knows the copy is
+    consistent. Readers never block the writer.
+
+    Must be created before the worker process is started so both sides map
+    the same memory.
+
+    notify -- Also write a byte to a pipe after every update, so a reader can
+              wait for changes on fileno() in its event loop instead of
+              polling. Writes never block, once the pipe is full a reader
+              already has changes waiting
+    """
+    FIELDS = ('az', 'alt', 'enc_body', 'enc_mirror', 'tracking', 'track_error', 'commands_per_minute',
+              'slew_moves', 'slew_saved', 'slew_progress', 'messages_coalesced', 'link_up', 'link_rtt',
+              'link_reconnects', 'updated', 'utc')
+
+    def __init__(self, notify=False):
+        self._seq = RawValue('L', 0)
+        self._data = RawArray('d', len(self.FIELDS))
+        self._index = dict((name, i) for i, name in enumerate(self.FIELDS))
+        self._notify = None
+        if notify:
+            self._notify = os.pipe()
+            for fd in self._notify:
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def write(self, **values):
+        """
+        Update fields in place, only to be called from the worker
+        values -- field=value pairs, see FIELDS. updated (monotonic) and utc
+                  (POSIX) timestamps are set automatically
+        """
+        self._seq.value += 1
+        for name, value in values.items():
+            self._data[self._index[name]] = value
+        self._data[self._index['updated']] = clock.monotonic()
+        self._data[self._index['utc']] = clock.time_now()
+        self._seq.value += 1
+        if self._notify is not None:
+            try:
+                os.write(self._notify[1], b'.')
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def fileno(self):
+        """
+        File descriptor that becomes readable when fields have been updated,
+        only with notify
+        """
+        return self._notify[0]
+
+    def drain(self):
+        """
+        Clear the notifications waiting on fileno()
+        Returns how many updates there were, at most the pipe's size
+        """
+        count = 0
+        while True:
+            try:
+                data = os.read(self._notify[0], 4096)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return count
+                raise
+            if not data:
+                return count
+            count += len(data)
+
+    def snapshot(self):
+        """
+        Returns a consistent copy of every field as a dict
+        """
+        while True:
+            seq = self._seq.value
+            if seq & 1:
+                continue
+            data = self._data[:]
+            if self._seq.value == seq:
+                return dict(zip(self.FIELDS, data))
+
+    def __getitem__(self, name):
+        return self.snapshot()[name]
+
+    @property
+    def sequence(self):
+        """
+        Number of updates made, changes whenever any field does
+        """
+        return self._seq.value // 2
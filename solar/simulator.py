@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+Stand in for the arduino, speaking the protocol implemented in
+arduino/solar_drive/solar_drive.pde over a local TCP port, in text or the
+version 2 frames, see protocol
+
+Run directly to start a standalone simulator:
+
+    python solar/simulator.py --port 8010 --slip 0.02
+
+or start one in-process and point the client at it:
+
+    sim = Simulator()
+    sim.start()
+    solar.connect(*sim.address)
+"""
+import argparse
+import bisect
+import logging
+import random
+import threading
+import socket
+import clock
+import protocol
+import solar
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+# Timings copied from solar_drive.pde
+STEP_DELAY_uS_FAST = 50
+STEP_DELAY_uS_TRACK = 1500
+ENCODER_PAUSE_mS = 100
+SYNC_PAUSE_mS = 100
+FAST_STEP_THRESHOLD = 100  # Turns of more steps than this use the fast delay
+DIRECTIONS = (solar.Directions.clockwise, solar.Directions.anti_clockwise)
+
+
+class Controller(object):
+    """
+    Model of the motors and encoders driven by the arduino
+
+    slip -- Fraction of motor steps lost before reaching the encoder
+    slip_jitter -- Random variation in slip from one turn to the next
+    time_scale -- Multiplier applied to every firmware delay, 0 to disable them
+    clock -- Clock to wait out the delays on, defaults to the active one
+    version -- Protocol version to speak, 1 to act like the legacy firmware
+    mount -- solar.Mount giving the steps per encoder tick, defaults to solar's constants
+    slip_profile -- Optional {motor: (times, slips)} of slip changing over time,
+                    as measured from a recording, see tune_gains. Each slip
+                    holds from its POSIX time until the next, in place of
+                    slip for that motor
+    """
+    def __init__(self, slip=0., slip_jitter=0., time_scale=1., clock=None, seed=None, version=protocol.VERSION,
+                 mount=None, slip_profile=None):
+        self.mount = mount or solar.Mount()
+        self.slip = slip
+        self.slip_profile = slip_profile or {}
+        self.slip_jitter = slip_jitter
+        self.time_scale = time_scale
+        self.clock = clock
+        self.version = version
+        self.home = {solar.Devices.body: False, solar.Devices.mirror: False}
+        self.busy_until = 0.
+        self.random = random.Random(seed)
+        self.position = {solar.Devices.body: 0., solar.Devices.mirror: 0.}
+        self.offset = {solar.Devices.body: 0, solar.Devices.mirror: 0}
+        self.commands = 0
+        self.steps = 0
+
+    def _clock(self):
+        return self.clock or clock.get_clock()
+
+    def _pause(self, seconds):
+        if self.time_scale > 0:
+            self._clock().sleep(seconds * self.time_scale)
+
+    def encoder(self, motor):
+        """
+        Return the encoder count for the motor
+        """
+        return int(self.position[motor] // self.mount.steps_per_enc) - self.offset[motor]
+
+    def reset(self):
+        for motor in self.position:
+            self.offset[motor] = int(self.position[motor] // self.mount.steps_per_enc)
+
+    def _slip(self, motor):
+        """
+        Slip of a motor at the current time
+        """
+        times, slips = self.slip_profile.get(motor, ((), ()))
+        if not len(times):
+            return self.slip
+        return slips[max(bisect.bisect_right(times, self._clock().time()) - 1, 0)]
+
+    def _step(self, motor, direction, steps):
+        slip = self._slip(motor) + self.random.uniform(-self.slip_jitter, self.slip_jitter)
+        moved = steps * (1. - min(max(slip, 0.), 1.))
+        if direction == solar.Directions.anti_clockwise:
+            moved = -moved
+        self.position[motor] += moved
+        self.steps += steps
+
+    def _run(self, steps, moves):
+        """
+        Wait out the firmware delays around stepping for steps, applying each
+        (motor, direction, steps) in moves
+        """
+        step_delay = STEP_DELAY_uS_TRACK
+        if steps > FAST_STEP_THRESHOLD:
+            step_delay = STEP_DELAY_uS_FAST
+
+        self._pause(SYNC_PAUSE_mS / 1000.)
+        self._pause(2 * steps * step_delay / 1e6)
+        for move in moves:
+            self._step(*move)
+        self._pause(ENCODER_PAUSE_mS / 1000.)
+        # Sync is held for another pause after the reply goes out
+        self.busy_until = self._clock().monotonic() + SYNC_PAUSE_mS / 1000. * self.time_scale
+
+    def turn(self, motor, direction, steps):
+        """
+        Step a motor, taking as long as the firmware would
+        Returns the encoder count once the turn is complete
+        """
+        self._run(steps, [(motor, direction, steps)])
+        return self.encoder(motor)
+
+    def turn_both(self, body_direction, body_steps, mirror_direction, mirror_steps):
+        """
+        Step both motors in the same loop, taking as long as the longer turn
+        Returns the (body, mirror) encoder counts once the turn is complete
+        """
+        self._run(max(body_steps, mirror_steps), [(solar.Devices.body, body_direction, body_steps),
+                                                  (solar.Devices.mirror, mirror_direction, mirror_steps)])
+        return self.encoder(solar.Devices.body), self.encoder(solar.Devices.mirror)
+
+    def handle(self, line):
+        """
+        Act on a single command line
+        Returns the reply line, or None if the command has no reply
+        """
+        line = line.strip()
+        if not line:
+            return None
+        self.commands += 1
+        self._clock().sleep(self.busy_until - self._clock().monotonic())
+        cmd, args = line[0], line[1:]
+
+        if cmd == solar.Commands.reset:
+            self.reset()
+        elif cmd == solar.Commands.encoder and args[:1] in self.position:
+            return str(self.encoder(args[0]))
+        elif cmd == solar.Commands.turn and args[:1] not in self.position:
+            return protocol.error + str(protocol.Errors.BAD_MOTOR)
+        elif cmd == solar.Commands.turn and args[1:2] not in DIRECTIONS:
+            return protocol.error + str(protocol.Errors.BAD_DIRECTION)
+        elif cmd == solar.Commands.turn:
+            try:
+                steps = int(args[2:] or 0)
+            except ValueError:
+                steps = 0
+            # Wrap like the firmware's 16 bit int, negative counts don't step
+            steps = max((steps + 32768) % 65536 - 32768, 0)
+            return str(self.turn(args[0], args[1], steps))
+        elif cmd == solar.Commands.dual_turn and ',' in args:
+            if any(move[:1] not in DIRECTIONS for move in args.split(',', 1)):
+                return protocol.error + str(protocol.Errors.BAD_DIRECTION)
+            moves = []
+            for move in args.split(',', 1):
+                try:
+                    steps = int(move[1:] or 0)
+                except ValueError:
+                    steps = 0
+                moves += [move[:1], max((steps + 32768) % 65536 - 32768, 0)]
+            return '{},{}'.format(*self.turn_both(*moves))
+        elif cmd == protocol.version_query and self.version >= 2:
+            return str(self.version)
+        else:
+            logging.warning('Simulator: Unknown Command: {}'.format(line))
+        return None
+
+    def handle_frame(self, frame):
+        """
+        Act on a single version 2 frame
+        Returns the reply frame, or None if the command has no reply
+        """
+        if self.version < 2:
+            logging.warning('Simulator: Frame sent to legacy firmware: {!r}'.format(bytes(frame)))
+            return None
+        request_id, cmd = protocol.decode_request(frame)
+        if cmd is None:
+            code = protocol.Errors.UNKNOWN_COMMAND
+            if len(frame) > 2 and chr(frame[2]) in protocol.REQUEST_FORMATS:
+                code = protocol.Errors.BAD_LENGTH
+            return protocol.encode_reply(request_id, protocol.error, str(code))
+        if cmd[0] in (solar.Commands.turn, solar.Commands.encoder) and cmd[1] not in self.position:
+            return protocol.encode_reply(request_id, protocol.error, str(protocol.Errors.BAD_MOTOR))
+        if cmd == protocol.query:
+            self.commands += 1
+            self._clock().sleep(self.busy_until - self._clock().monotonic())
+            status = self.home[solar.Devices.body] | self.home[solar.Devices.mirror] << 1
+            return protocol.encode_reply(request_id, cmd, '{},{},{}'.format(
+                self.encoder(solar.Devices.body), self.encoder(solar.Devices.mirror), status))
+        reply = self.handle(cmd)
+        if reply is None:
+            return None
+        return protocol.encode_reply(request_id, cmd[0], reply)
+
+
+class _Stream(object):
+    """
+    Splits what a client sends into text lines and version 2 frames for a
+    Controller, as the firmware does by the top bit of the first byte
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self._input = bytearray()
+
+    def feed(self, data):
+        """
+        Yields the bytes to send back for each command completed by data
+        """
+        self._input += bytearray(data)
+        while self._input:
+            if self._input[0] & protocol.FRAME_FLAG:
+                frame, self._input = protocol.split_frame(self._input)
+                if frame is None:
+                    return
+                reply = self.controller.handle_frame(frame)
+                if reply is not None:
+                    yield bytes(reply)
+            else:
+                if b'\n' not in self._input:
+                    return
+                line, self._input = self._input.split(b'\n', 1)
+                reply = self.controller.handle(line.decode('ascii'))
+                if reply is not None:
+                    yield (reply + '\r\n').encode('ascii')
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # Replies go out as soon as they are written, like the ethernet shield
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        stream = _Stream(self.server.controller)
+        self.server.connections.add(self.connection)
+        try:
+            for data in iter(lambda: self.connection.recv(4096), b''):
+                for reply in stream.feed(data):
+                    self.connection.sendall(reply)
+        except socket.error:
+            pass
+        finally:
+            self.server.connections.discard(self.connection)
+
+
+class FakeTransport(object):
+    """
+    Stands in for Telescope's socket, handing commands straight to a
+    Controller in the calling thread. With a VirtualClock no time passes
+    in the real world.
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self._stream = _Stream(controller)
+        self._output = b''
+
+    def sendall(self, data):
+        for reply in self._stream.feed(data):
+            self._output += reply
+
+    def recv(self, size):
+        if not self._output:
+            # Nothing will ever arrive, as if a socket timed out
+            raise socket.timeout('Simulator has no reply waiting')
+        data, self._output = self._output[:size], self._output[size:]
+        return data
+
+    def setsockopt(self, *args):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Simulator(object):
+    """
+    TCP server answering for a Controller, like the arduino's ethernet shield
+
+    host -- Address to listen on
+    port -- Port to listen on, 0 to pick a free one
+    Remaining keyword arguments are passed to Controller
+    """
+    def __init__(self, host='127.0.0.1', port=0, **kwargs):
+        self.controller = Controller(**kwargs)
+        self.server = _Server((host, port), _Handler)
+        self.server.controller = self.controller
+        self.server.connections = set()
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    def start(self):
+        """
+        Serve in a background thread
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def drop_connections(self):
+        """
+        Cut off every client, like the ethernet link going down
+        """
+        for connection in list(self.server.connections):
+            connection.shutdown(socket.SHUT_RDWR)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate the solar telescope arduino')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=solar.arduino['port'])
+    parser.add_argument('--slip', type=float, default=0., help='fraction of steps lost')
+    parser.add_argument('--slip-jitter', type=float, default=0.)
+    parser.add_argument('--time-scale', type=float, default=1.,
+                        help='multiplier on firmware delays, 0 to disable')
+    parser.add_argument('--protocol', type=int, default=protocol.VERSION,
+                        help='protocol version to speak, 1 for the legacy firmware')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    sim = Simulator(args.host, args.port, slip=args.slip, slip_jitter=args.slip_jitter,
+                    time_scale=args.time_scale, version=args.protocol)
+    logging.info('Simulating arduino on {}:{}'.format(*sim.address))
+    try:
+        sim.serve_forever()
+    except KeyboardInterrupt:
+        pass
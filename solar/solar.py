@@ -3,11 +3,15 @@
 Library for interfacing with the arduino controlling the solar telescope
 """
 import socket
+from collections import deque
 from functools import wraps
 import time
 import math
 from datetime import datetime
 import logging
+import clock
+import protocol
+import recorder
 
 
 class Commands:
@@ -16,6 +20,12 @@ class Commands:
     """
     reset = 'R'
     turn = 'T'
+    encoder = 'E'
+    dual_turn = 'D'
+    query = protocol.query  # Both encoders and the home switches, protocol version 2 only
+
+    # Commands the arduino answers with a reply of its own
+    replies = (turn, encoder, dual_turn, query)
 
 
 class Devices:
@@ -30,18 +40,21 @@ class Directions:
     clockwise = 'C'
     anti_clockwise = 'A'
 
+# Address of the arduino when none is given
 arduino = {
     'ip': '192.168.2.2',
     'port': 8010
 }
 
+# Gearing of the default mount, see Mount
 MOTOR_STEP_SIZE = 1.8  # degrees per step
 MICRO_STEPS = 16  # Number of microsteps per motor step
 GEAR_BOX_RATIO = 250
 GEAR_RATIO = 6.0
+ENCODER_TICKS = 10000  # Encoder ticks per turn of the gear box
 STEP_SIZE = (MOTOR_STEP_SIZE / MICRO_STEPS) / GEAR_BOX_RATIO
 
-ENCS_PER_REV = 10000 * GEAR_RATIO
+ENCS_PER_REV = ENCODER_TICKS * GEAR_RATIO
 STEPS_PER_REV = (360. / STEP_SIZE) * GEAR_RATIO
 
 STEPS_PER_ENC = STEPS_PER_REV / ENCS_PER_REV
@@ -52,63 +65,508 @@ SEC_PER_ENC = SEC_PER_STEP * STEPS_PER_ENC
 
 SLIP_FACTOR = STEPS_PER_ENC / 10
 
+# The firmware reads the step count into a 16 bit int
+MAX_STEPS_PER_COMMAND = 32767
+
+# Firmware timings, see solar_drive.pde
+FAST_STEP_THRESHOLD = 100  # Turns of more steps than this step fast
+SEC_PER_FAST_STEP = 2 * 50e-6
+SEC_PER_TRACK_STEP = 2 * 1500e-6
+SEC_PER_MOVE = 0.3  # Sync and encoder pauses around each turn
+
+# Connection to the arduino, in seconds
+CONNECT_TIMEOUT = 5.
+# Longest wait for a reply line, well over the longest single turn
+READ_TIMEOUT = 10.
+# Reconnect attempts back off from RECONNECT_DELAY doubling up to MAX_RECONNECT_DELAY
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 8.
+# Check an idle connection with an encoder query this often
+HEARTBEAT_INTERVAL = 5.
+# Wait for the firmware to say which protocol it speaks, longer than a turn
+# left running from a previous connection takes to finish
+NEGOTIATE_TIMEOUT = 5.
+# Encoder query round trips averaged for Telescope.metrics
+RTT_SAMPLES = 20
+
+
+class Mount(object):
+    """
+    Gearing of one telescope's axes, and the sizes and rates that follow from
+    it. The module constants are those of the default mount
+
+    motor_step_size -- Degrees per full motor step
+    micro_steps -- Microsteps per motor step
+    gear_box_ratio -- Reduction of the gear box on each motor
+    gear_ratio -- Reduction from the gear box to the axis
+    encoder_ticks -- Encoder ticks per turn of the gear box
+    """
+    def __init__(self, motor_step_size=MOTOR_STEP_SIZE, micro_steps=MICRO_STEPS, gear_box_ratio=GEAR_BOX_RATIO,
+                 gear_ratio=GEAR_RATIO, encoder_ticks=ENCODER_TICKS):
+        self.motor_step_size = motor_step_size
+        self.micro_steps = micro_steps
+        self.gear_box_ratio = gear_box_ratio
+        self.gear_ratio = gear_ratio
+        self.encoder_ticks = encoder_ticks
+
+        self.step_size = (float(motor_step_size) / micro_steps) / gear_box_ratio
+        self.encs_per_rev = encoder_ticks * gear_ratio
+        self.steps_per_rev = (360. / self.step_size) * gear_ratio
+        self.steps_per_enc = self.steps_per_rev / self.encs_per_rev
+        self.arcsec_per_step = (360 * 60 * 60) / self.steps_per_rev
+        self.arcsec_per_enc = self.arcsec_per_step * self.steps_per_enc
+        self.sec_per_step = (24 * 60 * 60) / self.steps_per_rev
+        self.sec_per_enc = self.sec_per_step * self.steps_per_enc
+        self.slip_factor = self.steps_per_enc / 10
+
+    def config(self):
+        """
+        Returns the arguments to build the same Mount again
+        """
+        return {
+            'motor_step_size': self.motor_step_size, 'micro_steps': self.micro_steps,
+            'gear_box_ratio': self.gear_box_ratio, 'gear_ratio': self.gear_ratio,
+            'encoder_ticks': self.encoder_ticks,
+        }
+
+
+class AxisState(object):
+    """
+    What the replies from the arduino have said about one motor, so a turn
+    doesn't need to ask for the encoder count first
+
+    encoder -- Last encoder count reported, None when not known
+    direction -- Direction of the last turn sent
+    updated -- clock.monotonic() time the encoder count was last reported
+    home -- The home switch input at the last Q query, None when not known
+    """
+    def __init__(self, motor):
+        self.motor = motor
+        self.invalidate()
+
+    @property
+    def known(self):
+        return self.encoder is not None
+
+    def update(self, encoder, direction=None):
+        self.encoder = encoder
+        if direction is not None:
+            self.direction = direction
+        self.updated = clock.monotonic()
+
+    def invalidate(self):
+        """
+        Forget everything, after the encoders are reset or the connection lost
+        """
+        self.encoder = None
+        self.direction = None
+        self.updated = None
+        self.home = None
+
 
-class _Singleton(type):
+class ConnectionLost(IOError):
     """
-    Class to force another class to be a singleton
+    The connection to the arduino dropped or stopped answering. Replies still
+    owed are lost, and the next command tries to reconnect
     """
-    _instances = {}
+    pass
 
-    def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = super(_Singleton, cls).__call__(*args, **kwargs)
-        return cls._instances[cls]
 
+class Reply(object):
+    """
+    A reply still owed by the arduino for a command sent with Telescope.submit
+    """
+    def __init__(self, telescope, cmd, request_id=None):
+        self.telescope = telescope
+        self.cmd = cmd
+        self.request_id = request_id
+        self.sent = clock.monotonic()
+        self._value = None
+        self._error = None
+        self._done = False
+
+    def done(self):
+        return self._done
+
+    def set_result(self, value):
+        self._value = value
+        self._done = True
+
+    def set_exception(self, error):
+        self._error = error
+        self._done = True
 
-class Telescope:
+    def result(self):
+        """
+        Wait for the reply to arrive
+        Returns the reply line, stripped of whitespace
+        Raises ConnectionLost if the connection dropped first
+        """
+        while not self._done:
+            self.telescope._resolve_next()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class Telescope(object):
     """
     Class to communicate with the arduino directly
+
+    Each Telescope is one mount with its own connection, gearing and slew
+    planner, so several can be driven from one process. The module functions
+    act on the active one, see get_telescope.
+
+    Replies arrive in the order the commands were sent, so any number of
+    commands can be in flight at once. Each one is matched to its Reply in
+    FIFO order as they are read from the socket.
+
+    Commands are given as text, as the legacy protocol sends them. When the
+    firmware speaks protocol version 2 they are sent as binary frames
+    instead, and each reply's request ID is checked against its command,
+    see protocol. The version is asked for on connecting.
+
+    The encoder count each reply gives is kept in axes, an AxisState for
+    each motor.
+
+    A connection that drops, or a reply that takes longer than READ_TIMEOUT,
+    raises ConnectionLost. The next command then reconnects, backing off
+    exponentially while the arduino can't be reached, and re-reads the
+    encoders. Commands aren't resent, it is up to the caller to carry on.
+
+    mount -- Mount giving the gearing, defaults to the module constants
+    planner -- SlewPlanner for the mount, defaults to a new one
     """
-    __metaclass__ = _Singleton
 
     def connected(f):
         @wraps(f)
         def _connected(*args, **kwargs):
-            if args[0].client_socket is not None:
-                return f(*args, **kwargs)
-            else:
-                raise IOError('Not connected to motors. Call Telescope.connect(\'<path to device>\')')
+            telescope = args[0]
+            if telescope.client_socket is None:
+                if telescope.address is None and telescope.transport is None:
+                    raise IOError('Not connected to motors. Call Telescope.connect(\'<path to device>\')')
+                telescope.reconnect()
+            return f(*args, **kwargs)
         return _connected
 
-    def __init__(self):
+    def __init__(self, mount=None, planner=None):
+        self.mount = mount or Mount()
+        self.planner = planner or SlewPlanner(mount=self.mount)
         self.client_socket = None
+        self.address = None
+        self.transport = None
+        self.version = None
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._request_id = 0
+        self.commands_sent = 0
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.reconnects = 0
+        self.rtts = deque(maxlen=RTT_SAMPLES)
+        self.last_heard = None
+        self._retry_delay = RECONNECT_DELAY
+        self._retry_at = 0
+        self.axes = {
+            Devices.body: AxisState(Devices.body),
+            Devices.mirror: AxisState(Devices.mirror),
+        }
 
     def __del__(self):
         self.disconnect()
 
-    def connect(self):
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((arduino['ip'], arduino['port']))
-        self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+    def connect(self, ip=None, port=None, transport=None, version=None):
+        """
+        Open the connection to the arduino
+        ip -- Address to connect to, defaults to arduino['ip']
+        port -- Port to connect to, defaults to arduino['port']
+        transport -- Already connected socket-like object to use instead,
+                     such as a simulator.FakeTransport
+        version -- Protocol version to speak, None to ask the firmware. Legacy
+                   firmware takes NEGOTIATE_TIMEOUT to not answer, 1 skips asking.
+                   Either way reconnecting keeps to the same version
+        """
+        self.disconnect()
+        if transport is not None:
+            self.transport = transport
+        else:
+            self.address = (ip or arduino['ip'], port or arduino['port'])
+        self.version = version
+        self._open()
+        self.commands_sent = 0
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.reconnects = 0
+        self.rtts.clear()
+        self._retry_delay = RECONNECT_DELAY
 
-    @connected
-    def disconnect(self, device):
-        self.client_socket.close()
+    def _open(self):
+        if self.transport is not None:
+            self.client_socket = self.transport
+        else:
+            client_socket = socket.create_connection(self.address, CONNECT_TIMEOUT)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            client_socket.settimeout(READ_TIMEOUT)
+            self.client_socket = client_socket
+        self._buffer = bytearray()
+        self._pending.clear()
+        self.last_heard = clock.monotonic()
+        self.invalidate()
+        if self.version is None:
+            self._negotiate()
+
+    def _negotiate(self):
+        """
+        Ask the firmware which protocol version it speaks, kept for reconnecting
+        """
+        self.client_socket.settimeout(NEGOTIATE_TIMEOUT)
+        try:
+            self.client_socket.sendall((protocol.version_query + '\n').encode('ascii'))
+            while b'\n' not in self._buffer:
+                data = self.client_socket.recv(64)
+                if not data:
+                    raise socket.error('connection closed')
+                self._buffer += bytearray(data)
+        except socket.timeout:
+            # Legacy firmware doesn't answer
+            self.version = 1
+        else:
+            line, self._buffer = self._split_line()
+            self.version = min(int(line), protocol.VERSION) if line.isdigit() else 1
+        finally:
+            self.client_socket.settimeout(READ_TIMEOUT)
+        logging.info('Speaking protocol version {} to the motors'.format(self.version))
+
+    def reconnect(self):
+        """
+        Connect again after the connection was lost and re-read the encoders,
+        once the backoff since the last failed attempt has passed
+        Raises ConnectionLost if it is too soon or the attempt fails
+        """
+        now = clock.monotonic()
+        if now < self._retry_at:
+            raise ConnectionLost('Reconnecting to motors in {:.1f}s'.format(self._retry_at - now))
+        try:
+            self._open()
+        except socket.error as e:
+            self._retry_at = now + self._retry_delay
+            self._retry_delay = min(self._retry_delay * 2, MAX_RECONNECT_DELAY)
+            raise ConnectionLost('Reconnecting to motors failed: {}'.format(e))
+        self.reconnects += 1
+        self._retry_delay = RECONNECT_DELAY
+        logging.warning('Reconnected to motors')
+        self.sync()
+
+    def _lost(self, error):
+        """
+        Close a connection that has failed, failing any replies still owed
+        Returns the ConnectionLost to raise
+        """
+        error = ConnectionLost('Lost connection to motors: {}'.format(error))
+        logging.warning(str(error))
+        if self.client_socket is not None and self.client_socket is not self.transport:
+            self.client_socket.close()
         self.client_socket = None
+        pending, self._pending = self._pending, deque()
+        for reply in pending:
+            reply.set_exception(error)
+        self.invalidate()
+        return error
+
+    def sync(self):
+        """
+        Read both encoders into axes, and the home switches with protocol
+        version 2, in one round trip
+        Returns the (body, mirror) encoder counts
+        """
+        if self.version >= 2:
+            reply, = self.submit(Commands.query)
+            body, mirror, status = [int(value) for value in reply.result().split(',')]
+            self.axes[Devices.body].home = bool(status & 1)
+            self.axes[Devices.mirror].home = bool(status & 2)
+        else:
+            replies = self.submit('E{}'.format(Devices.body), 'E{}'.format(Devices.mirror))
+            body, mirror = [int(reply.result()) for reply in replies]
+        self.axes[Devices.body].update(body)
+        self.axes[Devices.mirror].update(mirror)
+        return body, mirror
+
+    def heartbeat(self):
+        """
+        Check the connection with an encoder query if nothing has been heard
+        from the arduino for HEARTBEAT_INTERVAL, reconnecting if it has dropped
+        Returns whether the connection is up
+        """
+        if self.client_socket is not None and clock.monotonic() - self.last_heard < HEARTBEAT_INTERVAL:
+            return True
+        try:
+            self.sync()
+        except ConnectionLost:
+            return False
+        return True
+
+    def metrics(self):
+        """
+        Returns the connection quality as a dict of link_up (1 or 0),
+        link_rtt (mean seconds for an encoder query) and link_reconnects
+        """
+        return {
+            'link_up': float(self.client_socket is not None),
+            'link_rtt': sum(self.rtts) / len(self.rtts) if self.rtts else 0.,
+            'link_reconnects': self.reconnects,
+        }
+
+    def invalidate(self):
+        """
+        Forget the state of every axis
+        """
+        for axis in self.axes.values():
+            axis.invalidate()
+
+    def disconnect(self):
+        """
+        Close the connection, without reconnecting on the next command.
+        Replies still owed fail with ConnectionLost
+        """
+        if self.client_socket is not None:
+            self.client_socket.close()
+        self.client_socket = None
+        self.address = None
+        self.transport = None
+        pending, self._pending = self._pending, deque()
+        for reply in pending:
+            reply.set_exception(ConnectionLost('Disconnected from motors before {} was answered'.format(reply.cmd)))
+        self.invalidate()
 
     @connected
     def send_command(self, cmd):
         logging.debug('Send: {}'.format(cmd))
-        self.client_socket.send(cmd + '\n')
+        self._sendall(self._encode([cmd])[0])
+        self.commands_sent += 1
+
+    def _encode(self, cmds):
+        """
+        Returns the bytes to send for text commands in the protocol being
+        spoken, and the request ID given to each
+        """
+        if self.version < 2:
+            return ''.join(cmd + '\n' for cmd in cmds).encode('ascii'), [None] * len(cmds)
+        data = bytearray()
+        request_ids = []
+        for cmd in cmds:
+            self._request_id = (self._request_id + 1) % 256
+            data += protocol.encode_request(self._request_id, cmd)
+            request_ids.append(self._request_id)
+        return bytes(data), request_ids
+
+    def _sendall(self, data):
+        try:
+            self.client_socket.sendall(data)
+        except socket.error as e:
+            raise self._lost(e)
+        self.bytes_sent += len(data)
+
+    @connected
+    def submit(self, *cmds):
+        """
+        Send one or more commands in a single write without waiting for replies
+        cmds -- command strings, without the trailing newline
+        Returns a list of Reply objects, with None for commands that get no reply
+        """
+        for cmd in cmds:
+            logging.debug('Send: {}'.format(cmd))
+        data, request_ids = self._encode(cmds)
+        self._sendall(data)
+        self.commands_sent += len(cmds)
+
+        replies = []
+        for cmd, request_id in zip(cmds, request_ids):
+            if cmd[0] in Commands.replies:
+                reply = Reply(self, cmd, request_id)
+                self._pending.append(reply)
+                replies.append(reply)
+            else:
+                replies.append(None)
+        return replies
 
     @connected
     def readline(self):
-        data = ' '
-        while data[-1] != '\n':
-            data += self.client_socket.recv(1)
-        data = data.strip()
-        logging.debug('Recv: {}'.format(data))
-        return data
+        """
+        Read the next reply not already claimed by a submitted command
+        """
+        while self._pending:
+            self._resolve_next()
+        return self._next_reply()
+
+    def _resolve_next(self):
+        """
+        Hand the next reply from the arduino to the oldest outstanding Reply
+        """
+        reply = self._pending.popleft()
+        try:
+            line = self._next_reply(reply)
+        except ConnectionLost as e:
+            reply.set_exception(e)
+            raise
+        except IOError as e:
+            reply.set_exception(e)
+            return
+        reply.set_result(line)
+        if reply.cmd[0] in (Commands.encoder, Commands.query):
+            self.rtts.append(clock.monotonic() - reply.sent)
+
+    def _read(self):
+        """
+        Add as much as is available from the socket to the buffer, waiting
+        for something to arrive
+        """
+        self.round_trips += 1
+        try:
+            data = self.client_socket.recv(4096)
+        except socket.error as e:
+            raise self._lost(e)
+        if not data:
+            raise self._lost('connection closed')
+        self._buffer += bytearray(data)
+        self.bytes_received += len(data)
+
+    def _split_line(self):
+        line, rest = self._buffer.split(b'\n', 1)
+        return line.decode('ascii').strip(), rest
+
+    def _next_reply(self, reply=None):
+        """
+        Return the next reply from the socket as a line of text, whichever
+        protocol it came in
+        reply -- The Reply it should answer, to check the request ID against
+        Raises IOError if the firmware rejected the command
+        """
+        if self.version < 2:
+            while b'\n' not in self._buffer:
+                self._read()
+            line, self._buffer = self._split_line()
+            if line.startswith(protocol.error):
+                raise IOError('Motors rejected {}: error {}'.format(reply.cmd if reply else '', line[1:]))
+        else:
+            try:
+                frame = None
+                while frame is None:
+                    if self._buffer:
+                        frame, self._buffer = protocol.split_frame(self._buffer)
+                    if frame is None:
+                        self._read()
+                request_id, op, line = protocol.decode_reply(frame)
+            except ValueError as e:
+                raise self._lost(e)
+            if reply is not None and request_id != reply.request_id:
+                raise self._lost('reply {} to request {}'.format(request_id, reply.request_id))
+            if op == protocol.error:
+                raise IOError('Motors rejected {}: error {}'.format(reply.cmd if reply else '', line))
+        self.last_heard = clock.monotonic()
+        logging.debug('Recv: {}'.format(line))
+        return line
 
 
 def motor_check(f):
@@ -127,11 +585,35 @@ def direction_check(f):
     return wrapper
 
 
-def connect():
+def connect(ip=None, port=None, transport=None, version=None):
     """
     Connect to the telscope
+    ip -- Address of the arduino, or a simulator, defaults to arduino['ip']
+    port -- Port to connect to, defaults to arduino['port']
+    transport -- Socket-like object to use instead of connecting
+    version -- Protocol version to speak, None to ask the firmware
+    """
+    get_telescope().connect(ip, port, transport, version)
+
+
+def _queries(telescope, *motors):
     """
-    Telescope().connect()
+    Returns the E commands needed to learn the encoder counts of the motors
+    that aren't already known
+    """
+    return ['E{}'.format(motor) for motor in motors if not telescope.axes[motor].known]
+
+
+def _known(telescope, motors, replies):
+    """
+    Update the axes from the replies to commands from _queries
+    Returns the encoder count of each motor
+    """
+    replies = iter(replies)
+    for motor in motors:
+        if not telescope.axes[motor].known:
+            telescope.axes[motor].update(int(next(replies).result()))
+    return [telescope.axes[motor].encoder for motor in motors]
 
 
 @motor_check
@@ -139,23 +621,349 @@ def connect():
 def _raw_turn(motor, direction, turns):
     """
     Turn the motors, without regard for the encoder return values
+    Turns too large for one command are split up and sent together. The
+    encoder count is only asked for if it isn't already known
     Returns the number of encoded turns
     """
-    current = current_position(motor)
+    telescope = get_telescope()
+    chunks = _chunks(turns)
+    queries = _queries(telescope, motor)
+    replies = telescope.submit(*(queries + ['T{}{}{}'.format(motor, direction, steps) for steps in chunks]))
+    for steps in chunks:
+        recorder.active.record(recorder.Kinds.TURN, motor, direction, steps=steps)
+    position, = _known(telescope, [motor], replies[:len(queries)])
+    count = position
+    for reply in replies[len(queries):]:
+        count = int(reply.result())
+        telescope.axes[motor].update(count, direction)
+        recorder.active.record(recorder.Kinds.ENCODER, motor, encoder=count)
+    return abs(count - position)
+
+
+def check_steps(steps):
+    """
+    Raises ValueError if steps are more than one turn command can take
+    """
+    if not 0 <= int(steps) <= MAX_STEPS_PER_COMMAND:
+        raise ValueError('{} steps is more than one command can turn'.format(int(steps)))
+
+
+@motor_check
+@direction_check
+def step(motor, direction, steps):
+    """
+    Send a single turn of one motor, no more than MAX_STEPS_PER_COMMAND
+    Returns the encoder count once it is done
+    Raises ValueError for more steps than that, which the firmware would
+    wrap round to a negative count and not turn at all
+    """
+    check_steps(steps)
+    telescope = get_telescope()
+    reply, = telescope.submit('T{}{}{}'.format(motor, direction, int(steps)))
+    recorder.active.record(recorder.Kinds.TURN, motor, direction, steps=int(steps))
+    count = int(reply.result())
+    telescope.axes[motor].update(count, direction)
+    recorder.active.record(recorder.Kinds.ENCODER, motor, encoder=count)
+    return count
+
+
+def _chunks(turns):
+    """
+    Split a number of steps into pieces small enough for one command
+    """
+    turns = int(turns)
+    chunks = [MAX_STEPS_PER_COMMAND] * (turns // MAX_STEPS_PER_COMMAND)
+    if turns % MAX_STEPS_PER_COMMAND:
+        chunks.append(turns % MAX_STEPS_PER_COMMAND)
+    return chunks
 
-    Telescope().send_command('T{}{}{}'.format(motor, direction, int(turns)))
-    count = int(Telescope().readline())
 
-    return abs(count - current)
+def _raw_turn_both(body_direction, body_turns, mirror_direction, mirror_turns):
+    """
+    Turn the body and mirror motors at the same time, without regard for the
+    encoder return values
+    Returns the number of encoded turns for (body, mirror)
+    """
+    body_chunks, mirror_chunks = _chunks(body_turns), _chunks(mirror_turns)
+    n = max(len(body_chunks), len(mirror_chunks))
+    body_chunks += [0] * (n - len(body_chunks))
+    mirror_chunks += [0] * (n - len(mirror_chunks))
+
+    telescope = get_telescope()
+    queries = _queries(telescope, Devices.body, Devices.mirror)
+    cmds = list(queries)
+    for body_steps, mirror_steps in zip(body_chunks, mirror_chunks):
+        cmds.append('D{}{},{}{}'.format(body_direction, body_steps, mirror_direction, mirror_steps))
+    replies = telescope.submit(*cmds)
+    for body_steps, mirror_steps in zip(body_chunks, mirror_chunks):
+        recorder.active.record(recorder.Kinds.TURN, Devices.body, body_direction, steps=body_steps)
+        recorder.active.record(recorder.Kinds.TURN, Devices.mirror, mirror_direction, steps=mirror_steps)
+
+    body_start, mirror_start = body, mirror = _known(telescope, [Devices.body, Devices.mirror],
+                                                     replies[:len(queries)])
+    for reply in replies[len(queries):]:
+        body, mirror = _dual_reply(telescope, reply, body_direction, mirror_direction)
+    return abs(body - body_start), abs(mirror - mirror_start)
+
+
+def _dual_reply(telescope, reply, body_direction, mirror_direction):
+    """
+    Read the reply to a D command into the axes and the recording
+    Returns the (body, mirror) encoder counts
+    """
+    body, mirror = [int(count) for count in reply.result().split(',')]
+    telescope.axes[Devices.body].update(body, body_direction)
+    telescope.axes[Devices.mirror].update(mirror, mirror_direction)
+    recorder.active.record(recorder.Kinds.ENCODER, Devices.body, encoder=body)
+    recorder.active.record(recorder.Kinds.ENCODER, Devices.mirror, encoder=mirror)
+    return body, mirror
+
+
+def step_both(body_direction, body_steps, mirror_direction, mirror_steps):
+    """
+    Send a single turn of both motors, each no more than MAX_STEPS_PER_COMMAND
+    Returns the (body, mirror) encoder counts once it is done
+    Raises ValueError for more steps than that, see step
+    """
+    check_steps(body_steps)
+    check_steps(mirror_steps)
+    telescope = get_telescope()
+    reply, = telescope.submit('D{}{},{}{}'.format(body_direction, int(body_steps),
+                                                  mirror_direction, int(mirror_steps)))
+    recorder.active.record(recorder.Kinds.TURN, Devices.body, body_direction, steps=int(body_steps))
+    recorder.active.record(recorder.Kinds.TURN, Devices.mirror, mirror_direction, steps=int(mirror_steps))
+    return _dual_reply(telescope, reply, body_direction, mirror_direction)
 
 
 @motor_check
 def current_position(motor):
     """
-    Return the current encoder count for the motor
+    Ask the arduino for the current encoder count for the motor
+    """
+    telescope = get_telescope()
+    reply, = telescope.submit('E{}'.format(motor))
+    telescope.axes[motor].update(int(reply.result()))
+    return telescope.axes[motor].encoder
+
+
+@motor_check
+def position(motor):
+    """
+    Return the encoder count for the motor, only asking the arduino if it
+    isn't already known
+    """
+    axis = get_telescope().axes[motor]
+    if axis.known:
+        return axis.encoder
+    return current_position(motor)
+
+
+def positions():
+    """
+    Return the (body, mirror) encoder counts, asking the arduino for both in
+    one round trip if either isn't already known
+    """
+    telescope = get_telescope()
+    if telescope.axes[Devices.body].known and telescope.axes[Devices.mirror].known:
+        return telescope.axes[Devices.body].encoder, telescope.axes[Devices.mirror].encoder
+    return telescope.sync()
+
+
+class SlewPlanner(object):
+    """
+    Plans the moves for a slew from what recent moves achieved
+
+    For each motor and direction it keeps a decaying sum of the motor steps
+    sent and encoder ticks they produced, giving the current ticks per step
+    including any slip. A slew is then one large move, sized to land a
+    little short of the target, followed by as few small corrections as it
+    takes to get there.
+
+    It also predicts how long a slew will take from the firmware timings,
+    scaled by how long recent slews took against their prediction.
+
+    short_fraction -- Fraction of the distance the large move stops short by
+    decay -- Weight kept by older moves each time a new one is learnt
+    chunk_steps -- Most steps sent in one move, bounding how long a slew
+                   takes to stop
+    mount -- Mount the moves are for, defaults to the module constants
+    """
+    # Sizes in encoder ticks, the steps they come to depend on the mount
+    MIN_TICKS = 0.25
+    PRIOR_TICKS = 10
+    # Shorter moves are dominated by encoder quantisation, so aren't learnt from
+    LEARN_TICKS = 10
+    # Moves a slew is assumed to take until some have been seen
+    PRIOR_MOVES = 2
+
+    def __init__(self, short_fraction=0.02, decay=0.8, chunk_steps=MAX_STEPS_PER_COMMAND, mount=None):
+        self.mount = mount or Mount()
+        self.min_steps = self.MIN_TICKS * self.mount.steps_per_enc
+        self.prior_steps = self.PRIOR_TICKS * self.mount.steps_per_enc
+        self.learn_steps = self.LEARN_TICKS * self.mount.steps_per_enc
+        self.short_fraction = short_fraction
+        self.decay = decay
+        self.chunk_steps = chunk_steps
+        self.steps = {}
+        self.ticks = {}
+        self.predicted = 1.
+        self.taken = 1.
+        self.slews = 1.
+        self.slew_moves = self.PRIOR_MOVES
+        self.last = None
+
+    @staticmethod
+    def move_time(steps):
+        """
+        Returns the seconds the firmware takes to turn by steps, split into
+        as many commands as _raw_turn would send
+        """
+        seconds = 0.
+        for chunk in _chunks(steps) or [0]:
+            if chunk > FAST_STEP_THRESHOLD:
+                seconds += SEC_PER_MOVE + chunk * SEC_PER_FAST_STEP
+            else:
+                seconds += SEC_PER_MOVE + chunk * SEC_PER_TRACK_STEP
+        return seconds
+
+    def duration(self, *ticks):
+        """
+        Estimate how long a slew will take
+        ticks -- Encoder ticks to move each axis by, axes given together move
+                 at the same time
+        Returns seconds
+        """
+        steps = max(abs(t) for t in ticks) * self.mount.steps_per_enc
+        if steps == 0:
+            return 0.
+        corrections = max(self.slew_moves / self.slews - 1, 0)
+        seconds = self.move_time(steps) + corrections * self.move_time(self.min_steps)
+        return seconds * self.taken / self.predicted
+
+    def _learn_time(self, moves, predicted, seconds):
+        """
+        Update the slew time estimate from a completed slew
+        moves -- Round trips it took
+        predicted -- Seconds the firmware timings gave for the moves made
+        seconds -- Seconds it actually took
+        """
+        self.slews = self.decay * self.slews + 1
+        self.slew_moves = self.decay * self.slew_moves + moves
+        self.predicted = self.decay * self.predicted + predicted
+        self.taken = self.decay * self.taken + seconds
+
+    def ratio(self, motor, direction):
+        """
+        Returns the estimated encoder ticks per motor step
+        """
+        key = (motor, direction)
+        if key not in self.steps:
+            self.steps[key] = self.prior_steps
+            self.ticks[key] = float(self.PRIOR_TICKS)
+        return self.ticks[key] / self.steps[key]
+
+    def learn(self, motor, direction, steps, ticks):
+        """
+        Update the estimate from a completed move
+        """
+        if steps < self.learn_steps:
+            return
+        self.ratio(motor, direction)
+        key = (motor, direction)
+        self.steps[key] = self.decay * self.steps[key] + steps
+        self.ticks[key] = self.decay * self.ticks[key] + ticks
+
+    def next_move(self, motor, direction, remaining, first):
+        """
+        Returns the motor steps for the next move, with remaining encoder ticks to go
+        """
+        ratio = self.ratio(motor, direction)
+        if first:
+            target = remaining - max(1., remaining * self.short_fraction)
+            if target * 1. / ratio > self.min_steps:
+                return int(target / ratio)
+        return int(max(math.ceil(remaining / ratio), self.min_steps))
+
+    def moves(self, axes):
+        """
+        Make a slew one move at a time
+        axes -- List of (motor, direction, enc_turns), either one motor or
+                the body then the mirror, which then move together
+        Yields the encoder turns still to go on each axis after every move.
+        No move is longer than chunk_steps, so a slew can be abandoned
+        between moves without waiting long
+        """
+        start = clock.monotonic()
+        remaining = [enc_turns for _, _, enc_turns in axes]
+        moves = 0
+        chunks = 0
+        predicted = 0.
+        while any(r > 0 for r in remaining):
+            steps = []
+            for (motor, direction, _), r in zip(axes, remaining):
+                steps.append(self.next_move(motor, direction, r, moves == chunks) if r > 0 else 0)
+            # Only the large first move gets cut into chunks
+            chunked = max(steps) > self.chunk_steps
+            steps = [min(s, self.chunk_steps) for s in steps]
+            predicted += self.move_time(max(steps))
+
+            if len(axes) == 1:
+                done = [_raw_turn(axes[0][0], axes[0][1], steps[0])]
+            else:
+                done = _raw_turn_both(axes[0][1], steps[0], axes[1][1], steps[1])
+            for i, (motor, direction, _) in enumerate(axes):
+                self.learn(motor, direction, steps[i], done[i])
+                remaining[i] -= done[i] if steps[i] else 0
+                recorder.active.record(recorder.Kinds.ERROR, motor, direction, error=remaining[i])
+            moves += 1
+            chunks += chunked
+            yield list(remaining)
+
+        self.last = (moves, clock.monotonic() - start)
+        self._learn_time(moves - chunks, predicted, self.last[1])
+        logging.info('Slew {}: {} round trips in {:.2f}s'.format(
+            ' and '.join('{}{} {:.0f} ticks'.format(*axis) for axis in axes), moves, self.last[1]))
+
+    def slew(self, motor, direction, enc_turns):
+        """
+        Turn a motor until the encoder reports back enough turns
+        Returns (round trips, seconds taken)
+        """
+        for _ in self.moves([(motor, direction, enc_turns)]):
+            pass
+        return self.last
+
+    def slew_both(self, body_direction, body_turns, mirror_direction, mirror_turns):
+        """
+        Turn the body and mirror motors together until both encoders report
+        back enough turns. Each move carries the next move for both axes, an
+        axis that has arrived is sent no steps
+        Returns (round trips, seconds taken)
+        """
+        for _ in self.moves([(Devices.body, body_direction, body_turns),
+                             (Devices.mirror, mirror_direction, mirror_turns)]):
+            pass
+        return self.last
+
+
+_active = Telescope()
+
+
+def get_telescope():
+    """
+    The Telescope the module functions act on
     """
-    Telescope().send_command('E{}'.format(motor))
-    return int(Telescope().readline())
+    return _active
+
+
+def set_telescope(telescope):
+    """
+    Make telescope the one the module functions act on
+    Returns the previous one
+    """
+    global _active
+    previous, _active = _active, telescope
+    return previous
 
 
 @motor_check
@@ -163,37 +971,95 @@ def current_position(motor):
 def turn(motor, direction, enc_turns):
     """
     Turn a motor until the encoder reports back enough turns.
+    Returns (round trips, seconds taken)
+    """
+    return get_telescope().planner.slew(motor, direction, enc_turns)
+
+
+def turn_both(body_direction, body_turns, mirror_direction, mirror_turns):
+    """
+    Turn the body and mirror motors at the same time until both encoders
+    report back enough turns
+    Returns (round trips, seconds taken)
+    """
+    for direction in (body_direction, mirror_direction):
+        assert(direction == Directions.clockwise or direction == Directions.anti_clockwise)
+    return get_telescope().planner.slew_both(body_direction, body_turns, mirror_direction, mirror_turns)
+
+
+def slew_altaz(az, alt, start_az, start_alt, latitude):
     """
-    dt = enc_turns
-    while dt > 0:
-        turns = min(2000., dt * 0.7)
-        raw_turns = turns * STEPS_PER_ENC
-        raw_turns = int(max(raw_turns, STEPS_PER_ENC / 4))
-        completed = _raw_turn(motor, direction, raw_turns)
-        dt -= completed
+    Move the telescope from one azimuth and altitude to another, turning the
+    polar and declination axes together
+    az, alt -- Position to go to, in arcsec
+    start_az, start_alt -- Position the telescope is at, in arcsec
+    latitude -- Latitude of the telescope in degrees
+    """
+    # Imported here so importing solar doesn't bring in NumPy
+    import transform
+    polar, dec = transform.axis_offsets(az, alt, start_az, start_alt, latitude)
+    adjust_both(float(polar), float(dec))
 
 
-def adjust_az(arcsec):
+def adjust_az(arcsec, az, alt, latitude):
     """
     Move the telescope by arcsec in azimuth
-    n.b. Not implemented, just rotates the polar axis
+    az, alt -- Position the telescope is at, in arcsec
+    latitude -- Latitude of the telescope in degrees
     """
-    adjust_polar(arcsec)
+    slew_altaz(az + arcsec, alt, az, alt, latitude)
 
 
-def adjust_alt(arcsec):
+def adjust_alt(arcsec, az, alt, latitude):
     """
     Move the telescope by arcsec in altitude
-    n.b. Not implemented, just rotates the declination axis
+    az, alt -- Position the telescope is at, in arcsec
+    latitude -- Latitude of the telescope in degrees
     """
-    adjust_dec(arcsec)
+    slew_altaz(az, alt + arcsec, az, alt, latitude)
+
+
+def _direction(turns):
+    if turns < 0:
+        return Directions.anti_clockwise
+    return Directions.clockwise
+
+
+def adjust_both(polar, dec):
+    """
+    Rotate the polar and declination axes together
+    polar, dec -- arcseconds to rotate each axis by
+    """
+    arcsec_per_enc = get_telescope().mount.arcsec_per_enc
+    polar_turns = polar / arcsec_per_enc
+    dec_turns = dec / arcsec_per_enc
+    turn_both(_direction(polar_turns), abs(polar_turns), _direction(dec_turns), abs(dec_turns))
+
+
+def slew_moves(polar, dec):
+    """
+    Rotate the polar and declination axes together a move at a time, see
+    SlewPlanner.moves
+    polar, dec -- arcseconds to rotate each axis by
+    Yields the arcseconds (polar, dec) each axis has turned so far, after
+    every move
+    """
+    telescope = get_telescope()
+    arcsec_per_enc = telescope.mount.arcsec_per_enc
+    polar_turns = polar / arcsec_per_enc
+    dec_turns = dec / arcsec_per_enc
+    sign = [1 if turns >= 0 else -1 for turns in (polar_turns, dec_turns)]
+    for polar_left, dec_left in telescope.planner.moves([(Devices.body, _direction(polar_turns), abs(polar_turns)),
+                                               (Devices.mirror, _direction(dec_turns), abs(dec_turns))]):
+        yield (sign[0] * (abs(polar_turns) - polar_left) * arcsec_per_enc,
+               sign[1] * (abs(dec_turns) - dec_left) * arcsec_per_enc)
 
 
 def adjust_polar(arcsec):
     """
     Roate the polar axis by arcseconds
     """
-    turns = arcsec / ARCSEC_PER_ENC
+    turns = arcsec / get_telescope().mount.arcsec_per_enc
     if turns < 0:
         direc = Directions.anti_clockwise
     else:
@@ -205,7 +1071,7 @@ def adjust_dec(arcsec):
     """
     Rotate the declination axis by arcsec
     """
-    turns = arcsec / ARCSEC_PER_ENC
+    turns = arcsec / get_telescope().mount.arcsec_per_enc
     if turns < 0:
         direc = Directions.anti_clockwise
     else:
@@ -213,14 +1079,25 @@ def adjust_dec(arcsec):
     turn(Devices.mirror, direc, abs(turns))
 
 
+def heartbeat():
+    """
+    Check the connection to the arduino is up if it has been idle, see
+    Telescope.heartbeat
+    """
+    return get_telescope().heartbeat()
+
+
 def reset_zero():
     """
     Reset the encoder counts to zero
     """
-    Telescope().send_command('R')
+    telescope = get_telescope()
+    telescope.send_command('R')
+    telescope.invalidate()
 
 
 def log_constants():
-    logging.info('Motor steps per encode tick: {}'.format(STEPS_PER_ENC))
-    logging.info('Arcsec per motor step: {}'.format(ARCSEC_PER_STEP))
-    logging.info('Arcsec per encoder step: {}'.format(ARCSEC_PER_ENC))
+    mount = get_telescope().mount
+    logging.info('Motor steps per encode tick: {}'.format(mount.steps_per_enc))
+    logging.info('Arcsec per motor step: {}'.format(mount.arcsec_per_step))
+    logging.info('Arcsec per encoder step: {}'.format(mount.arcsec_per_enc))
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio client for the telescope, needing Python 3.6 or later
+
+An alternative to solar_async.TelescopeManager that runs in the caller's
+event loop alongside any other I/O, instead of in a worker process driven
+through a Pipe:
+
+    telescope = AsyncTelescope()
+    await telescope.connect(*sim.address)
+    await telescope.slew(3600, -1800)
+    tracking = asyncio.ensure_future(telescope.track(longitude, latitude, az, alt))
+    async for state in telescope.updates():
+        print(state['enc_body'], state['enc_mirror'])
+
+It speaks the same protocol as solar.Telescope, versions 1 and 2, with
+commands pipelined and replies matched to them in order by a reader task.
+The encoder counts each reply gives are kept in axes, as solar.AxisState.
+
+Cancelling the task running a slew or track stops it at once. The move in
+progress can't be called back from the arduino, its reply is still read so
+the connection stays in step and axes stays right.
+
+Run directly to watch a slew against a simulator:
+
+    python solar/solar_aio.py --polar 36000 --dec -18000
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import math
+import clock
+import control
+import protocol
+import simulator
+import solar
+import transform
+from ephemeris import EphemerisCache
+from solar_async import AxisTracker, track_interval
+
+# Latest updates kept for each updates() iterator, older ones are dropped
+UPDATES_KEPT = 1
+
+
+class AsyncTelescope(object):
+    """
+    Connection to the arduino for use in an asyncio event loop
+
+    planner -- solar.SlewPlanner to plan slews with, defaults to a new one
+    mount -- solar.Mount giving the gearing, defaults to solar's constants
+    tune -- (azimuth, altitude) arcsec offset from the Sun while tracking,
+            may be changed at any time
+    """
+    def __init__(self, planner=None, mount=None):
+        self.mount = mount or solar.Mount()
+        self.planner = planner or solar.SlewPlanner(mount=self.mount)
+        self.version = None
+        self.tune = (0., 0.)
+        self.axes = {
+            solar.Devices.body: solar.AxisState(solar.Devices.body),
+            solar.Devices.mirror: solar.AxisState(solar.Devices.mirror),
+        }
+        self.state = {}
+        self.commands_sent = 0
+        self._reader = None
+        self._writer = None
+        self._reading = None
+        self._pending = collections.deque()
+        self._request_id = 0
+        self._listeners = []
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    async def connect(self, ip=None, port=None, version=None):
+        """
+        Open the connection to the arduino
+        ip -- Address to connect to, defaults to solar.arduino['ip']
+        port -- Port to connect to, defaults to solar.arduino['port']
+        version -- Protocol version to speak, None to ask the firmware
+        """
+        await self.close()
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(ip or solar.arduino['ip'], port or solar.arduino['port']),
+            solar.CONNECT_TIMEOUT)
+        self.version = version or await self._negotiate()
+        logging.info('Speaking protocol version {} to the motors'.format(self.version))
+        self._reading = asyncio.ensure_future(self._read_replies())
+
+    async def _negotiate(self):
+        self._writer.write((protocol.version_query + '\n').encode('ascii'))
+        try:
+            line = await asyncio.wait_for(self._reader.readline(), solar.NEGOTIATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Legacy firmware doesn't answer
+            return 1
+        line = line.decode('ascii').strip()
+        return min(int(line), protocol.VERSION) if line.isdigit() else 1
+
+    async def close(self):
+        if self._reading is not None:
+            self._reading.cancel()
+            self._reading = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending(solar.ConnectionLost('Connection to motors closed'))
+        for axis in self.axes.values():
+            axis.invalidate()
+
+    def _fail_pending(self, error):
+        pending, self._pending = self._pending, collections.deque()
+        for future, _, _ in pending:
+            if not future.done():
+                future.set_exception(error)
+                # Nobody is left waiting on a reply to a cancelled slew
+                future.exception()
+
+    def submit(self, *cmds):
+        """
+        Send one or more commands in a single write without waiting for replies
+        cmds -- Text commands, as for solar.Telescope.submit
+        Returns a list of futures for the reply lines, with None for commands
+        that get no reply
+        """
+        if self._writer is None:
+            raise solar.ConnectionLost('Not connected to motors')
+        data = bytearray()
+        futures = []
+        for cmd in cmds:
+            logging.debug('Send: {}'.format(cmd))
+            self._request_id = (self._request_id + 1) % 256
+            if self.version >= 2:
+                data += protocol.encode_request(self._request_id, cmd)
+            else:
+                data += (cmd + '\n').encode('ascii')
+            future = None
+            if cmd[0] in solar.Commands.replies:
+                future = asyncio.get_event_loop().create_future()
+                self._pending.append((future, self._request_id, cmd))
+            futures.append(future)
+        self._writer.write(bytes(data))
+        self.commands_sent += len(cmds)
+        return futures
+
+    async def _wait(self, future):
+        """
+        Wait for a reply without giving up the future if cancelled, so the
+        reader still takes the reply to it off the connection
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), solar.READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            error = solar.ConnectionLost('No reply from motors in {:.0f}s'.format(solar.READ_TIMEOUT))
+            await self.close()
+            raise error
+
+    async def command(self, cmd):
+        """
+        Send a single command and wait for its reply line
+        """
+        future, = self.submit(cmd)
+        if future is None:
+            return None
+        return await self._wait(future)
+
+    async def _read_frame(self):
+        """
+        Read the next reply frame, skipping any bytes before it that can't
+        start one, such as a stray newline
+        """
+        header = await self._reader.readexactly(1)
+        while protocol.frame_length(header) is None:
+            logging.warning('Skipped a byte that is not a frame: {!r}'.format(header))
+            header = await self._reader.readexactly(1)
+        return bytearray(header) + await self._reader.readexactly(protocol.frame_length(header) - 1)
+
+    async def _read_replies(self):
+        """
+        Match replies to the commands waiting on them until the connection is
+        closed. However this stops, anything still waiting is failed
+        """
+        try:
+            while self._writer is not None:
+                if self.version >= 2:
+                    request_id, op, line = protocol.decode_reply(await self._read_frame())
+                else:
+                    request_id, op, line = None, None, (await self._reader.readline()).decode('ascii').strip()
+                    if not line:
+                        raise solar.ConnectionLost('Connection to motors closed')
+                    if line.startswith(protocol.error):
+                        op, line = protocol.error, line[1:]
+                logging.debug('Recv: {}'.format(line))
+                if not self._pending:
+                    logging.warning('Reply nothing was waiting for: {}'.format(line))
+                    continue
+                future, expected, cmd = self._pending.popleft()
+                if request_id is not None and request_id != expected:
+                    raise solar.ConnectionLost('Reply {} to request {}'.format(request_id, expected))
+                if op == protocol.error:
+                    if not future.done():
+                        future.set_exception(IOError('Motors rejected {}: error {}'.format(cmd, line)))
+                    continue
+                self._update(cmd, line)
+                if not future.done():
+                    future.set_result(line)
+            return
+        except asyncio.CancelledError:
+            # close() fails anything waiting
+            raise
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, solar.ConnectionLost) as e:
+            logging.warning('Lost connection to motors: {}'.format(e))
+            error = e
+        except Exception as e:
+            logging.exception('Reading replies from motors failed')
+            error = e
+        self._writer = None
+        self._fail_pending(solar.ConnectionLost('Lost connection to motors: {}'.format(error)))
+        for axis in self.axes.values():
+            axis.invalidate()
+
+    def _update(self, cmd, line):
+        """
+        Keep axes up to date from every reply, whether or not anyone still
+        waits for it
+        """
+        counts = [int(value) for value in line.split(',')]
+        op, args = cmd[0], cmd[1:]
+        if op == solar.Commands.turn:
+            self.axes[args[0]].update(counts[0], args[1])
+        elif op == solar.Commands.encoder:
+            self.axes[args[0]].update(counts[0])
+        elif op == solar.Commands.dual_turn:
+            body, mirror = args.split(',')
+            self.axes[solar.Devices.body].update(counts[0], body[0])
+            self.axes[solar.Devices.mirror].update(counts[1], mirror[0])
+        elif op == solar.Commands.query:
+            self.axes[solar.Devices.body].update(counts[0])
+            self.axes[solar.Devices.mirror].update(counts[1])
+            self.axes[solar.Devices.body].home = bool(counts[2] & 1)
+            self.axes[solar.Devices.mirror].home = bool(counts[2] & 2)
+        self.publish(enc_body=self.axes[solar.Devices.body].encoder,
+                     enc_mirror=self.axes[solar.Devices.mirror].encoder)
+
+    def publish(self, **values):
+        """
+        Update state and hand a copy to every updates() iterator
+        """
+        self.state.update(values)
+        self.state['updated'] = clock.monotonic()
+        for queue in self._listeners:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(dict(self.state))
+
+    async def updates(self):
+        """
+        Iterate over state each time it changes. A slow reader only sees the
+        latest state, older ones are dropped
+        """
+        queue = asyncio.Queue(UPDATES_KEPT)
+        self._listeners.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._listeners.remove(queue)
+
+    async def position(self, motor):
+        """
+        Return the encoder count for the motor, only asking the arduino if it
+        isn't already known
+        """
+        if not self.axes[motor].known:
+            await self.command('E{}'.format(motor))
+        return self.axes[motor].encoder
+
+    async def positions(self):
+        """
+        Return the (body, mirror) encoder counts, asking for any not already
+        known in one round trip
+        """
+        unknown = [motor for motor in (solar.Devices.body, solar.Devices.mirror) if not self.axes[motor].known]
+        if self.version >= 2 and unknown:
+            await self.command(solar.Commands.query)
+        elif unknown:
+            await asyncio.gather(*[self._wait(future) for future in self.submit(
+                *['E{}'.format(motor) for motor in unknown])])
+        return self.axes[solar.Devices.body].encoder, self.axes[solar.Devices.mirror].encoder
+
+    async def step(self, motor, direction, steps):
+        """
+        Send a single turn of one motor, no more than solar.MAX_STEPS_PER_COMMAND
+        Returns the encoder count once it is done
+        Raises ValueError for more steps than that, see solar.step
+        """
+        solar.check_steps(steps)
+        return int(await self.command('T{}{}{}'.format(motor, direction, int(steps))))
+
+    async def step_both(self, body_direction, body_steps, mirror_direction, mirror_steps):
+        """
+        Send a single turn of both motors, each no more than solar.MAX_STEPS_PER_COMMAND
+        Returns the (body, mirror) encoder counts once it is done
+        Raises ValueError for more steps than that, see solar.step
+        """
+        solar.check_steps(body_steps)
+        solar.check_steps(mirror_steps)
+        reply = await self.command('D{}{},{}{}'.format(body_direction, int(body_steps),
+                                                       mirror_direction, int(mirror_steps)))
+        body, mirror = [int(count) for count in reply.split(',')]
+        return body, mirror
+
+    async def _moves(self, axes):
+        """
+        Make a slew one move at a time, planned as solar.SlewPlanner.moves
+        axes -- List of (motor, direction, enc_turns), either one motor or
+                the body then the mirror, which then move together
+        Returns the encoder turns made on each axis
+        """
+        remaining = [enc_turns for _, _, enc_turns in axes]
+        moves = 0
+        chunks = 0
+        while any(r > 0 for r in remaining):
+            steps = []
+            for (motor, direction, _), r in zip(axes, remaining):
+                steps.append(self.planner.next_move(motor, direction, r, moves == chunks) if r > 0 else 0)
+            # Only the large first move gets cut into chunks
+            chunked = max(steps) > self.planner.chunk_steps
+            steps = [min(s, self.planner.chunk_steps) for s in steps]
+
+            start = await self.positions()
+            if len(axes) == 1:
+                counts = [await self.step(axes[0][0], axes[0][1], steps[0])]
+            else:
+                counts = await self.step_both(axes[0][1], steps[0], axes[1][1], steps[1])
+            for i, (motor, direction, _) in enumerate(axes):
+                done = abs(counts[i] - start[0 if motor == solar.Devices.body else 1])
+                self.planner.learn(motor, direction, steps[i], done)
+                remaining[i] -= done if steps[i] else 0
+            moves += 1
+            chunks += chunked
+        return [enc_turns - r for (_, _, enc_turns), r in zip(axes, remaining)]
+
+    async def turn(self, motor, direction, enc_turns):
+        """
+        Turn a motor until the encoder reports back enough turns, see solar.turn
+        Returns the encoder turns made
+        """
+        done, = await self._moves([(motor, direction, enc_turns)])
+        return done
+
+    async def slew(self, polar, dec):
+        """
+        Rotate the polar and declination axes together, see solar.adjust_both
+        polar, dec -- arcseconds to rotate each axis by
+        Returns the arcseconds (polar, dec) each axis turned
+        """
+        turns = [polar / self.mount.arcsec_per_enc, dec / self.mount.arcsec_per_enc]
+        done = await self._moves([(solar.Devices.body, solar._direction(turns[0]), abs(turns[0])),
+                                  (solar.Devices.mirror, solar._direction(turns[1]), abs(turns[1]))])
+        return tuple(math.copysign(d * self.mount.arcsec_per_enc, t) for d, t in zip(done, turns))
+
+    async def track(self, longitude, latitude, az, alt, controllers=None, interval=None):
+        """
+        Follow the Sun on both axes from the ephemeris until cancelled, as
+        solar_async.track_ephemeris does, offset by tune
+        longitude, latitude -- Site, in degrees
+        az, alt -- Where the telescope points now, in arcsec
+        controllers -- {motor: control.TrackController}, defaults to
+                       control.make_controllers
+        interval -- Seconds between moves, defaults to solar_async.track_interval
+        """
+        loop = asyncio.get_event_loop()
+        interval = interval or track_interval(self.mount)
+        ephemeris = EphemerisCache()
+        controllers = controllers or control.make_controllers(mount=self.mount)
+        for controller in controllers.values():
+            controller.reset()
+
+        def target(when):
+            s_az, s_alt = ephemeris.position(longitude, latitude, when)
+            ha, dec = transform.altaz_to_hadec(s_az + self.tune[0], s_alt + self.tune[1], latitude)
+            return float(ha), float(dec)
+
+        ha, dec = transform.altaz_to_hadec(az, alt, latitude)
+        enc_body, enc_mirror = await self.positions()
+        body = AxisTracker(solar.Devices.body, float(ha), enc_body, self)
+        mirror = AxisTracker(solar.Devices.mirror, float(dec), enc_mirror, self)
+        lead = interval / 2 + solar.SEC_PER_MOVE
+        start = last_update = next_move = loop.time()
+        commands = 0
+        self.publish(tracking=1)
+        try:
+            while True:
+                now_ha, now_dec = target(clock.time_now())
+                target_ha, target_dec = target(clock.time_now() + lead)
+                dt = loop.time() - last_update
+                last_update = loop.time()
+                body_direction, body_steps = body.steps_for(controllers[solar.Devices.body].update(
+                    now_ha - body.position, target_ha - now_ha, dt))
+                mirror_direction, mirror_steps = mirror.steps_for(controllers[solar.Devices.mirror].update(
+                    now_dec - mirror.position, target_dec - now_dec, dt))
+
+                if body_steps or mirror_steps:
+                    enc_body, enc_mirror = await self.step_both(body_direction, body_steps,
+                                                                mirror_direction, mirror_steps)
+                    commands += 1
+                    body.moved(body_direction, body_steps, enc_body)
+                    mirror.moved(mirror_direction, mirror_steps, enc_mirror)
+
+                now_ha, now_dec = target(clock.time_now())
+                az, alt = transform.hadec_to_altaz(body.position, mirror.position, latitude)
+                self.publish(az=float(az), alt=float(alt),
+                             track_error=math.hypot(now_ha - body.position, now_dec - mirror.position),
+                             commands_per_minute=commands / max((loop.time() - start) / 60., 1.))
+
+                # A move longer than the interval puts the next one off, as in track_ephemeris
+                next_move = max(next_move + interval, loop.time())
+                await asyncio.sleep(next_move - loop.time())
+        finally:
+            self.publish(tracking=0)
+
+
+async def _demo(args):
+    sim = simulator.Simulator(slip=args.slip, time_scale=args.time_scale)
+    sim.start()
+    telescope = AsyncTelescope(solar.SlewPlanner(chunk_steps=args.chunk_steps))
+    try:
+        await telescope.connect(*sim.address)
+
+        async def watch():
+            async for state in telescope.updates():
+                print('body {enc_body:8.0f} mirror {enc_mirror:8.0f}'.format(**state))
+
+        watching = asyncio.ensure_future(watch())
+        slew = asyncio.ensure_future(telescope.slew(args.polar, args.dec))
+        if args.cancel_after is not None:
+            await asyncio.sleep(args.cancel_after)
+            cancelled = clock.monotonic()
+            slew.cancel()
+            try:
+                await slew
+            except asyncio.CancelledError:
+                print('Slew cancelled in {:.0f}ms'.format((clock.monotonic() - cancelled) * 1000))
+        else:
+            print('Slewed {:.0f} {:.0f} arcsec'.format(*await slew))
+        watching.cancel()
+    finally:
+        await telescope.close()
+        sim.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Slew a simulated telescope with the asyncio client')
+    parser.add_argument('--polar', type=float, default=36000, help='arcsec to turn the polar axis')
+    parser.add_argument('--dec', type=float, default=-18000, help='arcsec to turn the declination axis')
+    parser.add_argument('--slip', type=float, default=0.02)
+    parser.add_argument('--time-scale', type=float, default=1.)
+    parser.add_argument('--chunk-steps', type=int, default=solar.MAX_STEPS_PER_COMMAND)
+    parser.add_argument('--cancel-after', type=float, help='seconds to cancel the slew after')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    asyncio.get_event_loop().run_until_complete(_demo(args))
@@ -3,13 +3,25 @@
 Library for interacting with the telescope in an asynchronous manner
 """
 from multiprocessing import Process, Pipe
-from datetime import datetime
 import math
 import solar
 import logging
+import os
 import time
 from functools import wraps
+from collections import OrderedDict
+import heapq
 from common import *
+from ephemeris import EphemerisCache
+from scheduler import DeadlineScheduler
+import clock
+from shared_state import SharedState
+import recorder
+import transform
+import control
+
+# Sun positions for the tracking and slewing loops, made by get_ephemeris_cache
+ephemeris_cache = None
 
 
 class Commands:
@@ -19,67 +31,314 @@ class Commands:
     SET_AZ, SET_ALT, SET_LAT, SET_LONG, \
         TRACK, CANCEL_TRACK, \
         TERMINATE, FINE_TUNE, \
-        SLEW_POLAR, SLEW_DEC, SLEW_TO_SUN, SET_ZERO, SET_SUN = range(13)
+        SLEW_POLAR, SLEW_DEC, SLEW_TO_SUN, SET_ZERO, SET_SUN, \
+        SLEW_BOTH, CANCEL_SLEW = range(15)
 
 
 class Responses:
     """
-    Repsonse codes for recieving data from the telescope thread
+    Repsonse codes for recieving data from the telescope thread. Positions
+    aren't sent, they are read from the SharedState
     """
-    SET_AZ, SET_ALT, SLEW_FINISHED = range(3)
+    SLEW_FINISHED, SLEW_CANCELLED = range(2)
 
 
-def slew_to_sun(properties):
+# Refinements of the slew time when working out where to meet the Sun
+INTERCEPT_ITERATIONS = 3
+# Close enough to the Sun to stop slewing, in encoder ticks
+SLEW_TOLERANCE_TICKS = 2
+# Give up catching up with the Sun after this many moves
+MAX_SLEW_MOVES = 10
+# Seconds the manager holds back a message of the same kind as one it just sent
+COALESCE_INTERVAL = 0.1
+
+
+def _slew_tolerance():
     """
-    Perform a slew to the suns location
+    Returns SLEW_TOLERANCE_TICKS in arcseconds on the mount being driven
+    """
+    return SLEW_TOLERANCE_TICKS * solar.get_telescope().mount.arcsec_per_enc
+
+
+def get_ephemeris_cache():
+    """
+    Returns the EphemerisCache for the tracking and slewing loops, making it on
+    first use. Its tables are kept on disk so a restart on the same day doesn't
+    recompute them, in ~/.cache/solar_drive or the directory named by the
+    SOLAR_DRIVE_CACHE environment variable, which can be set empty to keep
+    them in memory only
+    """
+    global ephemeris_cache
+    if ephemeris_cache is None:
+        directory = os.environ.get('SOLAR_DRIVE_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'solar_drive'))
+        ephemeris_cache = EphemerisCache(directory=directory or None)
+    return ephemeris_cache
+
+
+def _sun(properties, when):
+    return get_ephemeris_cache().position(properties.longitude, properties.latitude, when)
+
+
+def _slew_time(properties, az, alt, start_az, start_alt):
+    """
+    Estimated seconds to slew from start_az, start_alt to az, alt
+    """
+    polar, dec = transform.axis_offsets(az, alt, start_az, start_alt, properties.latitude)
+    telescope = solar.get_telescope()
+    return telescope.planner.duration(polar / telescope.mount.arcsec_per_enc, dec / telescope.mount.arcsec_per_enc)
+
+
+def intercept(properties, when):
+    """
+    Find where the Sun will be when a slew starting now would get there
+
+    properties - A TrackProperties object
+    when - POSIX seconds the slew starts at
+    Returns (az, alt) in arcseconds
+    """
+    s_az, s_alt = _sun(properties, when)
+    for i in range(INTERCEPT_ITERATIONS):
+        s_az, s_alt = _sun(properties, when + _slew_time(properties, s_az, s_alt, properties.az, properties.alt))
+    return s_az, s_alt
+
+
+def chase_moves(properties, when):
+    """
+    Estimate the moves a slew would take by going to where the Sun is now,
+    then chasing it for as long as it has moved too far in the meantime
 
     properties - A TrackProperties object
+    when - POSIX seconds the slew starts at
+    """
+    az, alt = properties.az, properties.alt
+    s_az, s_alt = _sun(properties, when)
+    moves = 0
+    while max(abs(s_az - az), abs(s_alt - alt)) > _slew_tolerance() and moves < MAX_SLEW_MOVES:
+        when += _slew_time(properties, s_az, s_alt, az, alt)
+        az, alt = s_az, s_alt
+        s_az, s_alt = _sun(properties, when)
+        moves += 1
+    return moves
+
+
+def slew_to(properties, az, alt):
     """
-    s_alt = sun_alt(properties.longitude, properties.latitude)
-    s_az = sun_az(properties.longitude, properties.latitude)
+    Slew the telescope to an azimuth and altitude, turning both axes together
+
+    Runs a move at a time, so the slew can be stopped between moves. While
+    it runs properties.az and alt follow where the telescope has got to, and
+    the fraction done is published as slew_progress.
 
-    logging.info('Sun at: {} {}'.format(az_to_str(s_az), alt_to_str(s_alt)))
+    properties - A TrackProperties object
+    az, alt -- Arc seconds to slew to
+    Yields the fraction done after each move
+    """
+    polar, dec = transform.axis_offsets(az, alt, properties.az, properties.alt, properties.latitude)
+    start_ha, start_dec = transform.altaz_to_hadec(properties.az, properties.alt, properties.latitude)
+    total = max(abs(polar), abs(dec))
+    for polar_done, dec_done in solar.slew_moves(float(polar), float(dec)):
+        p_az, p_alt = transform.hadec_to_altaz(start_ha + polar_done, start_dec + dec_done, properties.latitude)
+        properties.az, properties.alt = float(p_az), float(p_alt)
+        progress = min(max(abs(polar_done), abs(dec_done)) / total, 1.) if total else 1.
+        properties.publish(slew_progress=progress)
+        yield progress
+    properties.az, properties.alt = az, alt
+    properties.publish(slew_progress=1.)
 
-    solar.adjust_alt(s_alt - properties.alt)
-    properties.conn.send([Responses.SET_ALT, s_alt])
 
+def slew_to_sun(properties):
     """
-    As slewing can take a long time, might need to slew some more to catch
-    up with the Sun
+    Perform a slew to the suns location
+
+    Aims at where the Sun will be once the slew is done, as predicted from
+    the slew time, rather than where it is now, so the Sun should be met in
+    one move plus at most a correction. The moves taken, and how many fewer
+    that was than chasing the Sun would have taken, are published as
+    slew_moves and slew_saved
+
+    properties - A TrackProperties object
+    Yields the fraction of the current move done, see slew_to
     """
-    while abs(s_az - properties.az) > 2 * solar.ARCSEC_PER_ENC:
-        solar.adjust_alt(s_az - properties.az)
-        properties.az = s_az
-        properties.conn.send([Responses.SET_AZ, properties.az])
-        s_az = sun_az(properties.longitude, properties.latitude)
+    now = clock.time_now()
+    chase = chase_moves(properties, now)
+    s_az, s_alt = _sun(properties, now)
 
-    properties.conn.send([Responses.SLEW_FINISHED])
+    moves = 0
+    while max(abs(s_az - properties.az), abs(s_alt - properties.alt)) > _slew_tolerance() \
+            and moves < MAX_SLEW_MOVES:
+        if moves > 0:
+            recorder.active.record(recorder.Kinds.ERROR, solar.Devices.body,
+                                   error=(s_az - properties.az) / solar.get_telescope().mount.arcsec_per_enc)
+        s_az, s_alt = intercept(properties, now)
+        logging.info('Meeting Sun at: {} {}'.format(az_to_str(s_az), alt_to_str(s_alt)))
+        for progress in slew_to(properties, s_az, s_alt):
+            yield progress
+        moves += 1
+        properties.publish(slew_moves=moves)
+        now = clock.time_now()
+        s_az, s_alt = _sun(properties, now)
+
+    logging.info('Slew to Sun took {} moves, {} fewer than chasing it'.format(moves, chase - moves))
+    properties.publish(slew_moves=moves, slew_saved=chase - moves)
 
 
 def slew_az(properties, arcsec):
     """
-    Slew the azimuth of the telescope
+    Slew the azimuth of the telescope, see slew_to
 
     properties - A TrackProperties object
     arcsec -- Arc seconds to slew by
     """
-    solar.adjust_az(arcsec)
-    properties.az += arcsec
-    properties.conn.send([Responses.SET_AZ, properties.az])
-    properties.conn.send([Responses.SLEW_FINISHED])
+    return slew_to(properties, properties.az + arcsec, properties.alt)
 
 
 def slew_alt(properties, arcsec):
     """
-    Slew the altitude of the telescope
+    Slew the altitude of the telescope, see slew_to
 
     properties - A TrackProperties object
     arcsec -- Arc seconds to slew by
     """
-    solar.adjust_alt(arcsec)
-    properties.alt += arcsec
-    properties.conn.send([Responses.SET_ALT, properties.alt])
-    properties.conn.send([Responses.SLEW_FINISHED])
+    return slew_to(properties, properties.az, properties.alt + arcsec)
+
+
+def slew_both(properties, az, alt):
+    """
+    Slew the azimuth and altitude of the telescope at the same time, see slew_to
+
+    properties - A TrackProperties object
+    az, alt -- Arc seconds to slew each axis by
+    """
+    return slew_to(properties, properties.az + az, properties.alt + alt)
+
+
+def run(task):
+    """
+    Run a slew to the end without stopping
+    """
+    for _ in task:
+        pass
+
+
+class Priorities:
+    """
+    Order messages from the manager are acted on in, most urgent first
+    """
+    URGENT, NORMAL = range(2)
+
+
+# Messages acted on before anything else queued
+URGENT_COMMANDS = (Commands.TERMINATE, Commands.CANCEL_SLEW)
+# Messages that set a new target for the telescope, the latest replaces any others
+SLEW_COMMANDS = (Commands.SLEW_POLAR, Commands.SLEW_DEC, Commands.SLEW_BOTH, Commands.SLEW_TO_SUN)
+# Messages that stop a running slew
+STOP_COMMANDS = URGENT_COMMANDS + SLEW_COMMANDS + (Commands.CANCEL_TRACK,)
+# Messages that only matter for their latest value, a newer one replaces any waiting
+LATEST_COMMANDS = (Commands.FINE_TUNE, Commands.SET_LAT, Commands.SET_LONG, Commands.SET_AZ, Commands.SET_ALT)
+
+
+class MessageQueue(object):
+    """
+    Messages from the manager waiting to be acted on, most urgent first and
+    then in the order they arrived. A message of one of the LATEST_COMMANDS
+    replaces one of the same kind already waiting, counted in coalesced. It
+    takes the older one's place only if nothing has been queued behind it,
+    otherwise it goes to the back so it isn't acted on ahead of messages
+    sent before it.
+    """
+    def __init__(self):
+        self._heap = []
+        self._count = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, msg):
+        priority = Priorities.URGENT if msg[0] in URGENT_COMMANDS else Priorities.NORMAL
+        if msg[0] in LATEST_COMMANDS:
+            for i, (waiting_priority, count, waiting) in enumerate(self._heap):
+                if waiting[0] == msg[0]:
+                    self.coalesced += 1
+                    if count == max(entry[1] for entry in self._heap if entry[0] == waiting_priority):
+                        self._heap[i] = (waiting_priority, count, msg)
+                        return
+                    self._heap.pop(i)
+                    heapq.heapify(self._heap)
+                    break
+        heapq.heappush(self._heap, (priority, self._count, msg))
+        self._count += 1
+
+    def pop(self):
+        return heapq.heappop(self._heap)[2]
+
+    def receive(self, conn):
+        """
+        Queue every message waiting on the connection
+        """
+        while conn.poll():
+            self.push(conn.recv())
+
+    def take(self, commands):
+        """
+        Remove queued messages of some kinds, leaving the rest waiting
+        commands -- Commands to take
+        Returns the messages taken, in the order they would have been acted on
+        """
+        taken = sorted(entry for entry in self._heap if entry[2][0] in commands)
+        self._heap = [entry for entry in self._heap if entry[2][0] not in commands]
+        heapq.heapify(self._heap)
+        return [entry[2] for entry in taken]
+
+    def waiting(self, commands):
+        """
+        Whether any message of the given kinds is queued
+        """
+        return any(entry[2][0] in commands for entry in self._heap)
+
+
+def run_slew(properties, task):
+    """
+    Run a slew, checking for messages from the manager between moves
+
+    An urgent message or a new target stops the slew where it has got to,
+    so a stop waits at most one move, see solar.SlewPlanner.chunk_steps.
+    Only the newest of any queued targets is kept. Each slew ends with a
+    SLEW_FINISHED or SLEW_CANCELLED response.
+
+    properties - A TrackProperties object
+    task - Generator from slew_to, slew_to_sun etc
+    """
+    queue = properties.messages()
+    try:
+        for _ in task:
+            queue.receive(properties.conn)
+            if queue.waiting(STOP_COMMANDS):
+                task.close()
+                logging.info('Slew stopped at {} {}'.format(az_to_str(properties.az), alt_to_str(properties.alt)))
+                properties.conn.send([Responses.SLEW_CANCELLED, clock.monotonic()])
+                break
+        else:
+            properties.conn.send([Responses.SLEW_FINISHED])
+    except solar.ConnectionLost:
+        # The moves already made are in properties, the rest are abandoned
+        properties.publish()
+        properties.conn.send([Responses.SLEW_CANCELLED, clock.monotonic()])
+    # Older targets are dropped in favour of the newest
+    targets = queue.take(SLEW_COMMANDS)
+    for msg in targets[:-1]:
+        properties.conn.send([Responses.SLEW_CANCELLED, clock.monotonic()])
+    if targets:
+        queue.push(targets[-1])
+
+
+def track_interval(mount):
+    """
+    Seconds between tracking commands, as long as the mount's polar axis
+    takes to turn an encoder tick at the sidereal rate
+    """
+    return mount.steps_per_enc * mount.sec_per_step
 
 
 class TrackProperties:
@@ -89,126 +348,439 @@ class TrackProperties:
     longitude = 0
     tune_altitude = 0
     tune_azimuth = 0
-    connection = None
+    conn = None
+    state = None
+    controllers = None  # {motor: control.TrackController}, see control.load_controllers
+    queue = None
+
+    def messages(self):
+        """
+        The MessageQueue of messages from the manager waiting to be acted on
+        """
+        if self.queue is None:
+            self.queue = MessageQueue()
+        return self.queue
+
+    def publish(self, **values):
+        """
+        Share the current position, and any other fields given, with the manager
+        """
+        if self.queue is not None:
+            values.setdefault('messages_coalesced', self.queue.coalesced)
+        for name, value in solar.get_telescope().metrics().items():
+            values.setdefault(name, value)
+        self.state.write(az=self.az, alt=self.alt, **values)
+
+    def controller(self, motor):
+        """
+        The tracking controller for a motor, reset ready to start tracking
+        """
+        if self.controllers is None:
+            self.controllers = control.make_controllers(mount=solar.get_telescope().mount)
+        controller = self.controllers[motor]
+        controller.reset()
+        return controller
+
+
+def track_process(properties, duration=None):
+    """
+    Track the Sun by turning the polar axis at the sidereal rate
+
+    The polar axis turns in hour angle, so the declination stays put while
+    tracking and the azimuth and altitude published are worked out from the
+    hour angle the encoder reports.
+
+    The body axis' controller decides each batch from the encoder error
+    and the steps due at the sidereal rate, see control.
 
-def track_process(properties):
-    start = datetime.utcnow()
+    Steps are sent in batches of about an encoder tick's worth, which keeps
+    the controller busy for about a third of the time. Between batches the
+    process sleeps until the next batch is due on the monotonic clock, or
+    until a message arrives from the manager.
+
+    properties - A TrackProperties object
+    duration - Optional number of seconds to stop tracking after, otherwise
+               tracking continues until CANCEL_TRACK is received
+    """
+    scheduler = DeadlineScheduler(properties.conn)
+    controller = properties.controller(solar.Devices.body)
+    mount = solar.get_telescope().mount
+    batch_seconds = track_interval(mount)
+    start = clock.monotonic()
+    last_update = 0
     time_tracked = 0
-    enc_tracked = 0
-    enc_start = solar.current_position(solar.Devices.body)
-    start_az = properties.az
-    dt = 0
+    enc_start = solar.position(solar.Devices.body)
+    start_ha, dec = transform.altaz_to_hadec(properties.az, properties.alt, properties.latitude)
+    next_batch = start
+    # (az, alt, tune_azimuth, tune_altitude) a fine tune is still to reach
+    tune = None
+    enc_before = None
+    properties.publish(tracking=1, enc_body=enc_start)
 
     while True:
-        # Process any available messages
-        while properties.conn.poll():
-            msg = properties.conn.recv()
-            cmd, args = msg[0], msg[1:]
+        if scheduler.wait_until(next_batch):
+            # Process any available messages, only the latest fine tune is acted on
+            queue = properties.messages()
+            queue.receive(properties.conn)
+            for msg in queue.take((Commands.CANCEL_TRACK, Commands.FINE_TUNE)):
+                cmd, args = msg[0], msg[1:]
 
-            if cmd == Commands.CANCEL_TRACK:
+                if cmd == Commands.CANCEL_TRACK:
+                    scheduler.log_stats()
+                    properties.publish(tracking=0)
+                    return
+                elif cmd == Commands.FINE_TUNE:
+                    # Made before the next batch, kept as a target so a tune
+                    # cut short by a lost connection carries on from where it got to
+                    if tune is None:
+                        tune = (properties.az, properties.alt, properties.tune_azimuth, properties.tune_altitude)
+                    az, alt, tune_azimuth, tune_altitude = tune
+                    tune = (az + args[0][0] - tune_azimuth, alt + args[0][1] - tune_altitude,
+                            args[0][0], args[0][1])
+                    next_batch = clock.monotonic()
+            if queue.waiting((Commands.TERMINATE,)):
+                scheduler.log_stats()
+                properties.publish(tracking=0)
                 return
-            elif cmd == Commands.FINE_TUNE:
-                tune_azimuth = args[0][0]
-                tune_altitude = args[0][0]
-                if properties.tune_azimuth != tune_azimuth:
-                    print('SLEW_AZ')
-                    slew_az(properties, tune_azimuth - properties.tune_azimuth)
-                if properties.tune_altitude != tune_altitude:
-                    print('SLEW_ALT')
-                    slew_alt(properties, tune_altitude - properties.tune_altitude)
-            else:
-                raise NotImplementedError
+            continue
 
         # Now do tracking
-        now = datetime.utcnow()
-        dt = (now - start).total_seconds()
-        enc_expected = dt / solar.SEC_PER_ENC + properties.tune_azimuth * solar.ARCSEC_PER_ENC
-        enc_error = math.floor(enc_expected - enc_tracked)
-        turns = math.floor((dt - time_tracked) * (1. / solar.SEC_PER_STEP))
-
-        # Check encoders report the position we expect, otherwise compensate
-        if enc_error > 1:
-            # Large slip, so attempt to catch up
-            turns += (enc_error - 1) * solar.STEPS_PER_ENC
-        elif enc_error > 0:
-            # Small error, could be as little as one microstep so add small slip factor to catch up
-            turns += solar.SLIP_FACTOR
-        elif enc_error < 0:
-            time.sleep(solar.SEC_PER_STEP * solar.SLIP_FACTOR)
-            turns = 0
-
-        if turns > 0:
-            solar.Telescope().send_command('T{}{}{}'.format(solar.Devices.body, solar.Directions.clockwise, int(turns)))
-            enc_tracked = int(solar.Telescope().readline()) - enc_start
-            logging.debug('Micro Steps: {:5.2f} Encoder Error: {}'.format(turns, int(enc_error)))
-            properties.az = start_az + enc_tracked * solar.ARCSEC_PER_ENC
-            properties.conn.send([Responses.SET_AZ, properties.az])
-        else:
-            time.sleep(solar.SEC_PER_STEP)
+        if tune is not None:
+            try:
+                if enc_before is None:
+                    enc_before = solar.position(solar.Devices.body)
+                run(slew_to(properties, tune[0], properties.alt))
+                run(slew_to(properties, properties.az, tune[1]))
+                enc = solar.position(solar.Devices.body)
+            except solar.ConnectionLost:
+                # Tried again once reconnected, the moves made are in properties
+                properties.publish()
+                next_batch = clock.monotonic() + batch_seconds
+                continue
+            properties.tune_azimuth, properties.tune_altitude = tune[2], tune[3]
+            # The tune slews turned the polar axis as well, which the
+            # sidereal rate carries on from rather than undoing
+            enc_start += enc - enc_before
+            ha, dec = transform.altaz_to_hadec(properties.az, properties.alt, properties.latitude)
+            start_ha = ha - (enc - enc_start) * mount.arcsec_per_enc
+            tune = enc_before = None
+
+        dt = clock.monotonic() - start
+        if duration is not None and dt >= duration:
+            scheduler.log_stats()
+            properties.publish(tracking=0)
+            return
+        enc_expected = dt / mount.sec_per_enc
+        try:
+            # The encoder count is rounded down, so the axis is half a tick on from it on average
+            enc_error = enc_expected - (solar.position(solar.Devices.body) - enc_start) - 0.5
+            steps_due = math.floor((dt - time_tracked) / mount.sec_per_step)
+            move = controller.update(enc_error * mount.arcsec_per_enc, steps_due * mount.arcsec_per_step,
+                                     dt - last_update)
+            turns = max(math.floor(move / mount.arcsec_per_step), 0)
+            last_update = dt
+
+            recorder.active.record(recorder.Kinds.ERROR, solar.Devices.body, error=enc_error)
+
+            if turns > 0:
+                enc = solar.step(solar.Devices.body, solar.Directions.clockwise, turns)
+                logging.debug('Micro Steps: {:5.2f} Encoder Error: {:.1f}'.format(turns, enc_error))
+                az, alt = transform.hadec_to_altaz(start_ha + (enc - enc_start) * mount.arcsec_per_enc, dec,
+                                                   properties.latitude)
+                properties.az, properties.alt = float(az), float(alt)
+                properties.publish(enc_body=enc)
+        except solar.ConnectionLost:
+            # Carry on once reconnected, the encoder error makes up for the batches missed
+            properties.publish()
+            next_batch = clock.monotonic() + batch_seconds
+            continue
+
+        time_tracked += steps_due * mount.sec_per_step
+        next_batch = start + time_tracked + batch_seconds
+
+
+# Encoder ticks' worth of steps sent one way between each update of the
+# planner's steps per tick
+TRACK_LEARN_TICKS = 100
+
+
+class TrackModes:
+    """
+    Ways of tracking the Sun
+    SIDEREAL -- Turn the polar axis at a constant rate, see track_process
+    EPHEMERIS -- Follow the ephemeris on both axes, see track_ephemeris
+    """
+    SIDEREAL, EPHEMERIS = range(2)
+
+
+class AxisTracker(object):
+    """
+    Estimate of the angle one mount axis is at, finer than the encoder
+
+    Steps sent are added on at the ticks per step the planner has learnt for
+    the axis, and the estimate is kept inside the encoder tick last reported.
+    While tracking, long runs of steps one way are fed back to the planner.
+
+    motor -- solar.Devices motor turning the axis
+    origin -- Axis angle in arcsec when the encoder reads enc_origin
+    enc_origin -- Encoder count at origin
+    telescope -- Anything with the planner and mount of the axis, defaults to
+                 the active solar.Telescope
+    """
+    def __init__(self, motor, origin, enc_origin, telescope=None):
+        telescope = telescope or solar.get_telescope()
+        self.planner = telescope.planner
+        self.mount = telescope.mount
+        self.motor = motor
+        self.origin = origin
+        self.enc_origin = enc_origin
+        self.position = origin
+        self.count = enc_origin
+        self._direction = None
+        self._steps = 0
+        self._enc = enc_origin
+
+    def arcsec_per_step(self, direction):
+        return self.planner.ratio(self.motor, direction) * self.mount.arcsec_per_enc
+
+    def steps_for(self, move):
+        """
+        Returns (direction, steps) to turn by to move by arcsec
+        """
+        direction = solar.Directions.clockwise if move >= 0 else solar.Directions.anti_clockwise
+        steps = int(round(abs(move) / self.arcsec_per_step(direction)))
+        return direction, min(steps, solar.MAX_STEPS_PER_COMMAND)
+
+    def moved(self, direction, steps, count):
+        """
+        Update the estimate after a turn
+        direction, steps -- Turn sent
+        count -- Encoder count reported after it
+        """
+        sign = 1 if direction == solar.Directions.clockwise else -1
+        self.position += sign * steps * self.arcsec_per_step(direction)
+        low = self.origin + (count - self.enc_origin) * self.mount.arcsec_per_enc
+        self.position = min(max(self.position, low), low + self.mount.arcsec_per_enc)
+
+        previous, self.count = self.count, count
+        if steps == 0:
+            return
+        if direction != self._direction:
+            self._direction, self._steps, self._enc = direction, 0, previous
+        self._steps += steps
+        if self._steps >= TRACK_LEARN_TICKS * self.mount.steps_per_enc:
+            self.planner.learn(self.motor, direction, self._steps, abs(count - self._enc))
+            self._steps, self._enc = 0, count
+
+
+def track_target(properties, when):
+    """
+    Where the mount should point to follow the Sun, including any fine tuning
+
+    properties - A TrackProperties object
+    when - POSIX seconds
+    Returns (hour angle, declination) in arcseconds
+    """
+    s_az, s_alt = _sun(properties, when)
+    ha, dec = transform.altaz_to_hadec(s_az + properties.tune_azimuth, s_alt + properties.tune_altitude,
+                                       properties.latitude)
+    return float(ha), float(dec)
+
+
+def track_ephemeris(properties, duration=None):
+    """
+    Track the Sun on both axes by following the ephemeris
+
+    Every track_interval the hour angle and declination the Sun will have
+    half an interval after the move is done are worked out. The change from
+    where it is now is the feedforward move for each axis' controller, see
+    control, and both motors are sent the steps decided on in one command.
+    The error against the ephemeris and the
+    commands per minute are published as track_error and
+    commands_per_minute.
+
+    properties - A TrackProperties object
+    duration - Optional number of seconds to stop tracking after, otherwise
+               tracking continues until CANCEL_TRACK is received
+    """
+    scheduler = DeadlineScheduler(properties.conn)
+    start = clock.monotonic()
+    ha, dec = transform.altaz_to_hadec(properties.az, properties.alt, properties.latitude)
+    enc_body, enc_mirror = solar.positions()
+    body = AxisTracker(solar.Devices.body, float(ha), enc_body)
+    mirror = AxisTracker(solar.Devices.mirror, float(dec), enc_mirror)
+    interval = track_interval(body.mount)
+    lead = interval / 2 + solar.SEC_PER_MOVE
+    body_control = properties.controller(solar.Devices.body)
+    mirror_control = properties.controller(solar.Devices.mirror)
+    last_update = 0
+    commands = 0
+    next_batch = start
+    properties.publish(tracking=1, enc_body=enc_body, enc_mirror=enc_mirror)
+
+    while True:
+        if scheduler.wait_until(next_batch):
+            queue = properties.messages()
+            queue.receive(properties.conn)
+            for msg in queue.take((Commands.CANCEL_TRACK, Commands.FINE_TUNE)):
+                cmd, args = msg[0], msg[1:]
 
-        time_tracked = dt
-        
+                if cmd == Commands.CANCEL_TRACK:
+                    scheduler.log_stats()
+                    properties.publish(tracking=0)
+                    return
+                elif cmd == Commands.FINE_TUNE:
+                    # The next command moves to the tuned target
+                    properties.tune_azimuth, properties.tune_altitude = args[0][0], args[0][1]
+                    next_batch = clock.monotonic()
+            if queue.waiting((Commands.TERMINATE,)):
+                scheduler.log_stats()
+                properties.publish(tracking=0)
+                return
+            continue
+
+        dt = clock.monotonic() - start
+        if duration is not None and dt >= duration:
+            scheduler.log_stats()
+            properties.publish(tracking=0)
+            return
+
+        now_ha, now_dec = track_target(properties, clock.time_now())
+        target_ha, target_dec = track_target(properties, clock.time_now() + lead)
+        body_direction, body_steps = body.steps_for(
+            body_control.update(now_ha - body.position, target_ha - now_ha, dt - last_update))
+        mirror_direction, mirror_steps = mirror.steps_for(
+            mirror_control.update(now_dec - mirror.position, target_dec - now_dec, dt - last_update))
+        last_update = dt
+
+        if body_steps or mirror_steps:
+            try:
+                enc_body, enc_mirror = solar.step_both(body_direction, body_steps, mirror_direction, mirror_steps)
+            except solar.ConnectionLost:
+                # Whether the move was made shows in the encoders once reconnected
+                properties.publish()
+                next_batch = max(next_batch + interval, clock.monotonic())
+                continue
+            commands += 1
+            body.moved(body_direction, body_steps, enc_body)
+            mirror.moved(mirror_direction, mirror_steps, enc_mirror)
+
+        now_ha, now_dec = track_target(properties, clock.time_now())
+        recorder.active.record(recorder.Kinds.ERROR, solar.Devices.body,
+                               error=(now_ha - body.position) / body.mount.arcsec_per_enc)
+        recorder.active.record(recorder.Kinds.ERROR, solar.Devices.mirror,
+                               error=(now_dec - mirror.position) / mirror.mount.arcsec_per_enc)
+        az, alt = transform.hadec_to_altaz(body.position, mirror.position, properties.latitude)
+        properties.az, properties.alt = float(az), float(alt)
+        properties.publish(enc_body=enc_body, enc_mirror=enc_mirror,
+                           track_error=math.hypot(now_ha - body.position, now_dec - mirror.position),
+                           commands_per_minute=commands / max(dt / 60., 1.))
 
-def thread_process(conn):
+        # A move longer than the interval puts the next one off rather than
+        # leaving the deadlines behind for good
+        next_batch = max(next_batch + interval, clock.monotonic())
+
+
+def thread_process(conn, state, address=None, record_dir=None, gains_file=None, mount=None, version=None):
     """
     This is the program that runs on the seperate thread to communicate with the telsescope
 
+    conn -- Pipe connection to the TelescopeManager
+    state -- SharedState to publish the telescope position in
+    address -- Optional (ip, port) to connect to instead of solar.arduino
+    record_dir -- Optional directory to record sessions in, see recorder
+    gains_file -- Optional tracking gains file, defaults to control.CONFIG_PATH
+    mount -- Optional solar.Mount config dict, defaults to solar's constants
+    version -- Optional protocol version, 1 for legacy firmware, see solar.connect
+
     Alogrigthm:
 
     1. Connect to telescope
     2. Wait for any commands
-    3. Perform command actions
+    3. Perform command actions, checking for more commands between the moves
+       of a slew, see run_slew
     4. GOTO 2
     """
-    solar.connect()
+    solar.set_telescope(solar.Telescope(solar.Mount(**(mount or {}))))
+    solar.connect(*(address or ()), version=version)
     solar.log_constants()
 
     properties = TrackProperties()
     properties.conn = conn
+    properties.state = state
+    properties.controllers = control.load_controllers(gains_file, solar.get_telescope().mount)
+    if record_dir is not None:
+        recorder.start_session(record_dir)
+    properties.publish()
 
+    queue = properties.messages()
     while True:
-        msg = conn.recv()
+        if not queue:
+            # Keep an eye on the connection while idle
+            while not conn.poll(solar.HEARTBEAT_INTERVAL):
+                solar.heartbeat()
+                properties.publish()
+            queue.push(conn.recv())
+        queue.receive(conn)
+        msg = queue.pop()
         cmd, args = msg[0], msg[1:]
 
-        if cmd == Commands.TERMINATE:
-            return
-        elif cmd == Commands.SLEW_TO_SUN:
-            slew_to_sun(properties)
-        elif cmd == Commands.SLEW_POLAR:
-            arcsec = args[0]
-            slew_az(properties, arcsec)
-        elif cmd == Commands.SLEW_DEC:
-            arcsec = args[0]
-            slew_alt(properties, arcsec)
-        elif cmd == Commands.SET_LAT:
-            properties.latitude = args[0]
-        elif cmd == Commands.SET_LONG:
-            properties.longitude = args[0]
-        elif cmd == Commands.SET_AZ:
-            properties.az = args[0]
-        elif cmd == Commands.SET_ALT:
-            properties.alt = args[0]
-        elif cmd == Commands.FINE_TUNE:
-            properties.tune_azimuth = args[0][0]
-            properties.tune_altitude = args[0][1]
-        elif cmd == Commands.SET_ZERO:
-            logging.info('Setting as zero')
-            solar.reset_zero()
-            conn.send([Responses.SET_AZ, 0])
-            conn.send([Responses.SET_ALT, 0])
-            properties.az = 0
-            properties.alt = 0
-        elif cmd == Commands.SET_SUN:
-            logging.info('Setting as Sun Position')
-            solar.reset_zero()
-            properties.az = sun_az(properties.longitude, properties.latitude)
-            properties.alt = sun_alt(properties.longitude, properties.latitude)
-            conn.send([Responses.SET_AZ, properties.az])
-            conn.send([Responses.SET_ALT, properties.alt])
-        elif cmd == Commands.TRACK:
-            track_process(properties)
-        else:
-            raise NotImplementedError
+        try:
+            if cmd == Commands.TERMINATE:
+                recorder.stop_session()
+                return
+            elif cmd in (Commands.CANCEL_SLEW, Commands.CANCEL_TRACK):
+                # Nothing running to stop
+                pass
+            elif cmd == Commands.SLEW_TO_SUN:
+                run_slew(properties, slew_to_sun(properties))
+            elif cmd == Commands.SLEW_POLAR:
+                arcsec = args[0]
+                run_slew(properties, slew_az(properties, arcsec))
+            elif cmd == Commands.SLEW_DEC:
+                arcsec = args[0]
+                run_slew(properties, slew_alt(properties, arcsec))
+            elif cmd == Commands.SLEW_BOTH:
+                run_slew(properties, slew_both(properties, args[0], args[1]))
+            elif cmd == Commands.SET_LAT:
+                properties.latitude = args[0]
+            elif cmd == Commands.SET_LONG:
+                properties.longitude = args[0]
+            elif cmd == Commands.SET_AZ:
+                properties.az = args[0]
+                properties.publish()
+            elif cmd == Commands.SET_ALT:
+                properties.alt = args[0]
+                properties.publish()
+            elif cmd == Commands.FINE_TUNE:
+                properties.tune_azimuth = args[0][0]
+                properties.tune_altitude = args[0][1]
+            elif cmd == Commands.SET_ZERO:
+                logging.info('Setting as zero')
+                solar.reset_zero()
+                properties.az = 0
+                properties.alt = 0
+                properties.publish(enc_body=0, enc_mirror=0)
+            elif cmd == Commands.SET_SUN:
+                logging.info('Setting as Sun Position')
+                solar.reset_zero()
+                properties.az = sun_az(properties.longitude, properties.latitude)
+                properties.alt = sun_alt(properties.longitude, properties.latitude)
+                properties.publish(enc_body=0, enc_mirror=0)
+            elif cmd == Commands.TRACK:
+                if record_dir is not None:
+                    # Each tracking run gets a session of its own
+                    recorder.start_session(record_dir)
+                if args and args[0] == TrackModes.SIDEREAL:
+                    track_process(properties)
+                else:
+                    track_ephemeris(properties)
+            else:
+                raise NotImplementedError
+        except solar.ConnectionLost as e:
+            # Give up on the command, the next one reconnects
+            logging.warning('Abandoned {}: {}'.format(msg, e))
+            properties.publish(tracking=0)
 
 
 class TelescopeManager(Process):
@@ -240,60 +812,151 @@ class TelescopeManager(Process):
                 return None
         return _not_tracking
 
-    def __init__(self):
+    def __init__(self, address=None, record_dir=None, gains_file=None, mount=None, version=None):
+        """
+        address -- Optional (ip, port) of the arduino, such as a local simulator
+        record_dir -- Optional directory to record telemetry sessions in
+        gains_file -- Optional tracking gains file, see control
+        mount -- Optional solar.Mount config dict for a mount geared differently
+        version -- Optional protocol version the firmware speaks, 1 for legacy
+                   firmware to save NEGOTIATE_TIMEOUT waiting for it not to
+                   answer, None to ask
+        """
         self.conn, child_conn = Pipe()
-        super(TelescopeManager, self).__init__(target=thread_process, args=(child_conn,))
-        self._az = 0
-        self._alt = 0
+        self.state = SharedState(notify=True)
+        super(TelescopeManager, self).__init__(target=thread_process,
+                                               args=(child_conn, self.state, address, record_dir, gains_file,
+                                                     mount, version))
         self._longitude = 0
         self._latitude = 0
         self.commands_running = 0
         self.tracking = False
+        # Seconds from asking for a running slew to stop to it stopping
+        self.stop_latencies = []
+        self._stop_requested = None
+        # Messages held back by _send_latest, and how many each kind replaced
+        self._held = OrderedDict()
+        self._last_sent = {}
+        self.coalesced = {}
+
+    @property
+    def messages_coalesced(self):
+        """
+        Messages replaced by a newer one of the same kind before being acted
+        on, here and in the worker's queue
+        """
+        return sum(self.coalesced.values()) + int(self.state['messages_coalesced'])
+
+    @property
+    def link(self):
+        """
+        Quality of the worker's connection to the arduino, see solar.Telescope.metrics
+        """
+        state = self.state.snapshot()
+        return dict((name, state[name]) for name in ('link_up', 'link_rtt', 'link_reconnects'))
+
+    def _send(self, msg):
+        """
+        Send a message to the worker, after any held back so they keep their order
+        """
+        self._send_held()
+        self.conn.send(msg)
+
+    def _send_latest(self, msg):
+        """
+        Send a message of one of the LATEST_COMMANDS. One sent less than
+        COALESCE_INTERVAL after another of its kind is held back until the
+        next flush_messages or _send, replacing any already held
+        """
+        cmd = msg[0]
+        if cmd in self._held:
+            self.coalesced[cmd] = self.coalesced.get(cmd, 0) + 1
+            self._held[cmd] = msg
+        elif clock.monotonic() - self._last_sent.get(cmd, -COALESCE_INTERVAL) < COALESCE_INTERVAL:
+            self._held[cmd] = msg
+        else:
+            self._send(msg)
+            self._last_sent[cmd] = clock.monotonic()
+
+    def held_for(self):
+        """
+        Returns seconds until messages held back by _send_latest are due to
+        go with the next flush_messages, or None if none are held
+        """
+        if not self._held:
+            return None
+        due = min(self._last_sent.get(cmd, 0) for cmd in self._held) + COALESCE_INTERVAL
+        return max(due - clock.monotonic(), 0.)
+
+    def _send_held(self):
+        held, self._held = self._held, OrderedDict()
+        for cmd, msg in held.items():
+            self.conn.send(msg)
+            self._last_sent[cmd] = clock.monotonic()
+
+    def _request_stop(self):
+        """
+        Note the time a message that stops a running slew was sent
+        """
+        if self.commands_running > 0 and self._stop_requested is None:
+            self._stop_requested = clock.monotonic()
 
     def join(self, timeout=15):
         """
         Finish the thread and perform any cleanup
         """
         if self.tracking:
-            self.conn.send([Commands.CANCEL_TRACK])
-        self.conn.send([Commands.TERMINATE])
+            self._send([Commands.CANCEL_TRACK])
+        self._request_stop()
+        self._send([Commands.TERMINATE])
         super(TelescopeManager, self).join(timeout=timeout)
         while self.commands_running > 0:
             self.flush_messages()
 
     def flush_messages(self):
         """
-        Call to process any messages recieved from the telescope command thread
+        Call to process any messages recieved from the telescope command
+        thread, and to send any held back
         """
+        self._send_held()
         while self.conn.poll():
-            msg = self.conn.recv()
+            try:
+                msg = self.conn.recv()
+            except EOFError:
+                # The telescope process has exited, so nothing else will finish
+                self.commands_running = 0
+                return
             res, args = msg[0], msg[1:]
             if res == Responses.SLEW_FINISHED:
                 self.commands_running -= 1
-            elif res == Responses.SET_AZ:
-                self._az = args[0]
-            elif res == Responses.SET_ALT:
-                self._alt = args[0]
+            elif res == Responses.SLEW_CANCELLED:
+                self.commands_running -= 1
+                if self._stop_requested is not None:
+                    # Both processes share the system's monotonic clock
+                    self.stop_latencies.append(args[0] - self._stop_requested)
+                    logging.info('Slew stopped {:.0f}ms after being asked to'.format(
+                        self.stop_latencies[-1] * 1000))
+                    self._stop_requested = None
             else:
                 raise NotImplementedError
+            if self.commands_running == 0:
+                self._stop_requested = None
 
     @property
     def az(self):
-        return self._az
+        return self.state['az']
 
     @az.setter
     def az(self, az):
-        self._az = az
-        self.conn.send([Commands.SET_AZ, az])
+        self._send_latest([Commands.SET_AZ, az])
 
     @property
     def alt(self):
-        return self._alt
+        return self.state['alt']
 
     @alt.setter
     def alt(self, dec):
-        self._alt = dec
-        self.conn.send([Commands.SET_ALT, dec])
+        self._send_latest([Commands.SET_ALT, dec])
 
     @property
     def longitude(self):
@@ -304,7 +967,7 @@ class TelescopeManager(Process):
     @not_tracking
     def longitude(self, longitude):
         self._longitude = longitude
-        self.conn.send([Commands.SET_LONG, longitude])
+        self._send_latest([Commands.SET_LONG, longitude])
 
     @property
     def latitude(self):
@@ -315,50 +978,61 @@ class TelescopeManager(Process):
     @not_tracking
     def latitude(self, latitude):
         self._latitude = latitude
-        self.conn.send([Commands.SET_LAT, latitude])
+        self._send_latest([Commands.SET_LAT, latitude])
 
     @not_slewing
     @not_tracking
     def slew_az(self, arcsec):
         self.commands_running += 1
-        self.conn.send([Commands.SLEW_POLAR, arcsec])
+        self._send([Commands.SLEW_POLAR, arcsec])
 
     @not_slewing
     @not_tracking
     def slew_alt(self, arcsec):
         self.commands_running += 1
-        self.conn.send([Commands.SLEW_DEC, arcsec])
+        self._send([Commands.SLEW_DEC, arcsec])
 
     @not_tracking
     def slew_to_sun(self):
+        self._request_stop()
         self.commands_running += 1
-        self.conn.send([Commands.SLEW_TO_SUN])
+        self._send([Commands.SLEW_TO_SUN])
 
     @not_tracking
     def return_to_zero(self):
         logging.info('Returning to zero')
+        self._request_stop()
         self.commands_running += 1
-        self.conn.send([Commands.SLEW_POLAR, -self._az])
-        self.commands_running += 1
-        self.conn.send([Commands.SLEW_DEC, -self._alt])
+        self._send([Commands.SLEW_BOTH, -self.az, -self.alt])
+
+    def cancel_slew(self):
+        """
+        Stop any slew where it has got to, and drop any waiting
+        """
+        self._request_stop()
+        self._send([Commands.CANCEL_SLEW])
 
     def tune(self, tune):
-        self.conn.send([Commands.FINE_TUNE, tune])
+        self._send_latest([Commands.FINE_TUNE, tune])
 
     def set_zero(self):
-        self.conn.send([Commands.SET_ZERO])
+        self._send([Commands.SET_ZERO])
 
     def set_sun(self):
-        self.conn.send([Commands.SET_SUN])
+        self._send([Commands.SET_SUN])
 
     @not_tracking
-    def start_tracking(self):
+    def start_tracking(self, mode=TrackModes.EPHEMERIS):
+        """
+        mode -- One of TrackModes
+        """
         self.tracking = True
-        self.conn.send([Commands.TRACK])
+        self._send([Commands.TRACK, mode])
 
     def stop_tracking(self):
         self.tracking = False
-        self.conn.send([Commands.CANCEL_TRACK])
+        self._request_stop()
+        self._send([Commands.CANCEL_TRACK])
 
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.DEBUG)
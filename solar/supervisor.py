@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Drive several telescopes from one machine, each from a worker process of its own
+
+Every telescope gets a solar_async.TelescopeManager, so its connection,
+gearing and tracking live in a separate process and the workers run across
+the CPU cores. The telescopes are listed in a JSON file:
+
+    {"west": {"ip": "192.168.2.2", "port": 8010, "longitude": -3.18, "latitude": 51.48},
+     "east": {"ip": "192.168.2.3", "port": 8010, "longitude": -3.18, "latitude": 51.48,
+              "mount": {"gear_ratio": 4.0, "micro_steps": 32}, "protocol": 1}}
+
+where mount holds solar.Mount arguments for a telescope geared differently
+from the default, protocol is the version its firmware speaks, asked of the
+firmware if not given, and
+
+    python solar/supervisor.py telescopes.json
+
+starts them all and prints their combined status every few seconds,
+restarting any worker that dies. To load test against simulated controllers:
+
+    python solar/supervisor.py --load-test 8 --duration 120
+
+which starts each simulator in a process of its own, tracks the Sun on every
+telescope at once and reports the tracking error, command rate and round
+trip times of each.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import simulator
+from solar_async import TelescopeManager, TrackModes
+
+CARDIFF = (-3.18, 51.48)
+# Seconds between status reports
+STATUS_INTERVAL = 5.
+
+
+class Supervisor(object):
+    """
+    Runs a TelescopeManager for each telescope
+
+    telescopes -- {name: config}, config holding ip, port and optionally
+                  longitude, latitude, mount and protocol, see the module
+                  docstring
+    record_dir -- Optional directory to record sessions in, each telescope
+                  recording in a directory of its name under it
+    gains_file -- Optional tracking gains file, see control
+    pin -- Pin each worker to a CPU core of its own, where the OS allows
+    """
+    def __init__(self, telescopes, record_dir=None, gains_file=None, pin=True):
+        self.telescopes = telescopes
+        self.record_dir = record_dir
+        self.gains_file = gains_file
+        self.pin = pin
+        self.managers = {}
+        self.restarts = dict((name, 0) for name in telescopes)
+
+    def __getitem__(self, name):
+        return self.managers[name]
+
+    def _start(self, index, name):
+        config = self.telescopes[name]
+        record_dir = os.path.join(self.record_dir, name) if self.record_dir else None
+        manager = TelescopeManager((config['ip'], config['port']), record_dir, self.gains_file,
+                                   config.get('mount'), config.get('protocol'))
+        manager.start()
+        if self.pin and hasattr(os, 'sched_setaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+            os.sched_setaffinity(manager.pid, [cores[index % len(cores)]])
+        if 'longitude' in config:
+            manager.longitude = config['longitude']
+        if 'latitude' in config:
+            manager.latitude = config['latitude']
+        self.managers[name] = manager
+        logging.info('Started {} on {}:{}, pid {}'.format(name, config['ip'], config['port'], manager.pid))
+
+    def start(self):
+        for index, name in enumerate(sorted(self.telescopes)):
+            self._start(index, name)
+
+    def check(self):
+        """
+        Restart any worker that has died
+        Returns the names restarted
+        """
+        restarted = []
+        for index, name in enumerate(sorted(self.managers)):
+            if not self.managers[name].is_alive():
+                logging.warning('Worker for {} died with exit code {}, restarting'.format(
+                    name, self.managers[name].exitcode))
+                self.restarts[name] += 1
+                self._start(index, name)
+                restarted.append(name)
+        return restarted
+
+    def status(self):
+        """
+        Returns {name: state} with each telescope's shared state, see
+        shared_state.SharedState, and whether its worker is alive
+        """
+        status = {}
+        for name, manager in self.managers.items():
+            manager.flush_messages()
+            state = manager.state.snapshot()
+            state.update(alive=manager.is_alive(), restarts=self.restarts[name])
+            status[name] = state
+        return status
+
+    def summary(self, status=None):
+        """
+        Combine the status of every telescope
+        Returns a dict of counts, worst figures and means
+        """
+        status = status or self.status()
+        states = list(status.values())
+        rtts = [state['link_rtt'] for state in states if state['link_up']]
+        return {
+            'telescopes': len(states),
+            'alive': sum(1 for state in states if state['alive']),
+            'link_up': sum(1 for state in states if state['link_up']),
+            'tracking': sum(1 for state in states if state['tracking']),
+            'restarts': sum(state['restarts'] for state in states),
+            'reconnects': sum(state['link_reconnects'] for state in states),
+            'max_track_error': max([state['track_error'] for state in states if state['tracking']] or [0.]),
+            'mean_link_rtt': sum(rtts) / len(rtts) if rtts else 0.,
+            'max_link_rtt': max(rtts or [0.]),
+            'commands_per_minute': sum(state['commands_per_minute'] for state in states if state['tracking']),
+        }
+
+    def stop(self):
+        for manager in self.managers.values():
+            manager.join()
+
+
+def _serve_simulator(addresses, stop, kwargs):
+    sim = simulator.Simulator(**kwargs)
+    sim.start()
+    addresses.put(sim.address)
+    stop.wait()
+    sim.stop()
+
+
+def load_test(count, duration, slip=0.02, interval=STATUS_INTERVAL):
+    """
+    Track the Sun on count simulated telescopes at once
+    count -- Number of telescopes, each with its simulator in its own process
+    duration -- Seconds to track for
+    Returns {'summary': combined status at the end, 'telescopes': {name: figures}}
+    """
+    addresses = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    simulators = [multiprocessing.Process(target=_serve_simulator,
+                                          args=(addresses, stop, {'slip': slip, 'seed': i}))
+                  for i in range(count)]
+    for process in simulators:
+        process.daemon = True
+        process.start()
+    telescopes = {}
+    for i in range(count):
+        ip, port = addresses.get(timeout=30)
+        telescopes['sim{:02d}'.format(i)] = {'ip': ip, 'port': port,
+                                            'longitude': CARDIFF[0], 'latitude': CARDIFF[1]}
+
+    supervisor = Supervisor(telescopes)
+    supervisor.start()
+    try:
+        for manager in supervisor.managers.values():
+            manager.set_sun()
+            manager.start_tracking(TrackModes.EPHEMERIS)
+        peaks = dict((name, 0.) for name in telescopes)
+        rtts = dict((name, 0.) for name in telescopes)
+        start = time.time()
+        while time.time() - start < duration:
+            time.sleep(min(interval, max(duration - (time.time() - start), 0)))
+            supervisor.check()
+            status = supervisor.status()
+            for name, state in status.items():
+                peaks[name] = max(peaks[name], state['track_error'])
+                rtts[name] = max(rtts[name], state['link_rtt'])
+            logging.info('{:.0f}s: {}'.format(time.time() - start, json.dumps(supervisor.summary(status),
+                                                                               sort_keys=True)))
+        status = supervisor.status()
+        return {
+            'summary': supervisor.summary(status),
+            'telescopes': dict((name, {'track_error': state['track_error'], 'peak_track_error': peaks[name],
+                                       'commands_per_minute': state['commands_per_minute'],
+                                       'max_link_rtt': rtts[name], 'reconnects': state['link_reconnects']})
+                               for name, state in status.items()),
+        }
+    finally:
+        supervisor.stop()
+        stop.set()
+        for process in simulators:
+            process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive several telescopes, one worker process each')
+    parser.add_argument('config', nargs='?', help='JSON file listing the telescopes')
+    parser.add_argument('--record-dir', help='directory to record sessions in')
+    parser.add_argument('--gains', help='tracking gains file')
+    parser.add_argument('--load-test', type=int, metavar='N', help='track on N simulated telescopes instead')
+    parser.add_argument('--duration', type=float, default=60., help='seconds to load test for')
+    parser.add_argument('--slip', type=float, default=0.02)
+    parser.add_argument('--output', help='file to write the load test results to')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    if args.load_test:
+        results = load_test(args.load_test, args.duration, args.slip)
+        print(json.dumps(results, indent=2, sort_keys=True))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        sys.exit(0)
+    if not args.config:
+        parser.error('a config file or --load-test is needed')
+
+    with open(args.config) as f:
+        supervisor = Supervisor(json.load(f), args.record_dir, args.gains)
+    supervisor.start()
+    try:
+        while True:
+            time.sleep(STATUS_INTERVAL)
+            supervisor.check()
+            print(json.dumps(supervisor.summary(), sort_keys=True))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Run a tracking session against the simulated controller faster than real time
+
+By default the session runs on a VirtualClock from sunrise to sunset, which
+takes seconds rather than a day:
+
+    python solar/tracking_sim.py --date 2014-06-01 --slip 0.02
+
+The report gives the pointing error of the polar and declination axes
+against the ephemeris, along with how many commands and round trips it
+took. --mode sidereal runs the constant rate tracking for comparison.
+"""
+import argparse
+from datetime import datetime
+import json
+from multiprocessing import Pipe
+import time
+import numpy as np
+import clock
+import control
+import simulator
+import solar
+import solar_async
+import transform
+from ephemeris import sun_position
+from shared_state import SharedState
+
+CARDIFF = (-3.1701, 51.4841)
+
+
+class _SamplingController(simulator.Controller):
+    """
+    Controller that remembers where both axes were before and after each turn
+    """
+    def __init__(self, **kwargs):
+        simulator.Controller.__init__(self, **kwargs)
+        self.samples = []
+
+    def _sample(self):
+        self.samples.append((self._clock().monotonic(), self.position[solar.Devices.body],
+                             self.position[solar.Devices.mirror]))
+
+    def _run(self, steps, moves):
+        self._sample()
+        simulator.Controller._run(self, steps, moves)
+        self._sample()
+
+
+def daylight(longitude, latitude, date):
+    """
+    Find when the Sun is up
+    date -- UTC date
+    Returns (sunrise, sunset) in POSIX seconds, or None if the Sun doesn't rise
+    """
+    midnight = (datetime(date.year, date.month, date.day) - clock.EPOCH).total_seconds()
+    times = midnight + 60. * np.arange(24 * 60 + 1)
+    _, alt = sun_position(longitude, latitude, times)
+    up = np.flatnonzero(alt > 0)
+    if len(up) == 0:
+        return None
+    return times[up[0]], times[up[-1]]
+
+
+def simulate_tracking(longitude=CARDIFF[0], latitude=CARDIFF[1], start=None, duration=None,
+                      slip=0., slip_jitter=0., accelerate=None, seed=0,
+                      mode=solar_async.TrackModes.EPHEMERIS, controllers=None, mount=None, slip_profile=None):
+    """
+    Track for a while against a simulated controller, starting on the Sun
+    longitude, latitude -- Site, in degrees
+    start -- UTC datetime or POSIX seconds to start at, defaults to today's sunrise
+    duration -- Seconds to track for, defaults to until sunset
+    slip, slip_jitter, slip_profile -- Encoder slip, see simulator.Controller
+    accelerate -- Run on an AcceleratedClock this many times faster than real
+                  time, rather than a VirtualClock
+    mode -- One of solar_async.TrackModes
+    controllers -- Optional {motor: control.TrackController}, defaults to
+                   control.make_controllers
+    mount -- Optional solar.Mount to track with, on a telescope of its own,
+             defaults to the active telescope's
+    Returns a dict report
+    """
+    if isinstance(start, datetime):
+        start = (start - clock.EPOCH).total_seconds()
+    if start is None or duration is None:
+        day = datetime.utcfromtimestamp(start if start is not None else time.time()).date()
+        sun = daylight(longitude, latitude, day)
+        if sun is None:
+            raise ValueError('The Sun does not rise on {}'.format(day))
+        if start is None:
+            start = sun[0]
+        if duration is None:
+            duration = sun[1] - sun[0]
+
+    if accelerate is None:
+        sim_clock = clock.VirtualClock(start)
+    else:
+        sim_clock = clock.AcceleratedClock(accelerate, start)
+
+    previous_telescope = solar.set_telescope(solar.Telescope(mount)) if mount is not None else None
+    telescope = solar.get_telescope()
+    mount = telescope.mount
+    previous = clock.set_clock(sim_clock)
+    try:
+        controller = _SamplingController(slip=slip, slip_jitter=slip_jitter, seed=seed, mount=mount,
+                                         slip_profile=slip_profile)
+        solar.connect(transport=simulator.FakeTransport(controller))
+        conn, _ = Pipe()
+        properties = solar_async.TrackProperties()
+        properties.conn = conn
+        properties.state = SharedState()
+        properties.longitude = longitude
+        properties.latitude = latitude
+        properties.controllers = controllers
+        properties.az, properties.alt = [float(x) for x in sun_position(longitude, latitude, start)]
+
+        wall_start = time.time()
+        utc_offset = sim_clock.time() - sim_clock.monotonic()
+        if mode == solar_async.TrackModes.SIDEREAL:
+            solar_async.track_process(properties, duration)
+        else:
+            solar_async.track_ephemeris(properties, duration)
+        wall_time = time.time() - wall_start
+    finally:
+        clock.set_clock(previous)
+        if previous_telescope is not None:
+            solar.set_telescope(previous_telescope)
+
+    samples = np.array(controller.samples).reshape(-1, 3)
+    ha, dec = transform.altaz_to_hadec(*sun_position(longitude, latitude, samples[:, 0] + utc_offset),
+                                       latitude=latitude)
+    ha0, dec0 = transform.altaz_to_hadec(*sun_position(longitude, latitude, start), latitude=latitude)
+    ha_error = transform.wrap(ha0 + samples[:, 1] * mount.arcsec_per_step - ha)
+    dec_error = dec0 + samples[:, 2] * mount.arcsec_per_step - dec
+    error = np.hypot(ha_error, dec_error)
+
+    return {
+        'start': start,
+        'duration': duration,
+        'wall_time': wall_time,
+        'slip': slip,
+        'mode': 'sidereal' if mode == solar_async.TrackModes.SIDEREAL else 'ephemeris',
+        'commands': controller.commands,
+        'round_trips': telescope.round_trips,
+        'commands_per_minute': controller.commands / (duration / 60.),
+        'rms_error': float(np.sqrt(np.mean(error ** 2))) if len(error) else 0.,
+        'rms_ha_error': float(np.sqrt(np.mean(ha_error ** 2))) if len(error) else 0.,
+        'rms_dec_error': float(np.sqrt(np.mean(dec_error ** 2))) if len(error) else 0.,
+        'peak_error': float(error.max()) if len(error) else 0.,
+        'final_error': float(error[-1]) if len(error) else 0.,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate a day of tracking')
+    parser.add_argument('--longitude', type=float, default=CARDIFF[0])
+    parser.add_argument('--latitude', type=float, default=CARDIFF[1])
+    parser.add_argument('--date', help='UTC date as YYYY-MM-DD, defaults to today')
+    parser.add_argument('--hours', type=float, help='hours to track, defaults to sunrise to sunset')
+    parser.add_argument('--slip', type=float, default=0.)
+    parser.add_argument('--slip-jitter', type=float, default=0.)
+    parser.add_argument('--mode', choices=('ephemeris', 'sidereal'), default='ephemeris')
+    parser.add_argument('--gains', help='tracking gains file, see control')
+    parser.add_argument('--accelerate', type=float,
+                        help='run this many times faster than real time instead of on a virtual clock')
+    args = parser.parse_args()
+
+    start = None
+    if args.date is not None:
+        date = datetime.strptime(args.date, '%Y-%m-%d')
+        sun = daylight(args.longitude, args.latitude, date)
+        start = sun[0] if sun else (date - clock.EPOCH).total_seconds()
+    duration = args.hours * 3600 if args.hours is not None else None
+
+    mode = solar_async.TrackModes.SIDEREAL if args.mode == 'sidereal' else solar_async.TrackModes.EPHEMERIS
+    report = simulate_tracking(args.longitude, args.latitude, start, duration, args.slip,
+                               args.slip_jitter, args.accelerate, mode=mode,
+                               controllers=control.make_controllers() if args.gains is None
+                               else control.load_controllers(args.gains))
+    print(json.dumps(report, indent=2, sort_keys=True))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Conversions between the Sun's azimuth and altitude and the telescope's own
+axes, the hour angle turned by the polar axis and the declination turned by
+the mirror axis
+
+Angles are in arcseconds, like the positions from ephemeris, with azimuth
+measured from south and positive towards the east, and hour angle positive
+towards the west. Latitude is in degrees. Every function works on scalars or
+NumPy arrays, broadcast against each other.
+
+Right ascension is not needed to point the mount, the hour angle already
+includes the site's longitude through the azimuth and altitude it came from.
+"""
+import numpy as np
+
+ARCSEC_PER_RADIAN = 180. * 3600. / np.pi
+FULL_TURN = 360 * 3600
+HALF_TURN = 180 * 3600
+
+
+def wrap(arcsec):
+    """
+    Wrap an angle or difference of angles into [-180, 180) degrees
+    """
+    return (np.asarray(arcsec, dtype=float) + HALF_TURN) % FULL_TURN - HALF_TURN
+
+
+def altaz_to_hadec(az, alt, latitude):
+    """
+    Convert azimuth and altitude to hour angle and declination
+    az, alt -- Arcseconds
+    latitude -- Degrees
+    Returns (hour angle, declination) in arcseconds
+    """
+    az = np.asarray(az, dtype=float) / ARCSEC_PER_RADIAN
+    alt = np.asarray(alt, dtype=float) / ARCSEC_PER_RADIAN
+    lat = np.radians(latitude)
+
+    dec = np.arcsin(np.clip(np.sin(lat) * np.sin(alt) - np.cos(lat) * np.cos(alt) * np.cos(az), -1, 1))
+    hour_angle = np.arctan2(-np.cos(alt) * np.sin(az),
+                            np.cos(alt) * np.cos(az) * np.sin(lat) + np.sin(alt) * np.cos(lat))
+    return hour_angle * ARCSEC_PER_RADIAN, dec * ARCSEC_PER_RADIAN
+
+
+def hadec_to_altaz(hour_angle, dec, latitude):
+    """
+    Convert hour angle and declination to azimuth and altitude
+    hour_angle, dec -- Arcseconds
+    latitude -- Degrees
+    Returns (azimuth, altitude) in arcseconds
+    """
+    hour_angle = np.asarray(hour_angle, dtype=float) / ARCSEC_PER_RADIAN
+    dec = np.asarray(dec, dtype=float) / ARCSEC_PER_RADIAN
+    lat = np.radians(latitude)
+
+    alt = np.arcsin(np.clip(np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(hour_angle), -1, 1))
+    az = np.arctan2(-np.cos(dec) * np.sin(hour_angle),
+                    np.cos(hour_angle) * np.cos(dec) * np.sin(lat) - np.sin(dec) * np.cos(lat))
+    return az * ARCSEC_PER_RADIAN, alt * ARCSEC_PER_RADIAN
+
+
+def axis_offsets(az, alt, start_az, start_alt, latitude):
+    """
+    Find how far each axis has to turn to go from one position to another
+    az, alt -- Position to go to, arcseconds
+    start_az, start_alt -- Position to start from, arcseconds
+    latitude -- Degrees
+    Returns (polar, declination) turns in arcseconds, the polar turn taking
+    the short way round
+    """
+    ha, dec = altaz_to_hadec(az, alt, latitude)
+    start_ha, start_dec = altaz_to_hadec(start_az, start_alt, latitude)
+    return wrap(ha - start_ha), dec - start_dec
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Pick tracking gains by replaying recorded sessions against the simulator
+
+    python solar/tune_gains.py sessions/20140601T101500 --write
+
+Each session, see recorder, gives the time tracking ran and the slip each
+motor's encoder saw through it, measured every 50 encoder ticks from the
+turns and replies recorded. Tracking is re-run over the same time on a
+virtual clock for every combination of gains in the grid, against a
+simulated controller whose slip follows the recording, and the gains with
+the lowest RMS error times commands per minute are kept, so an extra
+command has to buy a matching cut in error. The error recorded on the
+night is reported alongside for comparison.
+"""
+import argparse
+import itertools
+import json
+import logging
+import numpy as np
+import control
+import recorder
+import solar
+import tracking_sim
+
+GRID = {
+    'kp': (0.5, 0.75, 1.),
+    'ki': (0., 0.01, 0.05),
+    'kd': (0., 0.5),
+    'deadband': (0., 10., 25.),
+}
+
+
+def _slips(records, motor, window, mount):
+    """
+    Measure the slip of one motor through a recorded session
+    Returns (slip over the whole session, times, slips), slips being
+    measured over each window encoder ticks the motor moved, starting at the
+    POSIX times given
+    """
+    records = records[records['motor'] == motor.encode('ascii')]
+    turns = records['kind'] == recorder.Kinds.TURN
+    sign = np.where(records['direction'] == solar.Directions.anti_clockwise.encode('ascii'), -1, 1)
+    steps = np.cumsum(np.where(turns, sign * records['steps'], 0))
+    readings = np.flatnonzero(records['kind'] == recorder.Kinds.ENCODER)
+    if len(readings) < 2:
+        return 0., [], []
+
+    times = records['utc'][readings]
+    encoder, steps = records['encoder'][readings].astype(float), steps[readings].astype(float)
+    moved = np.abs(encoder - encoder[0]) * mount.steps_per_enc
+    sent = np.abs(steps - steps[0])
+    slip = max(1. - moved[-1] / sent[-1], 0.) if sent[-1] > 0 else 0.
+
+    edges = np.searchsorted(moved, np.arange(0, moved[-1], window * mount.steps_per_enc))
+    windows = [(a, b) for a, b in zip(edges[:-1], edges[1:]) if sent[b] > sent[a]]
+    return (slip, [float(times[a]) for a, b in windows],
+            [float(1. - (moved[b] - moved[a]) / (sent[b] - sent[a])) for a, b in windows])
+
+
+def session_conditions(records, motor=solar.Devices.body, window=50, mount=None):
+    """
+    Work out what a recorded session was tracking through
+    records -- Structured array from recorder.load_session
+    motor -- Motor to sum the slip up for
+    window -- Encoder ticks in each slip measurement
+    mount -- solar.Mount the session was recorded on, defaults to the active telescope's
+    Returns a dict of start (POSIX), duration (seconds), slip and
+    slip_jitter of the motor, slip_profile, the slip of each motor over
+    time for simulator.Controller, and rms_error, the tracking error
+    recorded in arcsec
+    """
+    mount = mount or solar.get_telescope().mount
+    conditions = {
+        'start': float(records['utc'][0]) if len(records) else 0.,
+        'duration': float(records['utc'][-1] - records['utc'][0]) if len(records) else 0.,
+        'slip': 0.,
+        'slip_jitter': 0.,
+        'slip_profile': {},
+        'rms_error': 0.,
+    }
+    for each in (solar.Devices.body, solar.Devices.mirror):
+        slip, times, slips = _slips(records, each, window, mount)
+        if times:
+            conditions['slip_profile'][each] = (times, slips)
+        if each == motor:
+            conditions['slip'] = slip
+            # A uniform jitter of +-j has a spread of j / sqrt(3)
+            if len(slips) > 1:
+                conditions['slip_jitter'] = float(np.std(slips) * np.sqrt(3))
+
+    errors = records[records['kind'] == recorder.Kinds.ERROR]
+    if len(errors):
+        squares = [np.mean(errors['error'][errors['motor'] == each.encode('ascii')].astype(float) ** 2)
+                   for each in (solar.Devices.body, solar.Devices.mirror)
+                   if np.any(errors['motor'] == each.encode('ascii'))]
+        conditions['rms_error'] = float(np.sqrt(sum(squares)) * mount.arcsec_per_enc)
+    return conditions
+
+
+def candidates(grid=GRID):
+    """
+    Yields gains for each combination in the grid, the same on both axes
+    """
+    names = sorted(grid)
+    for values in itertools.product(*[grid[name] for name in names]):
+        gains = dict(zip(names, values))
+        yield {'body': gains, 'mirror': gains}
+
+
+def score(report):
+    return report['rms_error'] * report['commands_per_minute']
+
+
+def tune(conditions, longitude=tracking_sim.CARDIFF[0], latitude=tracking_sim.CARDIFF[1],
+         grid=GRID, hours=None, mount=None):
+    """
+    Replay every session with every candidate set of gains
+    conditions -- List of dicts from session_conditions
+    hours -- Only replay this much of each session, to save time
+    mount -- solar.Mount the sessions were recorded on, defaults to the active telescope's
+    Returns a list of (score, gains, reports), best first
+    """
+    mount = mount or solar.get_telescope().mount
+    results = []
+    for gains in candidates(grid):
+        reports = []
+        for session in conditions:
+            duration = session['duration'] if hours is None else min(session['duration'], hours * 3600)
+            # The slip profile already varies as much as the recording did
+            jitter = 0. if session['slip_profile'] else session['slip_jitter']
+            reports.append(tracking_sim.simulate_tracking(
+                longitude, latitude, session['start'], duration, session['slip'], jitter,
+                controllers=control.make_controllers(gains, mount), mount=mount,
+                slip_profile=session['slip_profile']))
+        results.append((float(np.mean([score(report) for report in reports])), gains, reports))
+        logging.info('{:.1f} {}'.format(results[-1][0], gains['body']))
+    results.sort(key=lambda result: result[0])
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune the tracking gains on recorded sessions')
+    parser.add_argument('sessions', nargs='+', help='session directories written by recorder')
+    parser.add_argument('--longitude', type=float, default=tracking_sim.CARDIFF[0])
+    parser.add_argument('--latitude', type=float, default=tracking_sim.CARDIFF[1])
+    parser.add_argument('--hours', type=float, help='replay at most this much of each session')
+    parser.add_argument('--write', action='store_true', help='save the best gains to the gains file')
+    parser.add_argument('--gains', help='gains file to write, defaults to control.CONFIG_PATH')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    conditions = [session_conditions(recorder.load_session(path)) for path in args.sessions]
+    for path, session in zip(args.sessions, conditions):
+        logging.info('{}: {}'.format(path, dict((name, value) for name, value in session.items()
+                                                 if name != 'slip_profile')))
+    conditions = [session for session in conditions if session['duration'] > 0]
+    if not conditions:
+        parser.error('no tracking in the sessions given')
+
+    results = tune(conditions, args.longitude, args.latitude, hours=args.hours)
+    best_score, best, reports = results[0]
+    print(json.dumps({'score': best_score, 'gains': best,
+                      'rms_error': [report['rms_error'] for report in reports],
+                      'recorded_rms_error': [session['rms_error'] for session in conditions],
+                      'commands_per_minute': [report['commands_per_minute'] for report in reports]},
+                     indent=2, sort_keys=True))
+    if args.write:
+        control.save_gains(control.make_controllers(best), args.gains)
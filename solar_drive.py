@@ -7,7 +7,8 @@ import solar
 import os
 import sys
 from datetime import datetime
-from PyQt4 import QtGui, QtCore, uic
+from PyQt4 import QtGui, QtCore
+from build_ui import load_ui
 
 
 def get_ui_file(name):
@@ -21,28 +22,67 @@ class SolarDriverApp(QtGui.QApplication):
     """
     The actual application. Handles loading the interface and connecting together
     the interface elements to their respective functions
+
+    Nothing is polled. The worker's pipe and the shared state's notification
+    pipe are watched by QSocketNotifiers, so replies are handled and the
+    position shown as soon as they arrive, and the clocks tick once a second
+    on the second.
+
+    The window is shown before the worker is started, which brings in
+    multiprocessing and NumPy, so it appears as quickly as possible.
     """
+    positionChanged = QtCore.pyqtSignal(float, float)
+
     def __init__(self):
         super(SolarDriverApp, self).__init__([])
-        ui = uic.loadUi(get_ui_file('solar_drive.ui'))
+        ui = load_ui(get_ui_file('solar_drive.ui'))
         self.ui = ui
 
         logging.getLogger().setLevel(logging.INFO)
 
-        self.telescope = solar.TelescopeManager()
+        # Nothing to act on until start_telescope has run
+        ui.setEnabled(False)
+        ui.show()
+        ui.raise_()
+
+        self.telescope = None
+        self.position = None
+        self.times = {}
+        self.positionChanged.connect(self.show_position)
+
+        self.clock = QtCore.QTimer(self)
+        self.clock.setSingleShot(True)
+        self.clock.timeout.connect(self.update_time)
+        self.update_time()
+
+        QtCore.QTimer.singleShot(0, self.start_telescope)
+
+    def start_telescope(self):
+        """
+        Start the worker and connect the interface to it, once the window is up
+        """
+        ui = self.ui
+        settings = QtCore.QSettings('Solar Control', 'solar_drive')
+        # 1 for legacy firmware, which would otherwise hold up connecting
+        protocol = settings.value('Motors/protocol', 0).toInt()[0]
+        self.telescope = solar.TelescopeManager(version=protocol or None)
         self.telescope.start()
 
-        self.ui.latitude.valueChanged.connect(self.set_latitude)
-        self.ui.longitude.valueChanged.connect(self.set_longitude)
-        self.ui.azAdjust.valueChanged.connect(self.tune)
-        self.ui.altAdjust.valueChanged.connect(self.tune)
+        ui.latitude.valueChanged.connect(self.set_latitude)
+        ui.longitude.valueChanged.connect(self.set_longitude)
+        ui.azAdjust.valueChanged.connect(self.tune)
+        ui.altAdjust.valueChanged.connect(self.tune)
 
-        ui.show()
-        ui.raise_()
+        self.replies = QtCore.QSocketNotifier(self.telescope.conn.fileno(), QtCore.QSocketNotifier.Read, self)
+        self.replies.activated.connect(self.flush_messages)
+        self.updates = QtCore.QSocketNotifier(self.telescope.state.fileno(), QtCore.QSocketNotifier.Read, self)
+        self.updates.activated.connect(self.state_changed)
+        self.state_changed()
 
-        timer = QtCore.QTimer(self)
-        timer.timeout.connect(self.update_time)
-        timer.start(200)
+        # Messages the manager holds back to coalesce are sent once due
+        self.held = QtCore.QTimer(self)
+        self.held.setSingleShot(True)
+        self.held.timeout.connect(self.flush_messages)
 
         ui.trackButton.clicked.connect(self.track)
         ui.findSun.clicked.connect(self.find_sun)
@@ -56,14 +96,17 @@ class SolarDriverApp(QtGui.QApplication):
         ui.setSun.clicked.connect(self.telescope.set_sun)
 
         ui.setZero.hide()
-        
+
         self.aboutToQuit.connect(self.terminating)
         self.load_config()
+        ui.setEnabled(True)
 
     def terminating(self):
         """
         Called just before the application quits
         """
+        if self.telescope is None:
+            return
         self.telescope.join()
         self.save_config()
 
@@ -78,6 +121,7 @@ class SolarDriverApp(QtGui.QApplication):
         self.telescope.latitude = settings.value('lat', self.ui.latitude.value()).toPyObject()
         self.telescope.longitude = settings.value('long', self.ui.longitude.value()).toPyObject()
         settings.endGroup()
+        self.send_held()
 
     def save_config(self):
         """
@@ -92,9 +136,12 @@ class SolarDriverApp(QtGui.QApplication):
 
     def set_latitude(self, value):
         self.telescope.latitude = value
+        self.send_held()
 
     def set_longitude(self, value):
         self.telescope.longitude = value
+        self.send_held()
+        self.update_time()
 
     def azLeft(self):
         arc = self.ui.calArcSec.value()
@@ -133,28 +180,59 @@ class SolarDriverApp(QtGui.QApplication):
         t_az = self.ui.azAdjust.value()
         t_alt = self.ui.altAdjust.value()
         self.telescope.tune([t_az, t_alt])
+        self.send_held()
 
-    def update_time(self):
+    def send_held(self):
         """
-        Called repeatedly to check for any updates and to update the time
-        and position displays
+        Have any message the manager held back sent when it is due
         """
-        self.telescope.flush_messages()
-
-        lt = datetime.now()
-        qlt = QtCore.QTime(lt.hour, lt.minute, lt.second)
-        self.ui.localTime.setTime(qlt)
+        delay = self.telescope.held_for()
+        if delay is not None and not self.held.isActive():
+            self.held.start(int(delay * 1000) + 1)
 
-        utc = datetime.utcnow()
-        qutc = QtCore.QTime(utc.hour, utc.minute, utc.second)
-        self.ui.utcTime.setTime(qutc)
+    def flush_messages(self):
+        """
+        Called when the worker replies, and when held back messages are due
+        """
+        if not self.telescope.is_alive():
+            # The pipe stays readable once closed
+            self.replies.setEnabled(False)
+        self.telescope.flush_messages()
+        self.send_held()
 
-        mst = solar.mean_solar_time(self.ui.longitude.value())
-        qmst = QtCore.QTime(mst.hour, mst.minute, mst.second)
-        self.ui.solarTime.setTime(qmst)
+    def state_changed(self):
+        """
+        Called when the worker has published, to show the position if it moved
+        """
+        self.telescope.state.drain()
+        state = self.telescope.state.snapshot()
+        position = (state['az'], state['alt'])
+        if position != self.position:
+            self.position = position
+            self.positionChanged.emit(*position)
+
+    def show_position(self, az, alt):
+        self.ui.azDisplay.setText(solar.az_to_str(az))
+        self.ui.altDisplay.setText(solar.alt_to_str(alt))
+
+    def _set_time(self, widget, t):
+        """
+        Show t on a time widget, if it isn't already
+        """
+        shown = (t.hour, t.minute, t.second)
+        if self.times.get(widget) != shown:
+            self.times[widget] = shown
+            widget.setTime(QtCore.QTime(*shown))
 
-        self.ui.azDisplay.setText(solar.az_to_str(self.telescope.az))
-        self.ui.altDisplay.setText(solar.alt_to_str(self.telescope.alt))
+    def update_time(self):
+        """
+        Update the clocks, then wait for the start of the next second
+        """
+        lt = datetime.now()
+        self._set_time(self.ui.localTime, lt)
+        self._set_time(self.ui.utcTime, datetime.utcnow())
+        self._set_time(self.ui.solarTime, solar.mean_solar_time(self.ui.longitude.value()))
+        self.clock.start(1000 - lt.microsecond // 1000)
 
 if __name__ == '__main__':
     app = SolarDriverApp()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+The modules in solar/ import each other by name, so the tests import them
+the same way, with solar/ ahead of the repository root on the path
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'solar'))
+
+
+@pytest.fixture(autouse=True)
+def ephemeris_cache(tmp_path, monkeypatch):
+    """
+    Keep the tracking loops' ephemeris tables out of the home directory
+    """
+    monkeypatch.setenv('SOLAR_DRIVE_CACHE', str(tmp_path / 'ephemeris'))
+    if 'solar_async' in sys.modules:
+        monkeypatch.setattr(sys.modules['solar_async'], 'ephemeris_cache', None)
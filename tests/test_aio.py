@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import protocol
+import simulator
+import solar
+from solar_aio import AsyncTelescope
+
+
+async def _serve(junk):
+    """
+    Start a server speaking for a simulated controller, sending junk before
+    every reply frame
+    Returns the server
+    """
+    controller = simulator.Controller(time_scale=0)
+
+    async def handle(reader, writer):
+        stream = simulator._Stream(controller)
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            for reply in stream.feed(data):
+                writer.write((junk if reply[0] & protocol.FRAME_FLAG else b'') + reply)
+        writer.close()
+
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+def _run(junk, setup=None):
+    """
+    Ask for both encoders through an AsyncTelescope
+    setup -- Optional function called with the telescope once connected
+    Returns the replies, or the exception raised
+    """
+    async def session():
+        server = await _serve(junk)
+        telescope = AsyncTelescope()
+        try:
+            await telescope.connect(*server.sockets[0].getsockname()[:2])
+            if setup is not None:
+                setup(telescope)
+            return await asyncio.wait_for(asyncio.gather(telescope.command('EB'), telescope.command('EM')), 5)
+        except Exception as e:
+            return e
+        finally:
+            await telescope.close()
+            server.close()
+            await server.wait_closed()
+
+    return asyncio.run(session())
+
+
+def test_bytes_between_frames_skipped():
+    assert _run(b'\r\n') == ['0', '0']
+
+
+def test_pending_replies_failed_when_reader_stops():
+    def setup(telescope):
+        def broken(cmd, line):
+            raise RuntimeError('broken')
+        telescope._update = broken
+
+    assert isinstance(_run(b'', setup), solar.ConnectionLost)
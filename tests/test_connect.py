@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import time
+import protocol
+import simulator
+import solar
+import solar_async
+
+
+def test_legacy_version_skips_negotiating():
+    sim = simulator.Simulator(time_scale=0, version=1)
+    sim.start()
+    manager = solar_async.TelescopeManager(sim.address, version=1)
+    try:
+        start = time.time()
+        manager.start()
+        while not manager.state['link_up'] and time.time() - start < solar.NEGOTIATE_TIMEOUT:
+            time.sleep(0.01)
+        assert manager.state['link_up']
+        assert time.time() - start < solar.NEGOTIATE_TIMEOUT / 2
+    finally:
+        manager.join()
+        sim.stop()
+
+
+def test_reconnect_keeps_version():
+    sim = simulator.Simulator(time_scale=0, version=1)
+    sim.start()
+    telescope = solar.Telescope()
+    try:
+        telescope.connect(*sim.address, version=1)
+        telescope.sync()
+        sim.drop_connections()
+        start = time.time()
+        while telescope.reconnects == 0 and time.time() - start < 10:
+            try:
+                telescope.sync()
+            except solar.ConnectionLost:
+                time.sleep(0.01)
+        assert telescope.version == 1
+        assert time.time() - start < solar.NEGOTIATE_TIMEOUT / 2
+    finally:
+        telescope.disconnect()
+        sim.stop()
+
+
+def test_legacy_rejects_bad_direction():
+    sim = simulator.Simulator(time_scale=0, version=1)
+    sim.start()
+    telescope = solar.Telescope()
+    try:
+        telescope.connect(*sim.address, version=1)
+        reply, = telescope.submit('DX10,A10')
+        try:
+            reply.result()
+        except IOError as e:
+            assert not isinstance(e, solar.ConnectionLost)
+            assert str(e).endswith('error {}'.format(protocol.Errors.BAD_DIRECTION))
+        else:
+            assert False, 'bad direction was not rejected'
+        # The link stays in step for the next command
+        assert telescope.submit('EB')[0].result() == '0'
+    finally:
+        telescope.disconnect()
+        sim.stop()
+
+
+def test_disconnect_fails_pending_replies():
+    sim = simulator.Simulator(time_scale=0)
+    sim.start()
+    telescope = solar.Telescope()
+    try:
+        telescope.connect(*sim.address)
+        reply, = telescope.submit('EB')
+        telescope.disconnect()
+        try:
+            reply.result()
+        except solar.ConnectionLost:
+            pass
+        else:
+            assert False, 'reply outlived the connection'
+    finally:
+        sim.stop()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import pytest
+import control
+import simulator
+import solar
+
+
+def test_threshold_output_limited_to_one_command():
+    mount = solar.Mount()
+    controller = control.ThresholdController(mount)
+    limit = solar.MAX_STEPS_PER_COMMAND * mount.arcsec_per_step
+    assert controller.update(10 * limit, 0., 1.) == limit
+    assert controller.update(3 * mount.arcsec_per_enc, 10., 1.) == 10. + 2 * mount.arcsec_per_enc
+    assert controller.update(-10 * limit, 10., 1.) == 0.
+
+
+def test_pid_output_limited_to_one_command():
+    mount = solar.Mount()
+    controller = control.PIDController(ki=1., mount=mount)
+    limit = solar.MAX_STEPS_PER_COMMAND * mount.arcsec_per_step
+    assert controller.update(10 * limit, 0., 1.) == limit
+    assert controller.update(-10 * limit, 0., 1.) == -limit
+
+
+def test_step_refuses_more_than_one_command():
+    solar.set_telescope(solar.Telescope())
+    controller = simulator.Controller(time_scale=0)
+    solar.connect(transport=simulator.FakeTransport(controller))
+    with pytest.raises(ValueError):
+        solar.step(solar.Devices.body, solar.Directions.clockwise, solar.MAX_STEPS_PER_COMMAND + 1)
+    with pytest.raises(ValueError):
+        solar.step_both(solar.Directions.clockwise, 0, solar.Directions.clockwise, solar.MAX_STEPS_PER_COMMAND + 1)
+    assert controller.steps == 0
+    solar.step(solar.Devices.body, solar.Directions.clockwise, solar.MAX_STEPS_PER_COMMAND)
+    assert controller.steps == solar.MAX_STEPS_PER_COMMAND
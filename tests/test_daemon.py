@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import simulator
+from daemon import Daemon, Errors
+
+
+def _ask(requests, setup=None, together=False):
+    """
+    Send requests to a daemon driving a simulator, one reply each
+    setup -- Optional function called with the daemon once started
+    together -- Send all the requests in one write before reading any reply
+    Returns the replies
+    """
+    async def session(path):
+        sim = simulator.Simulator(time_scale=0)
+        sim.start()
+        daemon = Daemon(sim.address)
+        await daemon.start(path)
+        if setup is not None:
+            setup(daemon)
+        reader, writer = await asyncio.open_unix_connection(path)
+        try:
+            replies = []
+            if together:
+                writer.write(b''.join((json.dumps(request) + '\n').encode('utf-8') for request in requests))
+            for request in requests:
+                if not together:
+                    writer.write((json.dumps(request) + '\n').encode('utf-8'))
+                replies.append(json.loads((await asyncio.wait_for(reader.readline(), 10)).decode('utf-8')))
+            return replies
+        finally:
+            writer.close()
+            await daemon.close()
+            sim.stop()
+
+    directory = tempfile.mkdtemp()
+    try:
+        return asyncio.run(session(os.path.join(directory, 'daemon.sock')))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_bad_params_are_refused():
+    replies = _ask([{'jsonrpc': '2.0', 'id': 1, 'method': 'slew', 'params': {'polar': 'abc', 'dec': 0}},
+                    {'jsonrpc': '2.0', 'id': 2, 'method': 'slew_altaz', 'params': {'az': None, 'alt': 0}},
+                    {'jsonrpc': '2.0', 'id': 3, 'method': 'tune', 'params': 'azimuth'},
+                    {'jsonrpc': '2.0', 'id': 4, 'method': 'status'}])
+    assert [reply['id'] for reply in replies] == [1, 2, 3, 4]
+    assert [reply['error']['code'] for reply in replies[:3]] == [Errors.INVALID_PARAMS] * 3
+    assert 'result' in replies[3]
+
+
+def test_unexpected_errors_are_answered():
+    async def broken(polar, dec):
+        raise IOError('firmware went away')
+
+    def setup(daemon):
+        daemon.telescope.slew = broken
+
+    replies = _ask([{'jsonrpc': '2.0', 'id': 1, 'method': 'slew', 'params': {'polar': 3600, 'dec': 0}},
+                    {'jsonrpc': '2.0', 'id': 2, 'method': 'status'}], setup)
+    assert replies[0]['error']['code'] == Errors.INTERNAL_ERROR
+    # The daemon carries on, and isn't left thinking the mount is moving
+    assert replies[1]['result']['motion'] is None
+
+
+def test_second_track_is_refused():
+    replies = _ask([{'jsonrpc': '2.0', 'id': 1, 'method': 'track'},
+                    {'jsonrpc': '2.0', 'id': 2, 'method': 'track'},
+                    {'jsonrpc': '2.0', 'id': 3, 'method': 'stop'}], together=True)
+    assert replies[0]['result'] is True
+    assert replies[1]['error']['code'] == Errors.BUSY
+    assert replies[2]['result'] is True
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import numpy as np
+import transform
+from ephemeris import EphemerisCache, sun_position
+
+DAY = 16222 * 86400.  # 2014-06-01
+SITES = [
+    (-3.1701, 51.4841),  # Cardiff
+    (18.9553, 69.6492),  # Tromso, where the Sun crosses north above the horizon
+    (-70.6693, -33.4489),  # Santiago
+]
+
+
+def test_interpolation_matches_direct_computation():
+    cache = EphemerisCache()
+    times = DAY + np.random.RandomState(0).uniform(0, 86400, 2000)
+    for longitude, latitude in SITES:
+        az, alt = sun_position(longitude, latitude, times)
+        # Clear of the refraction switching on just below the horizon
+        up = alt > 3600
+        cached = np.array([cache.position(longitude, latitude, when) for when in times[up]])
+        assert len(cached) > 0
+        assert np.abs(transform.wrap(cached[:, 0] - az[up])).max() < 0.01
+        assert np.abs(cached[:, 1] - alt[up]).max() < 0.01
+
+
+def test_least_recently_used_table_dropped():
+    cache = EphemerisCache(max_days=2)
+    longitude, latitude = SITES[0]
+    for day in (0, 1, 0, 2):
+        cache.position(longitude, latitude, DAY + day * 86400 + 43200)
+    days = [key[2] for key in cache.tables]
+    first = int(DAY // 86400)
+    assert days == [first, first + 2]
+
+
+def test_tables_survive_restart():
+    directory = tempfile.mkdtemp()
+    try:
+        longitude, latitude = SITES[0]
+        when = DAY + 43210.5
+        expected = EphemerisCache(directory=directory).position(longitude, latitude, when)
+        assert len([name for name in os.listdir(directory) if name.endswith('.npy')]) == 1
+
+        cache = EphemerisCache(directory=directory)
+
+        def compute(key):
+            raise AssertionError('Table computed again')
+        cache._compute = compute
+        assert cache.position(longitude, latitude, when) == expected
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_tracking_cache_directory_from_environment(tmp_path, monkeypatch):
+    import solar_async
+    monkeypatch.setenv('SOLAR_DRIVE_CACHE', str(tmp_path))
+    monkeypatch.setattr(solar_async, 'ephemeris_cache', None)
+    solar_async.get_ephemeris_cache().position(SITES[0][0], SITES[0][1], DAY)
+    assert len(os.listdir(str(tmp_path))) == 1
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from solar_async import Commands, MessageQueue
+
+
+def _drain(queue):
+    return [queue.pop() for _ in range(len(queue))]
+
+
+def test_latest_replaces_last_message_in_place():
+    queue = MessageQueue()
+    queue.push([Commands.SLEW_POLAR, 10])
+    queue.push([Commands.SET_AZ, 1])
+    queue.push([Commands.SET_AZ, 2])
+    assert _drain(queue) == [[Commands.SLEW_POLAR, 10], [Commands.SET_AZ, 2]]
+    assert queue.coalesced == 1
+
+
+def test_latest_keeps_order_of_messages_between():
+    queue = MessageQueue()
+    queue.push([Commands.SET_AZ, 1])
+    queue.push([Commands.SLEW_POLAR, 10])
+    queue.push([Commands.SET_AZ, 2])
+    queue.push([Commands.CANCEL_SLEW])
+    assert _drain(queue) == [[Commands.CANCEL_SLEW], [Commands.SLEW_POLAR, 10], [Commands.SET_AZ, 2]]
+    assert queue.coalesced == 1
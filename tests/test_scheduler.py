@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from multiprocessing import Pipe
+import clock
+from scheduler import DeadlineScheduler
+
+
+def test_wakes_at_deadline():
+    here, there = Pipe()
+    scheduler = DeadlineScheduler(here)
+    assert not scheduler.wait_until(clock.monotonic() + 0.01)
+    assert scheduler.wakeups == 1
+
+
+def test_wakes_for_message():
+    here, there = Pipe()
+    scheduler = DeadlineScheduler(here)
+    there.send('stop')
+    assert scheduler.wait_until(clock.monotonic() + 60)
+
+
+def test_message_seen_after_deadline_passed():
+    here, there = Pipe()
+    scheduler = DeadlineScheduler(here)
+    there.send('stop')
+    assert scheduler.wait_until(clock.monotonic() - 60)
+    here.recv()
+    assert not scheduler.wait_until(clock.monotonic() - 60)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+import socket
+import clock
+import simulator
+import solar
+import solar_async
+import tracking_sim
+import transform
+from ephemeris import sun_position
+from shared_state import SharedState
+
+CARDIFF = (-3.1701, 51.4841)
+MORNING = datetime(2014, 6, 1, 8)
+
+
+class _StopAt(object):
+    """
+    Stands in for the manager's end of the pipe, sending one message once
+    the clock reaches a time
+    """
+    def __init__(self, when, msg):
+        self.when = when
+        self.msg = msg
+        self.sent = None
+
+    def poll(self, timeout=0):
+        return self.sent is None and clock.monotonic() >= self.when
+
+    def recv(self):
+        self.sent = clock.monotonic()
+        return self.msg
+
+
+class _TimingController(simulator.Controller):
+    """
+    Controller that remembers when each command started
+    """
+    def __init__(self, **kwargs):
+        simulator.Controller.__init__(self, **kwargs)
+        self.times = []
+
+    def _run(self, steps, moves):
+        self.times.append(self._clock().monotonic())
+        simulator.Controller._run(self, steps, moves)
+
+
+class _DroppingTransport(simulator.FakeTransport):
+    """
+    Transport that loses the connection for a while, from the nth write
+    after a message is sent down conn
+    """
+    def __init__(self, controller, conn, nth, outage=5.):
+        simulator.FakeTransport.__init__(self, controller)
+        self.conn = conn
+        self.nth = nth
+        self.outage = outage
+        self.writes = 0
+        self.down_until = None
+
+    def sendall(self, data):
+        if self.conn.sent is not None and self.down_until is None:
+            self.writes += 1
+            if self.writes == self.nth:
+                self.down_until = clock.monotonic() + self.outage
+        if self.down_until is not None and clock.monotonic() < self.down_until:
+            raise socket.error('Simulated connection drop')
+        simulator.FakeTransport.sendall(self, data)
+
+
+def _track(conn, duration, az=0., alt=0., mode=solar_async.TrackModes.EPHEMERIS, drop_at=None):
+    """
+    Track from az, alt against a simulated controller on a virtual clock
+    mode -- One of solar_async.TrackModes
+    drop_at -- Optional write after conn's message to drop the connection at,
+               see _DroppingTransport
+    Returns (controller, seconds tracked for)
+    """
+    previous = clock.set_clock(clock.VirtualClock(MORNING))
+    try:
+        controller = _TimingController()
+        transport = simulator.FakeTransport(controller)
+        if drop_at is not None:
+            transport = _DroppingTransport(controller, conn, drop_at)
+        solar.set_telescope(solar.Telescope())
+        solar.connect(transport=transport)
+        properties = solar_async.TrackProperties()
+        properties.conn = conn
+        properties.state = SharedState()
+        properties.longitude, properties.latitude = CARDIFF
+        properties.az, properties.alt = az, alt
+        if mode == solar_async.TrackModes.SIDEREAL:
+            solar_async.track_process(properties, duration)
+        else:
+            solar_async.track_ephemeris(properties, duration)
+        return controller, clock.monotonic()
+    finally:
+        clock.set_clock(previous)
+
+
+def test_stops_after_long_first_move():
+    # The first moves take longer than the tracking interval to catch up with the Sun
+    conn = _StopAt(20., [solar_async.Commands.CANCEL_TRACK])
+    controller, tracked = _track(conn, duration=600.)
+    assert conn.sent is not None
+    assert tracked - conn.sent < 5.
+
+
+def test_commands_keep_to_interval_after_long_first_move():
+    controller, tracked = _track(_StopAt(float('inf'), None), duration=600.)
+    # Once caught up the deadlines carry on from there, rather than sending
+    # the intervals missed while catching up back to back
+    gaps = [b - a for a, b in zip(controller.times, controller.times[1:])]
+    assert min(gaps) > 0.9 * solar_async.track_interval(solar.get_telescope().mount)
+
+
+def _sidereal_tune_offsets(tune_azimuth, drop_at=None):
+    """
+    Track at the sidereal rate from the Sun, fine tuning the azimuth part way
+    drop_at -- Optional write after the tune to drop the connection at
+    Returns ((polar, dec) turned more than without the tune, (polar, dec)
+    the tune should have turned by) in arcseconds
+    """
+    when = 60.
+    start = (MORNING - clock.EPOCH).total_seconds()
+    az, alt = [float(x) for x in sun_position(CARDIFF[0], CARDIFF[1], start)]
+    untuned, _ = _track(_StopAt(float('inf'), None), 600., az, alt, solar_async.TrackModes.SIDEREAL)
+    tuned, _ = _track(_StopAt(when, [solar_async.Commands.FINE_TUNE, [tune_azimuth, 0]]), 600., az, alt,
+                      solar_async.TrackModes.SIDEREAL, drop_at)
+    moved = [(tuned.position[motor] - untuned.position[motor]) * solar.ARCSEC_PER_STEP
+             for motor in (solar.Devices.body, solar.Devices.mirror)]
+    s_az, s_alt = sun_position(CARDIFF[0], CARDIFF[1], start + when)
+    expected = transform.axis_offsets(s_az + tune_azimuth, s_alt, s_az, s_alt, CARDIFF[1])
+    return moved, [float(x) for x in expected]
+
+
+def test_sidereal_fine_tune_turns_axes_by_transform():
+    for tune in (100., -100.):
+        moved, expected = _sidereal_tune_offsets(tune)
+        # Within an encoder tick of the tune on both axes
+        assert abs(moved[0] - expected[0]) < solar.ARCSEC_PER_ENC
+        assert abs(moved[1] - expected[1]) < solar.ARCSEC_PER_ENC
+
+
+def test_sidereal_fine_tune_survives_lost_connection():
+    # Dropped before the tune starts, between its moves and once it is done
+    for drop_at in (1, 2, 3, 4):
+        moved, expected = _sidereal_tune_offsets(1000., drop_at)
+        # Picking up from the encoders once reconnected can cost a tick more
+        assert abs(moved[0] - expected[0]) < 2 * solar.ARCSEC_PER_ENC
+        assert abs(moved[1] - expected[1]) < 2 * solar.ARCSEC_PER_ENC
+
+
+def test_tracks_with_mount_of_its_own():
+    # Geared unlike the module constants, so its tracking interval and
+    # encoder tick differ from the default mount's
+    mount = solar.Mount(gear_ratio=4., micro_steps=32)
+    start = (MORNING - clock.EPOCH).total_seconds()
+    report = tracking_sim.simulate_tracking(CARDIFF[0], CARDIFF[1], start, 3600., mount=mount)
+    assert abs(report['commands_per_minute'] - 60. / solar_async.track_interval(mount)) < 1.
+    assert report['rms_error'] < mount.arcsec_per_enc
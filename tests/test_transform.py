@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import transform
+
+LATITUDE = 51.4841
+DEG = 3600.
+
+
+def _close(a, b, tolerance=1e-6):
+    return np.all(np.abs(transform.wrap(np.subtract(a, b))) < tolerance)
+
+
+def test_known_positions():
+    # (az, alt) -> (hour angle, dec), in degrees, azimuth from south towards
+    # the east and hour angle towards the west
+    known = [
+        ((0, 90), (0, LATITUDE)),  # Zenith
+        ((180, LATITUDE), (180, 90)),  # Celestial pole, due north
+        ((0, 90 - LATITUDE), (0, 0)),  # Equator on the meridian
+        ((0, 90 - LATITUDE + 23.44), (0, 23.44)),  # Midsummer noon
+        ((90, 0), (-90, 0)),  # Equator rising due east
+        ((-90, 0), (90, 0)),  # Equator setting due west
+    ]
+    for (az, alt), (ha, dec) in known:
+        got_ha, got_dec = transform.altaz_to_hadec(az * DEG, alt * DEG, LATITUDE)
+        if abs(dec) < 90:
+            assert _close(got_ha, ha * DEG, 1e-3)
+        assert _close(got_dec, dec * DEG, 1e-3)
+        if abs(dec) < 90 and abs(alt) < 90:
+            got_az, got_alt = transform.hadec_to_altaz(ha * DEG, dec * DEG, LATITUDE)
+            assert _close(got_az, az * DEG, 1e-3)
+            assert _close(got_alt, alt * DEG, 1e-3)
+
+
+def test_round_trip():
+    random = np.random.RandomState(0)
+    az = random.uniform(-180, 180, 1000) * DEG
+    alt = random.uniform(-85, 85, 1000) * DEG
+    for latitude in (-33.4, 0., LATITUDE, 69.6):
+        ha, dec = transform.altaz_to_hadec(az, alt, latitude)
+        back_az, back_alt = transform.hadec_to_altaz(ha, dec, latitude)
+        assert _close(back_az, az, 1e-3)
+        assert _close(back_alt, alt, 1e-3)
+
+
+def test_axis_offset_signs():
+    alt = 40 * DEG
+    # Towards the east on the meridian is back in hour angle, with the
+    # declination unchanged to first order
+    polar, dec = transform.axis_offsets(100., alt, 0., alt, LATITUDE)
+    assert polar < 0
+    assert abs(dec) < 0.1
+    # Up on the meridian is up in declination alone
+    polar, dec = transform.axis_offsets(0., alt + 100., 0., alt, LATITUDE)
+    assert abs(polar) < 1e-3
+    assert abs(dec - 100.) < 1e-3
+    # Towards the east of a morning Sun turns the polar axis back and raises
+    # the declination
+    polar, dec = transform.axis_offsets(90 * DEG + 100., 30 * DEG, 90 * DEG, 30 * DEG, LATITUDE)
+    assert polar < 0
+    assert dec > 0
+
+
+def test_polar_offset_takes_short_way():
+    start_az, start_alt = transform.hadec_to_altaz(179 * DEG, 60 * DEG, LATITUDE)
+    az, alt = transform.hadec_to_altaz(-179 * DEG, 60 * DEG, LATITUDE)
+    polar, dec = transform.axis_offsets(az, alt, start_az, start_alt, LATITUDE)
+    assert _close(polar, 2 * DEG, 1e-3)
+    assert abs(dec) < 1e-3
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import numpy as np
+import control
+import recorder
+import solar
+import tracking_sim
+import tune_gains
+
+START = 1401606000.  # 2014-06-01 07:00 UTC
+
+
+def _record(slip_profile, gains=None, duration=3600.):
+    """
+    Record a simulated tracking session
+    Returns (records, report from tracking_sim)
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        session = recorder.start_session(directory)
+        try:
+            report = tracking_sim.simulate_tracking(start=START, duration=duration, slip_profile=slip_profile,
+                                                    controllers=control.make_controllers(gains))
+        finally:
+            recorder.stop_session()
+        return recorder.load_session(session.path), report
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_slip_profile_recovered_from_recording():
+    # The body slips more half way through
+    records, report = _record({solar.Devices.body: ([START, START + 1800], [0., 0.05])})
+    conditions = tune_gains.session_conditions(records)
+    times, slips = [np.array(x) for x in conditions['slip_profile'][solar.Devices.body]]
+    assert abs(slips[times < START + 1700].mean()) < 0.005
+    assert abs(slips[times > START + 1900].mean() - 0.05) < 0.005
+    assert conditions['rms_error'] > 0
+
+
+def test_replay_tracks_as_recorded():
+    gains = {'deadband': 25.}
+    records, recorded = _record({solar.Devices.body: ([START, START + 1200, START + 2400], [0.05, 0., 0.08])},
+                                {'body': gains, 'mirror': gains})
+    conditions = tune_gains.session_conditions(records)
+    results = tune_gains.tune([conditions], grid=dict((name, (value,)) for name, value in gains.items()))
+    replayed = results[0][2][0]
+    # The same gains against a controller slipping as recorded make the same moves
+    assert abs(replayed['commands'] - recorded['commands']) < 0.02 * recorded['commands']
+    assert abs(replayed['rms_error'] - recorded['rms_error']) < 2.